@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+"""
+Microbenchmark of the per-request overhead of DDIClient: URL building,
+resource objects, headers and JSON handling, without any network.
+
+    python3 -m bench.ddi_overhead [requests]
+"""
+
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+
+from lib.ddi.client import DDIClient
+from lib.ddi.deployment_base import (
+    DeploymentStatusExecution, DeploymentStatusResult)
+
+from bench.fakeserver import client_config
+
+BASE = json.dumps({'config': {'polling': {'sleep': '00:00:30'}},
+                   '_links': {}}).encode()
+
+
+class Response(object):
+    status = 200
+    reason = 'OK'
+    content_length = 0
+    headers = {}
+
+    def __init__(self, method, body):
+        self.method = method
+        self.body = body
+
+    async def read(self):
+        return self.body
+
+    async def text(self):
+        return ''
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class NullSession(object):
+    """
+    Answers every request immediately with a canned response.
+    """
+
+    def get(self, url, **kwargs):
+        return Response('GET', BASE)
+
+    def post(self, url, **kwargs):
+        return Response('POST', b'')
+
+    def put(self, url, **kwargs):
+        return Response('PUT', b'')
+
+
+async def measure(name, n, request):
+    start = time.perf_counter()
+    for i in range(n):
+        await request(i)
+    elapsed = time.perf_counter() - start
+
+    # memory in a separate, shorter run: tracemalloc slows down allocations
+    tracemalloc.start()
+    for i in range(min(n, 1000)):
+        await request(i)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{:24} {:8.1f} us/request  {:9.0f} requests/s  peak {:6.1f} KiB'.format(
+        name, elapsed / n * 1e6, n / elapsed, peak / 1024))
+
+
+async def main(n):
+    ddi = DDIClient(NullSession(), **client_config(8080, auth_token='token'))
+
+    async def poll(i):
+        await ddi()
+
+    async def deployment(i):
+        await ddi.deploymentBase['42']('-1')
+
+    async def feedback(i):
+        await ddi.deploymentBase['42'].feedback(
+            DeploymentStatusExecution.proceeding,
+            DeploymentStatusResult.none, ['bench'], cnt=i % 100, of=100)
+
+    await measure('base poll', n, poll)
+    await measure('deploymentBase', n, deployment)
+    await measure('deployment feedback', n, feedback)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    asyncio.get_event_loop().run_until_complete(main(n))
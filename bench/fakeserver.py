@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal local HawkBit (DDI and MI) used by the benchmarks.
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import socket
+import time
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+from lib.delta import BlockIndex, BLOCK_SIZE, INDEX_SUFFIX
+
+
+class StaticResolver(AbstractResolver):
+    """
+    Resolves every host name (device.<host>, api.<host>) to localhost.
+    """
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{'hostname': host, 'host': '127.0.0.1', 'port': port,
+                 'family': socket.AF_INET, 'proto': 0,
+                 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+
+def client_session(**kwargs):
+    '''
+    Client session talking to the fake server whatever host is configured
+    '''
+    connector = aiohttp.TCPConnector(resolver=StaticResolver())
+    return aiohttp.ClientSession(connector=connector, **kwargs)
+
+
+def client_config(port, controller_id='bench', **kwargs):
+    '''
+    HBClient configuration for the fake server
+    '''
+    config = {
+        'ssl': False,
+        'ip': 'hawkbit.local',
+        'port': str(port),
+        'tenant_id': 'default',
+        'target_name': controller_id,
+        'controller_id': controller_id,
+        'login': 'admin',
+        'password': 'admin',
+        'auth_token': '',
+        'attributes': {'MAC': ''},
+        'run_as_service': 'no',
+    }
+    config.update(kwargs)
+    return config
+
+
+
+def fiql_arguments(text):
+    '''
+    Comma separated FIQL arguments, quoted ones unescaped
+    '''
+    return [re.sub(r'\\(.)', r'\1', quoted) if quoted else plain
+            for quoted, plain in re.findall(
+                r'"((?:[^"\\]|\\.)*)"|([^,]+)', text)]
+
+
+class FakeHawkBit(object):
+    """
+    Serves the base poll resource, deployments, artifacts and feedback of
+    any number of targets and records every request. Faults appended to
+    ``faults`` (see bench.faults) replace matching responses.
+    """
+
+    def __init__(self, tenant='default', sleep='00:00:30', hold=20):
+        self.tenant = tenant
+        self.sleep = sleep
+        # seconds a long-poll notification request is held open
+        self.hold = hold
+        # controller id -> queues of connected notification listeners
+        self.listeners = {}
+        self.targets = {}
+        self.deployments = {}
+        self.artifacts = {}
+        self.requests = []
+        self.feedback = []
+        self.actions = {}
+        self.faults = []
+        self.artifact_bytes = 0
+        self.runner = None
+        self.port = None
+
+        self.app = web.Application()
+        self.app.middlewares.append(self.record)
+        controller = '/{tenant}/controller/v1/{controller_id}'
+        self.app.router.add_get('/rest/v1/targets', self.get_targets)
+        self.app.router.add_post('/rest/v1/targets', self.post_targets)
+        self.app.router.add_get('/rest/v1/targets/{controller_id}/actions',
+                                self.get_actions)
+        self.app.router.add_get(
+            '/rest/v1/targets/{controller_id}/actions/{action_id}/status',
+            self.get_action_status)
+        self.app.router.add_get(controller, self.base)
+        self.app.router.add_get(controller + '/notify', self.notifications)
+        self.app.router.add_put(controller + '/configData', self.ok)
+        self.app.router.add_get(controller + '/deploymentBase/{action_id}',
+                                self.deployment_base)
+        self.app.router.add_post(
+            controller + '/deploymentBase/{action_id}/feedback',
+            self.post_feedback)
+        self.app.router.add_get(
+            controller + '/softwaremodules/{module_id}/artifacts/{filename}',
+            self.artifact)
+
+    @web.middleware
+    async def record(self, request, handler):
+        self.requests.append((time.monotonic(), request.method, request.path))
+        for fault in self.faults:
+            if fault.matches(request):
+                return await fault.apply(self, request, handler)
+        return await handler(request)
+
+    async def start(self, host='127.0.0.1', port=0):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        self.port = sock.getsockname()[1]
+
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.SockSite(self.runner, sock).start()
+        return self.port
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def add_target(self, controller_id, name=None):
+        self.targets[controller_id] = {
+            'controllerId': controller_id,
+            'name': name or controller_id,
+            'securityToken': 'token-{}'.format(controller_id),
+            'updateStatus': 'registered',
+            'lastModifiedAt': int(time.time() * 1000),
+        }
+
+    def set_action_status(self, controller_id, status_type, messages=()):
+        '''
+        Append status to the latest action of controller_id as seen by the
+        Management API
+        '''
+        action, statuses = self.actions[controller_id]
+        now = int(time.time() * 1000)
+        statuses.append({'id': len(statuses) + 1, 'type': status_type,
+                         'messages': list(messages), 'reportedAt': now})
+        target = self.targets.get(controller_id)
+        if target is not None:
+            target['lastModifiedAt'] = now
+            target['updateStatus'] = {'finished': 'in_sync',
+                                      'error': 'error'}.get(status_type,
+                                                            'pending')
+
+    def add_deployment(self, controller_id, action_id, payload,
+                       filename='manifest.json', module_id='1',
+                       block_index=False):
+        '''
+        Assign deployment with a single artifact to controller_id,
+        with block_index also publish its block index for delta downloads
+        '''
+        self.actions[controller_id] = (
+            {'id': int(action_id), 'type': 'update', 'status': 'pending',
+             'createdAt': int(time.time() * 1000)}, [])
+        if controller_id in self.targets:
+            self.set_action_status(controller_id, 'running')
+
+        artifacts = [self.add_artifact(controller_id, module_id, filename,
+                                       payload)]
+        if block_index:
+            index = BlockIndex(BLOCK_SIZE, len(payload), [
+                hashlib.sha256(payload[i:i + BLOCK_SIZE]).hexdigest()
+                for i in range(0, len(payload), BLOCK_SIZE)])
+            artifacts.append(self.add_artifact(
+                controller_id, module_id, filename + INDEX_SUFFIX,
+                json.dumps(index.to_json()).encode()))
+
+        self.notify(controller_id)
+        self.deployments[controller_id] = {
+            'id': str(action_id),
+            'deployment': {
+                'download': 'forced',
+                'update': 'forced',
+                'chunks': [{
+                    'part': 'os',
+                    'name': 'bench',
+                    'version': '1',
+                    'artifacts': artifacts,
+                }],
+            },
+        }
+
+    def add_artifact(self, controller_id, module_id, filename, payload):
+        self.artifacts[(module_id, filename)] = payload
+        return {
+            'filename': filename,
+            'size': len(payload),
+            'hashes': {
+                'md5': hashlib.md5(payload).hexdigest(),
+                'sha1': hashlib.sha1(payload).hexdigest(),
+                'sha256': hashlib.sha256(payload).hexdigest(),
+            },
+            '_links': {
+                'download-http': {
+                    'href': self.url(controller_id,
+                                     '/softwaremodules/{}/artifacts/{}'.format(
+                                         module_id, filename))
+                },
+            },
+        }
+
+    def url(self, controller_id, path=''):
+        return 'http://device.hawkbit.local:{}/{}/controller/v1/{}{}'.format(
+            self.port, self.tenant, controller_id, path)
+
+    def query(self, q):
+        '''
+        Targets matching the FIQL subset controllerId=in=(a,b) or
+        controllerId==a
+        '''
+        targets = list(self.targets.values())
+        if not q:
+            return targets
+        if q.startswith('controllerId=in=('):
+            ids = set(fiql_arguments(q[len('controllerId=in=('):-1]))
+        elif q.startswith('controllerId=='):
+            ids = set(fiql_arguments(q[len('controllerId=='):]))
+        else:
+            raise web.HTTPBadRequest(text='unsupported query')
+        return [t for t in targets if t['controllerId'] in ids]
+
+    async def get_targets(self, request):
+        targets = self.query(request.query.get('q'))
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', 50))
+        content = targets[offset:offset + limit]
+        return web.json_response({'content': content,
+                                  'total': len(targets),
+                                  'size': len(content)})
+
+    async def post_targets(self, request):
+        created = []
+        for target in await request.json():
+            if target['controllerId'] in self.targets:
+                raise web.HTTPConflict()
+            self.add_target(target['controllerId'], target.get('name'))
+            created.append(self.targets[target['controllerId']])
+        return web.json_response(created, status=201)
+
+    async def base(self, request):
+        controller_id = request.match_info['controller_id']
+        links = {}
+        deployment = self.deployments.get(controller_id)
+        if deployment:
+            links['deploymentBase'] = {
+                'href': self.url(controller_id, '/deploymentBase/{}?c=-1'.format(
+                    deployment['id']))
+            }
+        return web.json_response({
+            'config': {'polling': {'sleep': self.sleep}},
+            '_links': links,
+        })
+
+    async def deployment_base(self, request):
+        deployment = self.deployments.get(request.match_info['controller_id'])
+        if deployment is None:
+            raise web.HTTPNotFound()
+        return web.json_response(deployment)
+
+    async def post_feedback(self, request):
+        data = await request.json()
+        controller_id = request.match_info['controller_id']
+        self.feedback.append((controller_id, data))
+        if controller_id in self.actions:
+            status = data['status']
+            if status['execution'] == 'closed':
+                status_type = 'error' if status['result']['finished'] == \
+                    'failure' else 'finished'
+            else:
+                status_type = status['execution']
+            self.set_action_status(controller_id, status_type,
+                                   status.get('details', []))
+        if data['status']['execution'] == 'closed':
+            self.deployments.pop(request.match_info['controller_id'], None)
+        return web.Response()
+
+    async def get_actions(self, request):
+        entry = self.actions.get(request.match_info['controller_id'])
+        content = [entry[0]] if entry else []
+        return web.json_response({'content': content, 'total': len(content),
+                                  'size': len(content)})
+
+    async def get_action_status(self, request):
+        entry = self.actions.get(request.match_info['controller_id'])
+        if entry is None or \
+                str(entry[0]['id']) != request.match_info['action_id']:
+            raise web.HTTPNotFound()
+        content = list(reversed(entry[1]))[:int(request.query.get('limit', 50))]
+        return web.json_response({'content': content, 'total': len(entry[1]),
+                                  'size': len(content)})
+
+    async def artifact(self, request):
+        key = (request.match_info['module_id'], request.match_info['filename'])
+        if key not in self.artifacts:
+            raise web.HTTPNotFound()
+        payload = self.artifacts[key]
+        if 'Range' in request.headers:
+            part = payload[request.http_range]
+            self.artifact_bytes += len(part)
+            return web.Response(body=part, status=206,
+                                content_type='application/octet-stream')
+        self.artifact_bytes += len(payload)
+        return web.Response(body=payload,
+                            content_type='application/octet-stream')
+
+    def notify(self, controller_id):
+        '''
+        Tell connected listeners of controller_id to poll
+        '''
+        message = json.dumps({'controllerId': controller_id})
+        for queue in self.listeners.get(controller_id, ()):
+            queue.put_nowait(message)
+
+    async def notifications(self, request):
+        '''
+        Notification channel, WebSocket or long-poll
+        '''
+        queue = asyncio.Queue()
+        listeners = self.listeners.setdefault(
+            request.match_info['controller_id'], [])
+        listeners.append(queue)
+        try:
+            if request.headers.get('Upgrade', '').lower() == 'websocket':
+                ws = web.WebSocketResponse()
+                await ws.prepare(request)
+                receive = asyncio.ensure_future(ws.receive())
+                while not ws.closed:
+                    send = asyncio.ensure_future(queue.get())
+                    await asyncio.wait((send, receive),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if receive.done():
+                        send.cancel()
+                        break
+                    await ws.send_str(send.result())
+                return ws
+
+            try:
+                message = await asyncio.wait_for(queue.get(), self.hold)
+            except asyncio.TimeoutError:
+                return web.Response(status=204)
+            return web.json_response(text=message)
+        finally:
+            listeners.remove(queue)
+
+    async def ok(self, request):
+        return web.Response()
@@ -0,0 +1,340 @@
+#! /usr/bin/env python3
+"""
+Fault injection: runs one deployment per scenario against the fake
+HawkBit while injecting failures, and measures how the agent recovers.
+
+    python3 -m bench.faults [scenario ...] [--json results.json]
+
+For every scenario the time from the first injected fault to the
+successful final feedback, the artifact bytes downloaded in vain and the
+number of duplicate feedback messages are reported. Results written
+with --json can be compared between versions.
+"""
+
+import abc
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+PAYLOAD_SIZE = 2 * 1024 * 1024
+
+
+class Fault(abc.ABC):
+    """
+    Replaces the response of the next ``times`` requests matching method
+    and the path regex.
+    """
+
+    def __init__(self, path, times=1, method='GET'):
+        self.path = re.compile(path)
+        self.times = times
+        self.method = method
+        self.injected = 0
+        self.first = None
+
+    def matches(self, request):
+        return (self.injected < self.times and
+                request.method == self.method and
+                self.path.search(request.path) is not None)
+
+    async def apply(self, server, request, handler):
+        self.injected += 1
+        if self.first is None:
+            self.first = time.monotonic()
+        return await self.inject(server, request, handler)
+
+    @abc.abstractmethod
+    async def inject(self, server, request, handler):
+        '''
+        Response replacing the one of handler(request)
+        '''
+
+
+class Status(Fault):
+    """
+    Error status instead of the response, e.g. 503 or 429.
+    """
+
+    def __init__(self, path, status, times=1, method='GET'):
+        super(Status, self).__init__(path, times, method)
+        self.status = status
+
+    async def inject(self, server, request, handler):
+        headers = {'Retry-After': '1'} if self.status == 429 else None
+        return web.Response(status=self.status, headers=headers)
+
+
+class Reset(Fault):
+    """
+    Connection closed after half of the body was sent.
+    """
+
+    async def inject(self, server, request, handler):
+        resp = await handler(request)
+        body = resp.body
+        server.artifact_bytes -= len(body)
+
+        stream = web.StreamResponse(headers={
+            'Content-Type': resp.content_type,
+            'Content-Length': str(len(body))})
+        await stream.prepare(request)
+        await stream.write(body[:len(body) // 2])
+        server.artifact_bytes += len(body) // 2
+        request.transport.close()
+        return stream
+
+
+class Slow(Fault):
+    """
+    Body trickles in small chunks.
+    """
+
+    def __init__(self, path, times=1, method='GET', chunk=16 * 1024,
+                 delay=0.05):
+        super(Slow, self).__init__(path, times, method)
+        self.chunk = chunk
+        self.delay = delay
+
+    async def inject(self, server, request, handler):
+        resp = await handler(request)
+        body = resp.body
+
+        stream = web.StreamResponse(headers={
+            'Content-Type': resp.content_type,
+            'Content-Length': str(len(body))})
+        await stream.prepare(request)
+        for i in range(0, len(body), self.chunk):
+            await stream.write(body[i:i + self.chunk])
+            await asyncio.sleep(self.delay)
+        await stream.write_eof()
+        return stream
+
+
+class TruncatedJSON(Fault):
+    """
+    JSON body cut in half.
+    """
+
+    async def inject(self, server, request, handler):
+        resp = await handler(request)
+        return web.Response(body=resp.body[:len(resp.body) // 2],
+                            content_type='application/json')
+
+
+class Corrupt(Fault):
+    """
+    Artifact with flipped bytes, so its checksum does not match.
+    """
+
+    async def inject(self, server, request, handler):
+        resp = await handler(request)
+        body = bytearray(resp.body)
+        body[len(body) // 2] ^= 0xff
+        return web.Response(body=bytes(body),
+                            content_type=resp.content_type)
+
+
+class FakeContainer(object):
+    short_id = 'bench'
+    name = 'bench'
+    status = 'running'
+
+
+class FakeImage(object):
+    attrs = {'Size': 0}
+    tags = ['bench/app:1']
+
+
+class FakeDocker(object):
+    """
+    Docker client answering pull and run without a daemon, failing the
+    first ``failures`` pulls like an unreachable daemon.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.first = None
+        self.api = self
+        self.images = self
+        self.containers = self
+
+    def pull(self, uri, stream=True, decode=True):
+        if self.failures > 0:
+            self.failures -= 1
+            if self.first is None:
+                self.first = time.monotonic()
+            raise ConnectionError('Cannot connect to the Docker daemon')
+        return iter([{'status': 'Pull complete', 'id': 'layer'}])
+
+    def run(self, image, **kwargs):
+        return FakeContainer()
+
+    def get(self, name):
+        return FakeImage()
+
+    def prune(self, **kwargs):
+        return {}
+
+    def list(self, **kwargs):
+        return []
+
+
+ARTIFACT = r'/artifacts/'
+BASE = r'/controller/v1/bench$'
+DEPLOYMENT = r'/deploymentBase/\d+$'
+FEEDBACK = r'/feedback$'
+
+SCENARIOS = {
+    'baseline': lambda: ([], 0),
+    'reset': lambda: ([Reset(ARTIFACT, times=2)], 0),
+    'slow': lambda: ([Slow(ARTIFACT)], 0),
+    'poll-5xx': lambda: ([Status(BASE, 503, times=5)], 0),
+    'feedback-429': lambda: ([Status(FEEDBACK, 429, times=5,
+                                     method='POST')], 0),
+    'feedback-401': lambda: ([Status(FEEDBACK, 401, times=3,
+                                     method='POST')], 0),
+    'truncated-json': lambda: ([TruncatedJSON(DEPLOYMENT, times=2)], 0),
+    'checksum': lambda: ([Corrupt(ARTIFACT, times=2)], 0),
+    'docker': lambda: ([], 2),
+}
+
+
+def payload():
+    '''
+    Manifest padded to PAYLOAD_SIZE so that downloads take a while
+    '''
+    manifest = {
+        'imageUri': 'bench/app:1',
+        'containerCreateOptions': {'HostConfig': {'PortBindings': {}}},
+        'padding': '',
+    }
+    manifest['padding'] = 'x' * (PAYLOAD_SIZE - len(json.dumps(manifest)))
+    return json.dumps(manifest).encode()
+
+
+def final_feedback(server):
+    for _, data in server.feedback:
+        if data['status']['execution'] == 'closed':
+            return data['status']['result']['finished']
+    return None
+
+
+async def run_scenario(name, timeout):
+    # state directories (outbox, bundle) are per scenario
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='hbfaults-')
+
+    from lib.hbclient import HBClient
+    from bench.fakeserver import FakeHawkBit, client_session, client_config
+
+    faults, docker_failures = SCENARIOS[name]()
+    data = payload()
+
+    server = FakeHawkBit(sleep='00:00:01')
+    server.add_target('bench')
+    port = await server.start()
+    server.add_deployment('bench', 1, data)
+    server.faults = faults
+
+    config = client_config(port, auth_token='token-bench',
+                           outbox_max_delay='5', progress_interval='1',
+                           gc_interval='3600')
+    docker = FakeDocker(docker_failures)
+
+    async with client_session() as session:
+        client = HBClient(session, lambda result: None, **config)
+        client.docker_client = docker
+        await client.run_ddi()
+
+        start = time.monotonic()
+        polling = asyncio.ensure_future(client.start_polling(wait_on_error=1))
+
+        result = None
+        while time.monotonic() - start < timeout:
+            result = final_feedback(server)
+            if result is not None:
+                break
+            await asyncio.sleep(0.05)
+        done = time.monotonic()
+
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+
+    await server.stop()
+
+    firsts = [f.first for f in faults if f.first is not None]
+    if docker.first is not None:
+        firsts.append(docker.first)
+    first = min(firsts) if firsts else start
+
+    statuses = [json.dumps(data['status'], sort_keys=True)
+                for _, data in server.feedback]
+    recovered = result == 'success'
+
+    return {
+        'scenario': name,
+        'result': result or 'timeout',
+        'recovered': recovered,
+        'injected': sum(f.injected for f in faults) + (
+            docker_failures - docker.failures),
+        'time_to_recover': done - first if recovered else None,
+        'total': done - start,
+        'wasted_bytes': server.artifact_bytes - (len(data) if recovered else 0),
+        'duplicate_feedback': len(statuses) - len(set(statuses)),
+        'requests': len(server.requests),
+    }
+
+
+def report(results):
+    print('{:16} {:9} {:>8} {:>9} {:>8} {:>12} {:>10} {:>8}'.format(
+        'scenario', 'result', 'injected', 'recover', 'total', 'wasted',
+        'dup fb', 'requests'))
+    for r in results:
+        recover = '{:8.2f}s'.format(r['time_to_recover']) \
+            if r['time_to_recover'] is not None else '        -'
+        print('{:16} {:9} {:8} {} {:7.2f}s {:12} {:10} {:8}'.format(
+            r['scenario'], r['result'], r['injected'], recover, r['total'],
+            r['wasted_bytes'], r['duplicate_feedback'], r['requests']))
+
+
+async def main(args):
+    results = []
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit('Unknown scenarios: {}'.format(', '.join(unknown)))
+
+    if not args.verbose:
+        logging.getLogger('hbloader').setLevel(logging.CRITICAL)
+
+    for name in args.scenarios or list(SCENARIOS):
+        # the agent prints install steps to stdout
+        output = sys.stdout if args.verbose else io.StringIO()
+        with contextlib.redirect_stdout(output):
+            results.append(await run_scenario(name, args.timeout))
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fault injection harness')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run (default all): {}'.format(
+                            ', '.join(SCENARIOS)))
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds until a scenario counts as not recovered')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show agent log and output')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
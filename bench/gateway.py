@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+"""
+Gateway benchmark: one agent polling the fake HawkBit for many identities.
+
+    python3 -m bench.gateway [--identities 200] [--deployments 10]
+
+The same artifact is assigned to --deployments identities, plus one
+download-only assignment and one outside the maintenance window, which
+must be downloaded but not installed. Reported are the time until all
+installs are closed, base polls per identity, how often the shared
+artifact was downloaded and the memory held per identity.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+PAYLOAD_SIZE = 1024 * 1024
+
+
+def closed(server, controller_ids):
+    return [c for c, data in server.feedback
+            if c in controller_ids and data['status']['execution'] == 'closed']
+
+
+def staged(server, controller_ids):
+    return [c for c, data in server.feedback
+            if c in controller_ids and
+            'Downloaded, waiting for installation' in data['status']['details']]
+
+
+async def run(args):
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='hbgateway-')
+
+    from lib.gateway import Gateway
+    from bench.fakeserver import FakeHawkBit, client_session, client_config
+
+    server = FakeHawkBit(sleep=args.sleep)
+    port = await server.start()
+
+    identities = []
+    for number in range(args.identities):
+        controller_id = 'dev-{:04d}'.format(number)
+        server.add_target(controller_id)
+        identities.append({'controller_id': controller_id,
+                           'auth_token': 'token-' + controller_id,
+                           'address': '10.0.{}.{}'.format(number // 250,
+                                                          number % 250 + 1)})
+    path = os.path.join(os.environ['HOME'], 'identities.json')
+    with open(path, 'w') as identities_file:
+        json.dump(identities, identities_file)
+
+    config = client_config(port, gateway_install=['true', '{address}',
+                                                  '{artifacts}'])
+
+    async with client_session() as session:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        gateway = Gateway.from_file(session, path, **config)
+        after = tracemalloc.take_snapshot()
+        idle = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+        payload = os.urandom(PAYLOAD_SIZE)
+        installs = [i['controller_id'] for i in identities[:args.deployments]]
+        held = [i['controller_id'] for i in
+                identities[args.deployments:args.deployments + 2]]
+        for number, controller_id in enumerate(installs + held):
+            server.add_deployment(controller_id, number + 1, payload)
+        server.deployments[held[0]]['deployment']['update'] = 'skip'
+        server.deployments[held[1]]['deployment']['maintenanceWindow'] = \
+            'unavailable'
+
+        start = time.monotonic()
+        polling = asyncio.ensure_future(gateway.start_polling(wait_on_error=1))
+        while time.monotonic() - start < args.timeout:
+            if len(closed(server, installs)) == len(installs) and \
+                    len(set(staged(server, held))) == len(held):
+                break
+            await asyncio.sleep(0.1)
+        done = time.monotonic() - start
+
+        # memory of the agent's own objects while polling
+        await asyncio.sleep(args.settle)
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(True, '*/lib/*')])
+        polling_memory = sum(stat.size for stat in snapshot.statistics('filename'))
+        tracemalloc.stop()
+        elapsed = time.monotonic() - start
+
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+
+    await server.stop()
+
+    polls = sum(1 for t, method, p in server.requests
+                if method == 'GET' and p.startswith('/default/controller/v1/')
+                and p.count('/') == 4)
+    return {
+        'identities': args.identities,
+        'installed': len(set(closed(server, installs))),
+        'deployments': len(installs),
+        'held_installed': len(closed(server, held)),
+        'held_staged': len(set(staged(server, held))),
+        'time_to_install': done,
+        'polls_per_identity': polls / args.identities,
+        'elapsed': elapsed,
+        'artifact_downloads': server.artifact_bytes / len(payload),
+        'idle_per_identity': idle / args.identities,
+        'polling_per_identity': polling_memory / args.identities,
+    }
+
+
+def report(result):
+    print('identities            {}'.format(result['identities']))
+    print('installed             {} of {} in {:.1f}s'.format(
+        result['installed'], result['deployments'], result['time_to_install']))
+    print('held back             {} staged, {} installed (must be 0)'.format(
+        result['held_staged'], result['held_installed']))
+    print('polls per identity    {:.1f} in {:.1f}s'.format(
+        result['polls_per_identity'], result['elapsed']))
+    print('artifact downloads    {:.2f}'.format(result['artifact_downloads']))
+    print('memory per identity   {:.1f} KiB idle, {:.1f} KiB polling'.format(
+        result['idle_per_identity'] / 1024,
+        result['polling_per_identity'] / 1024))
+
+
+async def main(args):
+    if not args.verbose:
+        logging.getLogger('hbloader').setLevel(logging.CRITICAL)
+
+    result = await run(args)
+
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(result, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gateway benchmark')
+    parser.add_argument('--identities', type=int, default=200,
+                        help='downstream devices served by the gateway')
+    parser.add_argument('--deployments', type=int, default=10,
+                        help='identities the shared artifact is installed on')
+    parser.add_argument('--sleep', default='00:00:05',
+                        help='polling interval the server asks for')
+    parser.add_argument('--settle', type=float, default=5,
+                        help='seconds of polling before memory is measured')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds until the installs count as failed')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show agent log')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+"""
+Cost of parsing and validating DDI responses into lib.ddi.model, for a
+base poll resource and deployments of increasing size, compared with
+decoding the JSON alone.
+
+    python3 -m bench.model [iterations]
+"""
+
+import json
+import sys
+import time
+import tracemalloc
+
+from lib.ddi.model import Base, Deployment, DeploymentCache, Link
+
+URL = 'https://device.hawkbit.local/default/controller/v1/bench'
+
+
+def base():
+    return {
+        'config': {'polling': {'sleep': '00:05:00'}},
+        '_links': {
+            'deploymentBase': {'href': URL + '/deploymentBase/42?c=-2129030598'},
+            'configData': {'href': URL + '/configData'},
+        },
+    }
+
+
+def deployment(chunks, artifacts):
+    def artifact(module, number):
+        filename = 'artifact-{}.tar'.format(number)
+        href = '{}/softwaremodules/{}/artifacts/{}'.format(URL, module,
+                                                          filename)
+        return {
+            'filename': filename,
+            'size': 1024 * 1024,
+            'hashes': {'md5': '0' * 32, 'sha1': '0' * 40, 'sha256': '0' * 64},
+            '_links': {'download': {'href': href},
+                       'download-http': {'href': href.replace('https', 'http')},
+                       'md5sum': {'href': href + '.MD5SUM'}},
+        }
+
+    return {
+        'id': '42',
+        'deployment': {
+            'download': 'forced',
+            'update': 'attempt',
+            'chunks': [{'part': 'os', 'name': 'chunk-{}'.format(c),
+                        'version': '1.0',
+                        'artifacts': [artifact(c, a)
+                                      for a in range(artifacts)]}
+                       for c in range(chunks)],
+        },
+    }
+
+
+def measure(name, body, parse, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        json.loads(body)
+    decode = (time.perf_counter() - start) / iterations
+
+    data = json.loads(body)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse(data)
+    parsed = (time.perf_counter() - start) / iterations
+
+    tracemalloc.start()
+    model = parse(data)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del model
+
+    print('{:24} {:8} {:10.1f} {:10.1f} {:10}'.format(
+        name, len(body), decode * 1e6, parsed * 1e6, size))
+
+
+def main(iterations):
+    print('{:24} {:>8} {:>10} {:>10} {:>10}'.format(
+        'response', 'bytes', 'json us', 'model us', 'model B'))
+
+    measure('base', json.dumps(base()).encode(), Base.parse, iterations)
+    for chunks, artifacts in ((1, 1), (1, 10), (10, 20)):
+        measure('deployment {}x{}'.format(chunks, artifacts),
+                json.dumps(deployment(chunks, artifacts)).encode(),
+                Deployment.parse, iterations // chunks)
+
+    cache = DeploymentCache()
+    cache.put(Deployment.parse(deployment(1, 1), '-2129030598'))
+    link = Link('42', '-2129030598')
+    start = time.perf_counter()
+    for _ in range(iterations):
+        cache.get(link)
+    print('{:24} {:8} {:10} {:10.1f}'.format(
+        'cached deployment', '', '', (time.perf_counter() - start) /
+        iterations * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+"""
+Push notification benchmark: time from assignment of a deployment until
+the agent fetches it, and the number of base polls meanwhile, with plain
+polling and with notifications over WebSocket and long-poll.
+
+    python3 -m bench.notify [--assignments 5] [--speed 10]
+
+Waits of the agent are divided by --speed (see clock_speed), so the
+polling baseline is --speed times faster than in the field.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+
+MODES = {
+    'polling': '',
+    'websocket': 'ws://device.hawkbit.local:{port}/{{tenant}}/controller/v1/{{controllerId}}/notify',
+    'longpoll': 'http://device.hawkbit.local:{port}/{{tenant}}/controller/v1/{{controllerId}}/notify',
+}
+
+
+async def run_mode(mode, assignments, speed):
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='hbnotify-')
+
+    from lib.hbclient import HBClient
+    from bench.fakeserver import FakeHawkBit, client_session, client_config
+    from bench.faults import FakeDocker, payload, final_feedback
+
+    server = FakeHawkBit()
+    server.add_target('bench')
+    port = await server.start()
+
+    config = client_config(port, auth_token='token-bench',
+                           notify_url=MODES[mode].format(port=port),
+                           progress_interval='1', gc_interval='3600')
+
+    latencies = []
+    async with client_session() as session:
+        client = HBClient(session, lambda result: None, **config)
+        client.docker_client = FakeDocker()
+        client.clock_speed = speed
+        await client.run_ddi()
+
+        start = time.monotonic()
+        polling = asyncio.ensure_future(client.start_polling(wait_on_error=1))
+        for number in range(assignments):
+            await asyncio.sleep(random.uniform(2, 6))
+            server.feedback = []
+            assigned = time.monotonic()
+            server.add_deployment('bench', number + 1, payload())
+
+            path = '/default/controller/v1/bench/deploymentBase/{}'.format(
+                number + 1)
+            while final_feedback(server) is None:
+                await asyncio.sleep(0.01)
+            fetched = min(t for t, method, p in server.requests
+                          if p == path and t >= assigned)
+            latencies.append(fetched - assigned)
+
+        elapsed = time.monotonic() - start
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+
+    await server.stop()
+
+    polls = sum(1 for t, method, p in server.requests
+                if p == '/default/controller/v1/bench' and t >= start)
+    return {
+        'mode': mode,
+        'median': statistics.median(latencies),
+        'max': max(latencies),
+        'polls': polls,
+        'elapsed': elapsed,
+    }
+
+
+async def main(args):
+    if not args.verbose:
+        logging.getLogger('hbloader').setLevel(logging.CRITICAL)
+
+    print('{:10} {:>10} {:>10} {:>8} {:>9}'.format(
+        'mode', 'median', 'max', 'polls', 'total'))
+    for mode in MODES:
+        # the agent prints install steps to stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = await run_mode(mode, args.assignments, args.speed)
+        print('{:10} {:9.3f}s {:9.3f}s {:8} {:8.1f}s'.format(
+            result['mode'], result['median'], result['max'],
+            result['polls'], result['elapsed']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Push notification benchmark')
+    parser.add_argument('--assignments', type=int, default=5,
+                        help='deployments assigned per mode')
+    parser.add_argument('--speed', type=float, default=10,
+                        help='speed-up of the agent\'s waits')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show agent log')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+"""
+Priority benchmark: how much a deployment of a large compressed artifact
+slows down a CPU bound workload on all cores, with the agent's workers
+in the default, the lowest and no scheduling class (see priority_*
+settings).
+
+    python3 -m bench.priority [--size 64]
+
+The workload stands in for the production containers; its throughput
+while the agent downloads, decompresses and hashes is reported relative
+to its throughput alone, together with the agent's deployment time.
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    'off': {'priority_nice': '0', 'priority_ionice': ''},
+    'default': {'priority_nice': '10', 'priority_ionice': 'best-effort'},
+    'idle': {'priority_nice': '19', 'priority_ionice': 'idle'},
+}
+
+
+def workload(counter, stop):
+    block = os.urandom(64 * 1024)
+    while not stop.is_set():
+        for _ in range(16):
+            hashlib.sha256(block).digest()
+        with counter.get_lock():
+            counter.value += 1
+
+
+def payload(size):
+    '''
+    gzip compressed manifest of about size MB, half compressible
+    '''
+    manifest = {
+        'imageUri': 'bench/app:1',
+        'containerCreateOptions': {'HostConfig': {'PortBindings': {}}},
+        'padding': os.urandom(size * 1024 * 1024 // 4).hex() + 'x' * (
+            size * 1024 * 1024 // 2),
+    }
+    return gzip.compress(json.dumps(manifest).encode(), compresslevel=1)
+
+
+async def child(mode, size):
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='hbpriority-')
+
+    from lib import priority
+    priority.apply(**MODES[mode])
+
+    from lib.hbclient import HBClient
+    from bench.fakeserver import FakeHawkBit, client_session, client_config
+    from bench.faults import FakeDocker, final_feedback
+
+    server = FakeHawkBit(sleep='00:00:01')
+    server.add_target('bench')
+    port = await server.start()
+    server.add_deployment('bench', 1, payload(size),
+                          filename='manifest.json.gz')
+
+    config = client_config(port, auth_token='token-bench',
+                           progress_interval='1', gc_interval='3600',
+                           **MODES[mode])
+    async with client_session() as session:
+        client = HBClient(session, lambda result: None, **config)
+        client.docker_client = FakeDocker()
+        await client.run_ddi()
+
+        start = time.monotonic()
+        polling = asyncio.ensure_future(client.start_polling(wait_on_error=1))
+        while final_feedback(server) is None:
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - start
+
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+    await server.stop()
+
+    print(json.dumps({'elapsed': elapsed, 'result': final_feedback(server)}))
+
+
+def run(args):
+    workers = os.cpu_count()
+    counter = multiprocessing.Value('L', 0)
+    stop = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=workload, args=(counter, stop))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    def rate(seconds):
+        before = counter.value
+        time.sleep(seconds)
+        return (counter.value - before) / seconds
+
+    try:
+        time.sleep(1)
+        alone = rate(3)
+
+        print('{} workload processes, {:.0f} blocks/s alone'.format(
+            workers, alone))
+        print('{:8} {:>10} {:>10}'.format('class', 'deploy', 'workload'))
+        for mode in MODES:
+            before = counter.value
+            start = time.monotonic()
+            out = subprocess_output(mode, args.size)
+            during = (counter.value - before) / (time.monotonic() - start)
+            result = json.loads(out.splitlines()[-1])
+            print('{:8} {:9.2f}s {:9.1f}%'.format(
+                mode, result['elapsed'], during * 100 / alone))
+    finally:
+        stop.set()
+        for process in processes:
+            process.join()
+
+
+def subprocess_output(mode, size):
+    import subprocess
+    return subprocess.run(
+        [sys.executable, '-m', 'bench.priority', '--child', mode,
+         '--size', str(size)],
+        cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT),
+        stdout=subprocess.PIPE, check=True).stdout.decode()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Priority benchmark')
+    parser.add_argument('--size', type=int, default=64,
+                        help='artifact size in MB (decompressed)')
+    parser.add_argument('--child', choices=list(MODES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        asyncio.get_event_loop().run_until_complete(child(args.child, args.size))
+    else:
+        run(args)
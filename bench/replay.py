@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+"""
+Replays a recorded trace (see trace_record in hblcfg.json) through the
+agent without a server, optionally faster and under cProfile.
+
+    python3 -m bench.replay trace.jsonl.gz [--speed 10] [--profile out.prof]
+
+Docker is replaced by a client answering without a daemon, so only the
+agent's own behaviour is replayed.
+"""
+
+import argparse
+import asyncio
+import cProfile
+import logging
+import os
+import pstats
+import re
+import tempfile
+import time
+
+
+def target_of(session):
+    '''
+    Tenant and controller id of the first DDI request in the trace
+    '''
+    for key in session.entries:
+        match = re.search(r' /([^/]+)/controller/v1/([^/?]+)', key)
+        if match:
+            return match.groups()
+    raise SystemExit('No DDI requests in trace')
+
+
+async def replay(args):
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='hbreplay-')
+
+    from lib.hbclient import HBClient
+    from lib.trace import ReplaySession
+    from bench.fakeserver import client_config
+    from bench.faults import FakeDocker
+
+    session = ReplaySession(args.trace, speed=args.speed)
+    tenant, controller_id = target_of(session)
+
+    config = client_config(0, controller_id=controller_id,
+                           tenant_id=tenant, auth_token='replay')
+    client = HBClient(session, lambda result: None, **config)
+    client.docker_client = FakeDocker()
+    client.clock_speed = args.speed or 1000
+    await client.run_ddi()
+
+    start = time.monotonic()
+    polling = asyncio.ensure_future(client.start_polling())
+    try:
+        await asyncio.wait_for(session.ended.wait(), args.timeout)
+        # let the agent process the last responses
+        await asyncio.sleep(0.5)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.monotonic() - start
+
+    polling.cancel()
+    await asyncio.gather(polling, return_exceptions=True)
+
+    print('{} requests left in trace, {} requests not in trace, {:.2f}s'.format(
+        session.remaining, len(session.missing), elapsed))
+    for key in sorted(set(session.missing))[:10]:
+        print('  not in trace: {}'.format(key))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded traffic')
+    parser.add_argument('trace', help='trace file written by trace_record')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='speed-up of recorded timings, 0 for no waits')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds until the replay is stopped')
+    parser.add_argument('--profile', help='write cProfile stats to this file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show agent log')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.CRITICAL)
+
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+
+    asyncio.get_event_loop().run_until_complete(replay(args))
+
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+
+
+if __name__ == '__main__':
+    main()
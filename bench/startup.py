@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+"""
+Startup benchmark: import time of the agent and time from process start
+to the first base poll, against a local fake HawkBit.
+
+    python3 -m bench.startup [runs]
+"""
+
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def child(spawned, port, auth_token):
+    start = time.perf_counter()
+    from lib.hbclient import HBClient
+    imported = time.perf_counter() - start
+
+    from bench.fakeserver import client_session, client_config
+
+    config = client_config(port, auth_token=auth_token)
+    async with client_session() as session:
+        client = HBClient(session, lambda result: None, **config)
+        await client.run_ddi()
+        await client.ddi()
+        first_poll = time.time() - spawned
+
+    print(json.dumps({'import': imported, 'first_poll': first_poll}))
+
+
+async def run(runs):
+    from bench.fakeserver import FakeHawkBit
+
+    server = FakeHawkBit()
+    server.add_target('bench')
+    port = await server.start()
+
+    results = {}
+    home = tempfile.mkdtemp()
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+
+    # cold: target looked up via MI, warm: security token configured
+    for mode, token in (('cold', ''), ('warm', 'token-bench')):
+        samples = []
+        for _ in range(runs):
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'bench.startup', '--child',
+                str(time.time()), str(port), token,
+                cwd=ROOT, env=env, stdout=asyncio.subprocess.PIPE)
+            out, _ = await proc.communicate()
+            samples.append(json.loads(out.decode().splitlines()[-1]))
+        results[mode] = samples
+
+    await server.stop()
+
+    for mode, samples in results.items():
+        for key in ('import', 'first_poll'):
+            values = [sample[key] for sample in samples]
+            print('{:5} {:10} median {:7.1f} ms  min {:7.1f} ms  max {:7.1f} ms'.format(
+                mode, key, statistics.median(values) * 1000,
+                min(values) * 1000, max(values) * 1000))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        spawned, port, token = sys.argv[2:5] + [''] * (5 - len(sys.argv))
+        asyncio.get_event_loop().run_until_complete(
+            child(float(spawned), port, token))
+    else:
+        runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+        asyncio.get_event_loop().run_until_complete(run(runs))
@@ -1,6 +1,7 @@
 #! /usr/bin/env python3
 
 import sys
+import signal
 import asyncio
 import aiohttp
 import json
@@ -9,6 +10,10 @@ import pathlib
 from getpass import getpass
 
 from lib.hbclient import HBClient
+from lib.profiling import Profiler
+from lib.watchdog import LoopMonitor
+from lib.logsetup import LogPipeline
+from lib import priority
 from lib.ddi.client import DDIClient
 from lib.ddi.client import (ConfigStatusExecution, ConfigStatusResult)
 
@@ -27,17 +32,79 @@ async def main():
 
     config = load_config()
 
-    logfmt= '%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d-%(funcName)s] %(message)s'
-    datefmt= '%Y-%m-%d %H:%M:%S'
+    logs = LogPipeline(config.get('loglevel', 'INFO'),
+                       ring_size=int(config.get('log_ring_size', 1000)),
+                       ring_level=config.get('log_ring_level', 'DEBUG'),
+                       logfile=config.get('logfile') or None).start()
 
-    logging.basicConfig(level=logging.DEBUG, format=logfmt, datefmt=datefmt)
+    # hashing, block matching and installers yield to the device's
+    # workloads, the event loop keeps polling at normal priority
+    priority.apply(**config)
+
+    # SIGHUP writes buffered debug records
+    asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, logs.flush_ring)
+
+    profiler = Profiler(
+            pathlib.Path.home().joinpath('.hbloader/profile'),
+            seconds=int(config.get('profile_seconds', 30)),
+            max_files=int(config.get('profile_max_files', 20)))
+    profiler.install()
+
+    monitor = None
+    threshold = int(config.get('loop_lag_threshold', 250))
+    if threshold:
+        monitor = LoopMonitor(threshold / 1000).start()
 
     async with aiohttp.ClientSession() as session:
-        client = HBClient(session, result_callback, step_callback, **config)
+        trace = None
+        if config.get('trace_record'):
+            from lib.trace import RecordingSession
+            session = trace = RecordingSession(session, config['trace_record'])
+
+        if config.get('gateway_identities'):
+            client = await start_gateway(session, config)
+        else:
+            client = HBClient(session, result_callback, step_callback, **config)
+
+            await client.run_ddi()
+
+            # next start skips target lookup in MI
+            if client.config['auth_token'] != config.get('auth_token'):
+                config['auth_token'] = client.config['auth_token']
+                save_config(config)
+
+        try:
+            await client.start_polling()
+        finally:
+            profiler.close()
+            if monitor:
+                monitor.stop()
+            if trace:
+                trace.close()
+            logs.stop()
+
+async def start_gateway(session, config):
+    '''
+    Gateway for the identities listed in gateway_identities,
+    unknown identities are registered first.
+
+    The gateway serves the metrics endpoint, but neither push
+    notifications (notify_url) nor the metrics snapshot file.
+    '''
+    from lib.gateway import Gateway
+    from lib.mi.client import MIClient
 
-        await client.run_ddi()
+    if config.get('notify_url'):
+        logging.getLogger('hbloader').warning(
+                'notify_url is not supported in gateway mode, polling only')
 
-        await client.start_polling()
+    gateway = Gateway.from_file(session, config['gateway_identities'],
+                                **config)
+    failed = await gateway.register(MIClient(session, **config))
+    if failed:
+        logging.getLogger('hbloader').warning(
+                '%s identities could not be registered', failed)
+    return gateway
 
 def ask_parameters(config):
     '''
@@ -153,9 +220,42 @@ def load_config():
     "password" : "admin",
     "auth_token" : "",
     "attributes" : {"MAC": ""},
-    "loglevel" : "DEBUG",
+    "loglevel" : "INFO",
     "run_as_service" : "yes",
-    "port" :  "443"
+    "port" :  "443",
+    "gc_keep_images" : "3",
+    "gc_bundle_budget_mb" : "256",
+    "gc_interval" : "3600",
+    "progress_interval" : "10",
+    "progress_step" : "5",
+    "outbox_batch" : "10",
+    "outbox_max_delay" : "300",
+    "max_actions" : "2",
+    "metrics_port" : "",
+    "metrics_interval" : "60",
+    "profile_seconds" : "30",
+    "profile_max_files" : "20",
+    "loop_lag_threshold" : "250",
+    "log_ring_size" : "1000",
+    "log_ring_level" : "DEBUG",
+    "logfile" : "",
+    "json_codec" : "auto",
+    "install_window" : "",
+    "install_timeout" : "600",
+    "decompress_artifacts" : "yes",
+    "decompress_max_ratio" : "20",
+    "trace_record" : "",
+    "gateway_identities" : "",
+    "gateway_install" : [],
+    "gateway_concurrency" : "8",
+    "notify_url" : "",
+    "notify_poll_interval" : "300",
+    "preflight" : "yes",
+    "preflight_reserve_mb" : "100",
+    "preflight_min_memory_mb" : "64",
+    "priority_nice" : "10",
+    "priority_ionice" : "best-effort",
+    "priority_cgroup" : ""
     }
 
     ''' 
@@ -176,12 +276,16 @@ def load_config():
 
     ask_parameters(config)
 
-    with open(HBLCFG, "w") as config_file:
-            json.dump(config, config_file, indent=4)
+    save_config(config)
 
     return config
 
 
+def save_config(config):
+    with open(HBLCFG, "w") as config_file:
+            json.dump(config, config_file, indent=4)
+
+
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     loop.run_until_complete(main())
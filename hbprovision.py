@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+'''
+Bulk registration of targets on the HawkBit server.
+
+Reads controller ids and names from a CSV file (columns controllerId and
+name) or a JSON list, registers them with the Management API and writes
+the security tokens needed for device imaging.
+
+    python3 hbprovision.py targets.csv -o tokens.csv
+'''
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import pathlib
+import sys
+
+import aiohttp
+
+from lib.mi.client import MIClient
+from lib.mi.bulk import register_targets
+
+HBLCFG = 'hblcfg.json'
+
+
+def read_targets(path):
+    '''
+    List of dicts with controllerId and name
+    '''
+    path = pathlib.Path(path)
+
+    with path.open('r', newline='') as targets_file:
+        if path.suffix == '.json':
+            items = json.load(targets_file)
+        else:
+            items = list(csv.DictReader(targets_file))
+
+    targets = []
+    for item in items:
+        if isinstance(item, str):
+            item = {'controllerId': item}
+        controller_id = item['controllerId'].strip()
+        if controller_id:
+            targets.append({'controllerId': controller_id,
+                            'name': item.get('name') or controller_id})
+    return targets
+
+
+def write_tokens(path, targets, registered):
+    with open(path, 'w', newline='') as tokens_file:
+        writer = csv.writer(tokens_file)
+        writer.writerow(['controllerId', 'name', 'securityToken'])
+        for target in targets:
+            found = registered.get(target['controllerId'])
+            if found:
+                writer.writerow([found['controllerId'], found.get('name', ''),
+                                 found.get('securityToken', '')])
+
+
+async def main(args):
+    with open(args.config, 'r') as config_file:
+        config = json.load(config_file)
+
+    targets = read_targets(args.targets)
+    print('{} targets to register'.format(len(targets)))
+
+    async with aiohttp.ClientSession() as session:
+        mi = MIClient(session, **config)
+        registered, failed = await register_targets(
+                mi, targets,
+                batch_size=args.batch,
+                concurrency=args.concurrency,
+                retries=args.retries)
+
+    write_tokens(args.output, targets, registered)
+    print('{} registered, {} failed, tokens written to {}'.format(
+        len(registered), len(failed), args.output))
+
+    for target in failed:
+        print('failed: {}'.format(target['controllerId']))
+
+    return 1 if failed else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('targets', help='CSV or JSON file of targets')
+    parser.add_argument('-o', '--output', default='tokens.csv',
+                        help='CSV file for security tokens')
+    parser.add_argument('-c', '--config', default=HBLCFG,
+                        help='server configuration (default hblcfg.json)')
+    parser.add_argument('--batch', type=int, default=100,
+                        help='targets per request (at most 500)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='requests in flight')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='retries of a failed batch')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(main(parse_args())))
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+'''
+Live rollout status of many targets on the HawkBit server.
+
+Lists targets matching an optional FIQL filter, looks up their latest
+actions with a bounded number of concurrent requests and prints counts
+per phase and the slowest devices.
+
+    python3 hbstatus.py -q 'assignedDS.name==app' --refresh 15
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+import aiohttp
+
+from lib.mi.client import MIClient
+from lib.mi.fleet import FleetStatus
+
+HBLCFG = 'hblcfg.json'
+
+ORDER = ('waiting', 'downloading', 'downloaded', 'installing', 'done',
+         'failed', 'canceled', 'idle')
+
+
+def render(fleet, top, elapsed, updated):
+    summary = fleet.summary()
+    total = sum(summary.values())
+    lines = ['{} targets, {} refreshed, {} requests in {:.1f}s'.format(
+        total, updated, fleet.requests, elapsed), '']
+
+    for phase in ORDER:
+        if summary.get(phase):
+            lines.append('  {:12} {:7} {:5.1f}%'.format(
+                phase, summary[phase], 100.0 * summary[phase] / total))
+
+    slowest = fleet.slowest(top)
+    if slowest:
+        lines += ['', 'Slowest:']
+        for seconds, state in slowest:
+            lines.append('  {:32} {:12} {:8.0f}s  {}'.format(
+                state.controller_id, state.phase, seconds, state.message))
+
+    failed = fleet.failed()
+    if failed:
+        lines += ['', 'Failed:']
+        for state in failed[:top]:
+            lines.append('  {:32} {}'.format(state.controller_id,
+                                             state.message))
+        if len(failed) > top:
+            lines.append('  ... {} more'.format(len(failed) - top))
+
+    return '\n'.join(lines)
+
+
+async def main(args):
+    with open(args.config, 'r') as config_file:
+        config = json.load(config_file)
+
+    async with aiohttp.ClientSession() as session:
+        mi = MIClient(session, **config)
+        fleet = FleetStatus(mi, args.q, concurrency=args.concurrency)
+
+        while True:
+            start = time.monotonic()
+            updated = await fleet.refresh()
+            output = render(fleet, args.top, time.monotonic() - start,
+                            updated)
+
+            if not args.refresh:
+                print(output)
+                return 0
+
+            # clear screen and redraw
+            print('\033[2J\033[H' + time.strftime('%H:%M:%S ') + output,
+                  flush=True)
+            await asyncio.sleep(args.refresh)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-q', help='FIQL filter for targets')
+    parser.add_argument('-c', '--config', default=HBLCFG,
+                        help='server configuration (default hblcfg.json)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='requests in flight')
+    parser.add_argument('--refresh', type=int, default=0,
+                        help='seconds between refreshes, 0 to print once')
+    parser.add_argument('--top', type=int, default=10,
+                        help='slowest and failed targets shown')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    try:
+        sys.exit(loop.run_until_complete(main(parse_args())))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import json
+import logging
+from pathlib import Path
+
+
+class GarbageCollector(object):
+    """
+    Background cleanup of old docker images, stopped containers and
+    downloaded files in the bundle directory.
+
+    The last ``keep_images`` known-good images of every service are kept
+    so a deployment can be rolled back.
+    """
+
+    STATE_FILE = '.gc_state.json'
+
+    def __init__(self, dl_dir, keep_images=3, bundle_budget=256 * 1024 * 1024,
+                 interval=3600, report_callback=None, docker_client=None):
+        self.logger = logging.getLogger('hbloader')
+        self.dl_dir = Path(dl_dir)
+        self.keep_images = keep_images
+        self.bundle_budget = bundle_budget
+        self.interval = interval
+        self.report_callback = report_callback
+        self.docker_client = docker_client
+        self.state_file = self.dl_dir.joinpath(self.STATE_FILE)
+        self.known_good = self.load_state()
+        # file name -> number of users, e.g. an install and a delta download
+        self.protected = collections.Counter()
+        self.trigger = asyncio.Event()
+
+    def load_state(self):
+        '''
+        Load per service list of known-good images
+        '''
+        if not self.state_file.exists():
+            return {}
+
+        try:
+            with self.state_file.open('r') as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            self.logger.warning('GC state file unreadable, starting empty')
+            return {}
+
+    def save_state(self):
+        tmp = self.state_file.with_suffix('.tmp')
+        with tmp.open('w') as state_file:
+            json.dump(self.known_good, state_file, indent=4)
+        tmp.replace(self.state_file)
+
+    @staticmethod
+    def service_name(image):
+        '''
+        Image reference without tag or digest, e.g.
+        registry:5000/app:1.2 -> registry:5000/app
+        '''
+        name = image.split('@')[0]
+        head, _, tail = name.rpartition('/')
+        if ':' in tail:
+            tail = tail.split(':')[0]
+        return '{}/{}'.format(head, tail) if head else tail
+
+    def mark_good(self, image):
+        '''
+        Remember image as successfully deployed and schedule a run.
+        '''
+        service = self.service_name(image)
+        images = [i for i in self.known_good.get(service, []) if i != image]
+        images.append(image)
+        self.known_good[service] = images
+        self.save_state()
+        self.trigger.set()
+
+    def snapshot(self):
+        '''
+        Copy of the known-good images for a worker thread
+        '''
+        return {service: list(images)
+                for service, images in self.known_good.items()}
+
+    def forget(self, removed):
+        '''
+        Drop images removed by a worker thread from the known-good lists.
+        '''
+        if not removed:
+            return
+        for service in list(self.known_good):
+            self.known_good[service] = [i for i in self.known_good[service]
+                                        if i not in removed]
+        self.save_state()
+
+    def protect(self, path):
+        '''
+        Never remove this bundle file (e.g. artifact being installed)
+        '''
+        self.protected[Path(path).name] += 1
+
+    def release(self, path):
+        name = Path(path).name
+        self.protected[name] -= 1
+        if self.protected[name] <= 0:
+            del self.protected[name]
+
+    async def start(self):
+        """
+        Run collection after every deployment and every ``interval`` seconds.
+        """
+        self.logger.info('GC started, interval {}s'.format(self.interval))
+
+        while True:
+            try:
+                await asyncio.wait_for(self.trigger.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.trigger.clear()
+
+            try:
+                await self.collect()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.logger.exception('GC run failed')
+
+    async def collect(self):
+        """
+        Run one collection in a worker thread and report reclaimed bytes.
+        """
+        loop = asyncio.get_event_loop()
+        reclaimed, removed = await loop.run_in_executor(
+                None, self.collect_sync, self.snapshot())
+        self.forget(removed)
+
+        self.logger.info('GC reclaimed {} bytes'.format(sum(reclaimed.values())))
+
+        if self.report_callback and any(reclaimed.values()):
+            await self.report_callback(reclaimed)
+
+        return reclaimed
+
+    def collect_sync(self, known_good):
+        reclaimed = {
+            'containers': 0,
+            'images': 0,
+            'bundle': 0,
+        }
+        removed = []
+
+        try:
+            reclaimed['containers'], reclaimed['images'], removed = \
+                self.prune_docker(known_good, self.keep_images)
+        except Exception as e:
+            self.logger.warning('Docker prune failed: {}'.format(e))
+
+        reclaimed['bundle'] = self.trim_bundle()
+
+        return reclaimed, removed
+
+    async def make_room(self, bundle=0, docker=False):
+        '''
+        Evict more than a regular run for a deployment which does not fit:
+        at least bundle bytes of bundle files, and with docker all images
+        but the newest known-good one of each service.
+        '''
+        loop = asyncio.get_event_loop()
+        reclaimed, removed = await loop.run_in_executor(
+                None, self.make_room_sync, self.snapshot(), bundle, docker)
+        self.forget(removed)
+
+        self.logger.info('GC made room: {} bytes'.format(
+            sum(reclaimed.values())))
+        if self.report_callback and any(reclaimed.values()):
+            await self.report_callback(reclaimed)
+
+        return reclaimed
+
+    def make_room_sync(self, known_good, bundle, docker):
+        reclaimed = {
+            'containers': 0,
+            'images': 0,
+            'bundle': 0,
+        }
+        removed = []
+
+        if docker:
+            try:
+                reclaimed['containers'], reclaimed['images'], removed = \
+                    self.prune_docker(known_good, keep_images=1)
+            except Exception as e:
+                self.logger.warning('Docker prune failed: {}'.format(e))
+
+        if bundle:
+            reclaimed['bundle'] = self.trim_bundle(reclaim=bundle)
+
+        return reclaimed, removed
+
+    def prune_docker(self, known_good, keep_images):
+        '''
+        Remove stopped containers, images of known_good beyond the newest
+        keep_images per service and dangling layers.
+
+        Runs in a worker thread, known_good is a snapshot and left as is.
+
+        Returns:
+            Reclaimed bytes of containers and images, removed images
+        '''
+        import docker
+        from docker.errors import APIError as DockerAPIError
+
+        if self.docker_client is not None:
+            client = self.docker_client()
+        else:
+            client = docker.from_env()
+
+        result = client.containers.prune()
+        containers = result.get('SpaceReclaimed') or 0
+
+        in_use = set()
+        for container in client.containers.list():
+            in_use.update(container.image.tags)
+
+        images = 0
+        removed = []
+        for known in known_good.values():
+            keep = known[-keep_images:] if keep_images > 0 else []
+            for image in known[:-len(keep) or None]:
+                if image in in_use:
+                    continue
+                try:
+                    size = client.images.get(image).attrs.get('Size', 0)
+                    client.images.remove(image)
+                    images += size
+                    removed.append(image)
+                    self.logger.info('GC removed image {}'.format(image))
+                except DockerAPIError as e:
+                    self.logger.warning('GC cannot remove {}: {}'.format(image, e))
+                    continue
+
+        result = client.images.prune(filters={'dangling': True})
+        images += result.get('SpaceReclaimed') or 0
+
+        return containers, images, removed
+
+    def trim_bundle(self, reclaim=0):
+        '''
+        Delete oldest files in bundle directory until it fits the budget,
+        and at least reclaim bytes are deleted.
+        '''
+        files = [p for p in self.dl_dir.iterdir()
+                 if p.is_file() and p.name != self.STATE_FILE
+                 and p.name not in self.protected]
+        files.sort(key=lambda p: p.stat().st_mtime)
+
+        total = sum(p.stat().st_size for p in files)
+        budget = min(self.bundle_budget, max(total - reclaim, 0))
+        reclaimed = 0
+
+        for p in files:
+            if total <= budget:
+                break
+            size = p.stat().st_size
+            try:
+                p.unlink()
+            except OSError as e:
+                self.logger.warning('GC cannot remove {}: {}'.format(p, e))
+                continue
+            self.logger.debug('GC removed {}'.format(p))
+            total -= size
+            reclaimed += size
+
+        return reclaimed
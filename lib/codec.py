@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import time
+
+from .metrics import REGISTRY
+
+# compressed responses are requested and decoded by aiohttp, the raw
+# size is only known from Content-Length: size="decoded" marks chunked
+# compressed responses counted with their decoded size
+WIRE_BYTES = REGISTRY.counter(
+    'hbloader_wire_bytes_total',
+    'JSON bytes on the wire (compressed size if the server compressed)',
+    ('api', 'direction', 'encoding', 'size'))
+
+BODY_BYTES = REGISTRY.counter(
+    'hbloader_body_bytes_total',
+    'Decoded JSON body bytes',
+    ('api', 'direction'))
+
+PARSE_DURATION = REGISTRY.histogram(
+    'hbloader_json_parse_seconds',
+    'Time spent decoding JSON responses',
+    ('api', 'codec'),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+
+
+class JSONCodec(object):
+    """
+    Encodes and decodes JSON bodies with the fastest available library.
+    """
+    __slots__ = ('name', 'loads', 'encode')
+
+    def __init__(self, name, loads, encode):
+        self.name = name
+        self.loads = loads
+        self.encode = encode
+
+    def dumps(self, data):
+        '''
+        Encode data as UTF-8 JSON bytes
+        '''
+        return self.encode(data)
+
+    async def read(self, resp, api):
+        '''
+        Read and decode JSON response, account bytes and parse time.
+        '''
+        body = await resp.read()
+        if not body:
+            return None
+
+        encoding = resp.headers.get('Content-Encoding', 'identity')
+        if resp.content_length is not None:
+            WIRE_BYTES.inc(resp.content_length, api=api, direction='in',
+                           encoding=encoding, size='wire')
+        else:
+            WIRE_BYTES.inc(len(body), api=api, direction='in',
+                           encoding=encoding,
+                           size='wire' if encoding == 'identity' else 'decoded')
+        BODY_BYTES.inc(len(body), api=api, direction='in')
+
+        start = time.perf_counter()
+        data = self.loads(body)
+        PARSE_DURATION.observe(time.perf_counter() - start,
+                               api=api, codec=self.name)
+        return data
+
+    def write(self, data, api):
+        '''
+        Encode request body and account its bytes.
+        '''
+        body = self.dumps(data)
+        WIRE_BYTES.inc(len(body), api=api, direction='out',
+                       encoding='identity', size='wire')
+        BODY_BYTES.inc(len(body), api=api, direction='out')
+        return body
+
+
+def stdlib_codec():
+    return JSONCodec('json', json.loads,
+                     lambda data: json.dumps(data).encode('utf-8'))
+
+
+def orjson_codec():
+    import orjson
+    return JSONCodec('orjson', orjson.loads, orjson.dumps)
+
+
+def ujson_codec():
+    import ujson
+    return JSONCodec('ujson', ujson.loads,
+                     lambda data: ujson.dumps(data).encode('utf-8'))
+
+
+CODECS = {
+    'json': stdlib_codec,
+    'orjson': orjson_codec,
+    'ujson': ujson_codec,
+}
+
+
+def get_codec(name='auto'):
+    '''
+    Codec by name, 'auto' picks orjson or ujson if installed
+    and falls back to the standard library.
+    '''
+    if name != 'auto':
+        try:
+            return CODECS[name]()
+        except (ImportError, KeyError):
+            logging.getLogger('hbloader').warning(
+                'JSON codec %s not available, using json', name)
+            return stdlib_codec()
+
+    for candidate in ('orjson', 'ujson'):
+        try:
+            return CODECS[candidate]()
+        except ImportError:
+            continue
+
+    return stdlib_codec()
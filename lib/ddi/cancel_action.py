@@ -3,6 +3,8 @@
 from datetime import datetime
 from enum import Enum
 
+from .resource import ResourceCache
+
 
 # status of the action execution
 CancelStatusExecution = Enum('CancelStatusExecution',
@@ -19,9 +21,12 @@ class Action(object):
     Represents /{tenant}/controller/v1/{targetid}/cancelAction/{actionId} in
     HawkBit's DDI API.
     """
+    __slots__ = ('ddi', 'action_id', 'key')
+
     def __init__(self, ddi, action_id):
         self.ddi = ddi
         self.action_id = action_id
+        self.key = 'cancelAction/{}'.format(action_id)
 
     async def __call__(self):
         """
@@ -56,8 +61,11 @@ class Action(object):
             }
         }
 
-        return await self.ddi.post_resource(
-            '/{tenant}/controller/v1/{controllerId}/cancelAction/{actionId}/feedback', post_data, actionId=self.action_id)
+        return await self.ddi.queue_resource(
+            'POST', '/{tenant}/controller/v1/{controllerId}/cancelAction/{actionId}/feedback', post_data,
+            key=self.key,
+            final=status_execution != CancelStatusExecution.proceeding,
+            actionId=self.action_id)
 
 
 class CancelAction(object):
@@ -65,9 +73,11 @@ class CancelAction(object):
     Represents /{tenant}/controller/v1/{targetid}/cancelAction in HawkBit's DDI
     API.
     """
+    __slots__ = ('ddi', 'actions')
+
     def __init__(self, ddi):
         self.ddi = ddi
+        self.actions = ResourceCache(lambda action_id: Action(ddi, action_id))
 
     def __getitem__(self, key):
-        action_id = key
-        return Action(self.ddi, action_id)
+        return self.actions[key]
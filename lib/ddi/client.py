@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
-import json
 import hashlib
 import logging
+import time
 
 from aiohttp.client import ClientTimeout
 from datetime import datetime
@@ -11,6 +11,9 @@ from enum import Enum
 from .deployment_base import DeploymentBase
 from .softwaremodules import SoftwareModules
 from .cancel_action import CancelAction
+from ..metrics import (
+    HTTP_REQUESTS, HTTP_DURATION, DOWNLOAD_BYTES, PHASE_DURATION)
+from ..codec import get_codec
 
 # status of the action execution
 ConfigStatusExecution = Enum('ConfigStatusExecution',
@@ -23,7 +26,9 @@ ConfigStatusResult = Enum('ConfigStatusResultFinished',
 
 
 class APIError(Exception):
-    pass
+    def __init__(self, message, status=None):
+        super(APIError, self).__init__(message)
+        self.status = status
 
 
 class DDIClient(object):
@@ -42,16 +47,30 @@ class DDIClient(object):
         429: 'Too many requests.'
     }
 
-    def __init__(self, session, timeout=10, **kwargs):
+    # API paths used by the client and its resources, compiled per client
+    routes = (
+        '/{tenant}/controller/v1/{controllerId}',
+        '/{tenant}/controller/v1/{controllerId}/configData',
+        '/{tenant}/controller/v1/{controllerId}/deploymentBase/{actionId}',
+        '/{tenant}/controller/v1/{controllerId}/deploymentBase/{actionId}/feedback',
+        '/{tenant}/controller/v1/{controllerId}/cancelAction/{actionId}',
+        '/{tenant}/controller/v1/{controllerId}/cancelAction/{actionId}/feedback',
+        '/{tenant}/controller/v1/{controllerId}/softwaremodules/{moduleId}/artifacts',
+        '/{tenant}/controller/v1/{controllerId}/softwaremodules/{moduleId}/artifacts/{filename}',
+    )
+
+    def __init__(self, session, timeout=10, outbox=None, **kwargs):
         self.logger = logging.getLogger('hbloader')
         self.session = session
+        self.outbox = outbox
         self.host = '{}:{}'.format(kwargs['ip'],kwargs['port'])
         self.ssl = kwargs['ssl']
-        self.headers = {'Authorization': 'TargetToken {}'.format(kwargs['auth_token'])}
-        self.logger.debug('Headers:  '.format(self.headers))
+        self.set_auth_token(kwargs['auth_token'])
         self.tenant = kwargs['tenant_id']
         self.controller_id = kwargs['controller_id']
         self.timeout = timeout
+        self.client_timeout = ClientTimeout(timeout)
+        self.codec = get_codec(kwargs.get('json_codec', 'auto'))
         # URL parts which get replaced lateron
         self.placeholders = ['tenant', 'target', 'softwaremodule', 'action',
                              'filename']
@@ -59,20 +78,39 @@ class DDIClient(object):
             '/MD5SUM': '.MD5SUM'
         }
 
-    @property
-    def cancelAction(self):
-        self.logger.info('')
-        return CancelAction(self)
-
-    @property
-    def softwaremodules(self):
-        self.logger.info('')
-        return SoftwareModules(self)
-
-    @property
-    def deploymentBase(self):
-        self.logger.info('')
-        return DeploymentBase(self)
+        self.route_table = {}
+        for api_path in self.routes:
+            self.compile_route(api_path)
+
+        self.cancelAction = CancelAction(self)
+        self.softwaremodules = SoftwareModules(self)
+        self.deploymentBase = DeploymentBase(self)
+
+    def set_auth_token(self, auth_token):
+        self.headers = {'Authorization': 'TargetToken {}'.format(auth_token)}
+        self.get_headers = {'Accept': 'application/json', **self.headers}
+        self.post_headers = {'Content-Type': 'application/json',
+                             'Accept': 'application/json', **self.headers}
+        self.put_headers = {'Content-Type': 'application/json', **self.headers}
+
+    def compile_route(self, api_path):
+        '''
+        Expand protocol, host, tenant and controller id of api_path once.
+        Returns the URL template and whether it still has placeholders.
+        '''
+        url = self.build_api_url(
+                api_path.replace('{tenant}', self.tenant)
+                        .replace('{controllerId}', self.controller_id))
+        route = self.route_table[api_path] = (url, '{' in url)
+        return route
+
+    def url(self, api_path, **kwargs):
+        '''
+        Full URL of api_path with remaining placeholders from kwargs
+        '''
+        route = self.route_table.get(api_path) or self.compile_route(api_path)
+        url, has_placeholders = route
+        return url.format(**kwargs) if has_placeholders else url
 
     async def __call__(self):
         """
@@ -82,7 +120,6 @@ class DDIClient(object):
 
         Returns: JSON data
         """
-        self.logger.info('')
         return await self.get_resource('/{tenant}/controller/v1/{controllerId}')
 
     async def configData(self, status_execution, status_result, action_id='',
@@ -102,7 +139,6 @@ class DDIClient(object):
            status_details((tuple, list)): List of details to provide
            other: passed as custom configuration data (key/value)
         """
-        self.logger.info('')
         assert isinstance(action_id, str), 'id must be string'
         assert isinstance(status_result, ConfigStatusResult), \
             'status_result_finished must be ConfigStatusResult enum'
@@ -127,7 +163,9 @@ class DDIClient(object):
             'data': kwdata
         }
 
-        await self.put_resource('/{tenant}/controller/v1/{controllerId}/configData', put_data)
+        await self.queue_resource(
+            'PUT', '/{tenant}/controller/v1/{controllerId}/configData', put_data,
+            key='configData')
 
 
     def build_api_url(self, api_path):
@@ -140,8 +178,6 @@ class DDIClient(object):
         Returns:
             Expanded API URL with protocol (http/https) and host prepended
         """
-        self.logger.info('')
-
         protocol = 'https' if self.ssl else 'http'
         return '{protocol}://device.{host}{api_path}'.format(
             protocol=protocol, host=self.host, api_path=api_path)
@@ -159,31 +195,21 @@ class DDIClient(object):
         Returns:
             Response JSON data
         """
+        url = self.url(api_path, **kwargs)
 
-        self.logger.info('')
-        
-        get_headers = {
-            'Accept': 'application/json',
-            **self.headers
-        }
-        url = self.build_api_url(
-                api_path.format(
-                    tenant=self.tenant,
-                    controllerId=self.controller_id,
-                    **kwargs))
-
-        self.logger.debug('GET {} {}'.format(url, get_headers))
-        async with self.session.get(url, headers=get_headers,
-                                    params=query_params,
-                                    timeout=ClientTimeout(self.timeout)) as resp:
-            await self.check_http_status(resp)
-            json = await resp.json()
-            self.logger.debug(json)
-            return json
+        self.logger.debug('GET %s', url)
+        with HTTP_DURATION.time(api='ddi', method='GET'):
+            async with self.session.get(url, headers=self.get_headers,
+                                        params=query_params,
+                                        timeout=self.client_timeout) as resp:
+                await self.check_http_status(resp)
+                data = await self.codec.read(resp, 'ddi')
+        return data
 
     async def get_binary_resource(self, api_path, dl_location,
                                   mime='application/octet-stream',
-                                  timeout=3600, **kwargs):
+                                  timeout=3600, progress_callback=None,
+                                  decoder=None, **kwargs):
         """
         Helper method for binary HTTP GET API requests.
 
@@ -195,23 +221,22 @@ class DDIClient(object):
         Keyword Args:
             mime: mimetype of content to retrieve
                   (default: 'application/octet-stream')
+            progress_callback: called with (bytes done, bytes total)
+            decoder: StreamDecoder for compressed content
             kwargs: Other keyword args used for replacing items in the API path
 
         Returns:
             MD5 hash of downloaded content
         """
-        self.logger.info('')
-
-        url = self.build_api_url(
-                api_path.format(
-                    tenant=self.tenant,
-                    controllerId=self.controller_id,
-                    **kwargs))
-        return await self.get_binary(url, dl_location, mime, timeout=timeout)
+        url = self.url(api_path, **kwargs)
+        return await self.get_binary(url, dl_location, mime, timeout=timeout,
+                                     progress_callback=progress_callback,
+                                     decoder=decoder)
 
     async def get_binary(self, url, dl_location,
                          mime='application/octet-stream',
-                         timeout=3600):
+                         timeout=3600, progress_callback=None,
+                         decoder=None):
         """
         Actual download method with checksum checking.
 
@@ -223,19 +248,22 @@ class DDIClient(object):
                   (default: 'application/octet-stream')
             timeout: download timeout
                   (default: 3600)
+            progress_callback: called with (bytes done, bytes total)
+            decoder: StreamDecoder writing decompressed content, the hash
+                  is taken over the compressed stream
 
         Returns:
             MD5 hash of downloaded content
         """
-        self.logger.info('')
-
         get_bin_headers = {
             'Accept': mime,
             **self.headers
         }
         hash_md5 = hashlib.md5()
+        hash_time = 0
+        decode_time = 0
 
-        self.logger.debug('GET binary {}'.format(url))
+        self.logger.debug('GET binary %s', url)
 
         # session timeout & single socket read timeout
         timeout = ClientTimeout(timeout, sock_read=60)
@@ -244,6 +272,8 @@ class DDIClient(object):
                                     timeout=timeout) as resp:
 
             await self.check_http_status(resp)
+            total = resp.content_length or 0
+            done = 0
             with dl_location.open('wb') as fd:
                 while True:
                     chunk, _ = await resp.content.readchunk()
@@ -252,11 +282,61 @@ class DDIClient(object):
                     if not chunk:
                         break
 
-                    fd.write(chunk)
+                    start = time.perf_counter()
                     hash_md5.update(chunk)
-
+                    hash_time += time.perf_counter() - start
+
+                    if decoder is not None:
+                        start = time.perf_counter()
+                        fd.write(decoder.decompress(chunk))
+                        decode_time += time.perf_counter() - start
+                    else:
+                        fd.write(chunk)
+                    DOWNLOAD_BYTES.inc(len(chunk))
+
+                    if progress_callback:
+                        done += len(chunk)
+                        progress_callback(done, total)
+
+                if decoder is not None:
+                    fd.write(decoder.flush())
+
+        PHASE_DURATION.observe(hash_time, phase='hash')
+        if decoder is not None:
+            PHASE_DURATION.observe(decode_time, phase='decompress')
         return hash_md5.hexdigest()
 
+    async def get_range(self, url, first=None, last=None,
+                        mime='application/octet-stream', timeout=600):
+        """
+        Fetch a byte range (first to last inclusive) of an artifact,
+        or the whole artifact without first.
+
+        Returns:
+            Content bytes
+
+        Raises:
+            APIError: if the server ignored the requested range
+        """
+        headers = {
+            'Accept': mime,
+            **self.headers
+        }
+        if first is not None:
+            headers['Range'] = 'bytes={}-{}'.format(first, last)
+
+        self.logger.debug('GET %s %s', url, headers.get('Range', ''))
+        async with self.session.get(url, headers=headers,
+                                    timeout=ClientTimeout(timeout,
+                                                          sock_read=60)) as resp:
+            await self.check_http_status(resp)
+            if first is not None and resp.status != 206:
+                raise APIError('Range requests not supported', resp.status)
+            data = await resp.read()
+
+        DOWNLOAD_BYTES.inc(len(data))
+        return data
+
     async def post_resource(self, api_path, data, **kwargs):
         """
         Helper method for HTTP POST API requests.
@@ -267,24 +347,14 @@ class DDIClient(object):
         Keyword Args:
             kwargs: keyword args used for replacing items in the API path
         """
-        self.logger.info('')
+        url = self.url(api_path, **kwargs)
+        self.logger.debug('POST %s', url)
 
-        post_headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            **self.headers
-        }
-        url = self.build_api_url(
-                api_path.format(
-                    tenant=self.tenant,
-                    controllerId=self.controller_id,
-                    **kwargs))
-        self.logger.debug('POST {}'.format(url))
-
-        async with self.session.post(url, headers=post_headers,
-                                     data=json.dumps(data),
-                                     timeout=ClientTimeout(self.timeout)) as resp:
-            await self.check_http_status(resp)
+        with HTTP_DURATION.time(api='ddi', method='POST'):
+            async with self.session.post(url, headers=self.post_headers,
+                                         data=self.codec.write(data, 'ddi'),
+                                         timeout=self.client_timeout) as resp:
+                await self.check_http_status(resp)
 
     async def put_resource(self, api_path, data, **kwargs):
         """
@@ -296,33 +366,45 @@ class DDIClient(object):
         Keyword Args:
             kwargs: keyword args used for replacing items in the API path
         """
-        self.logger.info('') 
-        
-        put_headers = {
-            'Content-Type': 'application/json',
-            **self.headers
-        }
-        url = self.build_api_url(
-                api_path.format(
-                    tenant=self.tenant,
-                    controllerId=self.controller_id,
-                    **kwargs))
-        self.logger.debug('PUT {}'.format(url))
-        self.logger.debug(json.dumps(data))
-
-        async with self.session.put(url, headers=put_headers,
-                                    data=json.dumps(data),
-                                    timeout=ClientTimeout(self.timeout)) as resp:
-            await self.check_http_status(resp)
+        url = self.url(api_path, **kwargs)
+        self.logger.debug('PUT %s', url)
+
+        with HTTP_DURATION.time(api='ddi', method='PUT'):
+            async with self.session.put(url, headers=self.put_headers,
+                                        data=self.codec.write(data, 'ddi'),
+                                        timeout=self.client_timeout) as resp:
+                await self.check_http_status(resp)
+
+    async def queue_resource(self, method, api_path, data, key=None,
+                             final=False, **kwargs):
+        """
+        Send feedback like requests through the outbox, or directly if
+        the client has no outbox.
+
+        Args:
+            method(str): 'POST' or 'PUT'
+            api_path(str): REST API path
+            data: JSON data for request
+        Keyword Args:
+            key: deduplication key in outbox
+            final: request closes the action
+            kwargs: keyword args used for replacing items in the API path
+        """
+        if self.outbox is None:
+            send = self.post_resource if method == 'POST' else self.put_resource
+            return await send(api_path, data, **kwargs)
+
+        self.outbox.put(method, api_path, data, key, final, **kwargs)
 
     async def check_http_status(self, resp):
         """Log API error message."""
-        self.logger.info('')
-        
-        if resp.status != 200:
+        HTTP_REQUESTS.inc(api='ddi', method=resp.method, status=resp.status)
+
+        # 206 answers ranged artifact requests
+        if resp.status not in (200, 206):
             error_description = await resp.text()
             if error_description:
-                self.logger.debug('API error: {}'.format(error_description))
+                self.logger.debug('API error: %s', error_description)
 
             if resp.status in self.error_responses:
                 reason = self.error_responses[resp.status]
@@ -330,4 +412,4 @@ class DDIClient(object):
                 reason = resp.reason
 
             raise APIError('{status}: {reason}'.format(
-                status=resp.status, reason=reason))
+                status=resp.status, reason=reason), resp.status)
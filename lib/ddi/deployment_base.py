@@ -3,6 +3,8 @@
 from datetime import datetime
 from enum import Enum
 
+from .resource import ResourceCache
+
 # status of the action execution
 DeploymentStatusExecution = Enum('DeploymentStatusExecution',
                                  'closed proceeding canceled scheduled \
@@ -23,14 +25,19 @@ class DeploymentBaseAction(object):
     in HawkBit's DDI API.
     See http://sp.apps.bosch-iot-cloud.com/documentation/rest-api/rootcontroller-api-guide.html#_get_tenant_controller_v1_targetid_deploymentbase_actionid # noqa
     """
+    __slots__ = ('ddi', 'action_id', 'key')
 
     def __init__(self, ddi, action_id):
         self.ddi = ddi
         self.action_id = action_id
+        self.key = 'deploymentBase/{}'.format(action_id)
 
     async def __call__(self, resource=None):
+        # the link of a base poll names the resource version, yarl
+        # rejects a parameter without value
+        query_params = {'c': resource} if resource is not None else None
         return await self.ddi.get_resource(
-            '/{tenant}/controller/v1/{controllerId}/deploymentBase/{actionId}', {'c': resource}, actionId=self.action_id)
+            '/{tenant}/controller/v1/{controllerId}/deploymentBase/{actionId}', query_params, actionId=self.action_id)
 
     async def feedback(self, status_execution, status_result,
                        status_details=(), **kwstatus_result_progress):
@@ -59,8 +66,11 @@ class DeploymentBaseAction(object):
             }
         }
 
-        return await self.ddi.post_resource(
-            '/{tenant}/controller/v1/{controllerId}/deploymentBase/{actionId}/feedback', post_data, actionId=self.action_id)
+        return await self.ddi.queue_resource(
+            'POST', '/{tenant}/controller/v1/{controllerId}/deploymentBase/{actionId}/feedback', post_data,
+            key=self.key,
+            final=status_execution != DeploymentStatusExecution.proceeding,
+            actionId=self.action_id)
 
 
 class DeploymentBase(object):
@@ -68,9 +78,12 @@ class DeploymentBase(object):
     Represents /{tenant}/controller/v1/{targetid}/deploymentBase in HawkBit's
     DDI API.
     """
+    __slots__ = ('ddi', 'actions')
+
     def __init__(self, ddi):
         self.ddi = ddi
+        self.actions = ResourceCache(
+            lambda action_id: DeploymentBaseAction(ddi, action_id))
 
     def __getitem__(self, key):
-        action_id = key
-        return DeploymentBaseAction(self.ddi, action_id)
+        return self.actions[key]
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+'''
+Parsed DDI responses: base poll resource and deployments.
+
+Responses are validated once when they are parsed; a missing or
+malformed field raises ModelError naming the field, e.g.
+"deployment.chunks[0].artifacts[1].hashes.md5 missing".
+'''
+
+from pathlib import PurePosixPath
+from urllib.parse import urlsplit, parse_qs
+
+from .deployment_base import DeploymentUpdate
+from ..delta import INDEX_SUFFIX
+
+
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+class ModelError(ValueError):
+    pass
+
+
+def field(data, key, path, kind=str):
+    '''
+    data[key], checked to be of type kind
+    '''
+    if not isinstance(data, dict) or key not in data:
+        raise ModelError('{}.{} missing'.format(path, key))
+    value = data[key]
+    if not isinstance(value, kind):
+        raise ModelError('{}.{} is not {}'.format(
+            path, key, getattr(kind, '__name__', 'valid')))
+    return value
+
+
+def local_name(filename):
+    '''
+    File name to store an artifact under: the last path component of
+    the server's filename, so that it cannot point outside a directory
+    '''
+    name = PurePosixPath(filename).name
+    if not name or name in ('.', '..'):
+        raise ModelError('artifact filename is not valid: {}'.format(
+            filename))
+    return name
+
+
+def path_segments(href):
+    '''
+    Path segments of href, the last ones are all that is looked at
+    '''
+    return href.split('?', 1)[0].split('#', 1)[0].split('/')
+
+
+class Link(object):
+    """
+    Action link of the base poll resource, e.g. deploymentBase/{id}?c=...
+    """
+    __slots__ = ('action_id', 'resource')
+
+    def __init__(self, action_id, resource=None):
+        self.action_id = action_id
+        self.resource = resource
+
+    @classmethod
+    def parse(cls, href, rel):
+        segments = path_segments(href)
+        if len(segments) < 2 or segments[-2] != rel:
+            raise ModelError('_links.{} has no action id: {}'.format(rel, href))
+        query = parse_qs(urlsplit(href).query)
+        return cls(segments[-1], query.get('c', [None])[0])
+
+
+class Base(object):
+    """
+    Base poll resource
+    """
+    __slots__ = ('sleep', 'config_data', 'deployment', 'cancel')
+
+    def __init__(self, sleep, config_data=False, deployment=None, cancel=None):
+        self.sleep = sleep
+        self.config_data = config_data
+        self.deployment = deployment
+        self.cancel = cancel
+
+    @classmethod
+    def parse(cls, data):
+        config = field(data, 'config', 'base', dict)
+        polling = field(config, 'polling', 'base.config', dict)
+        sleep_str = field(polling, 'sleep', 'base.config.polling')
+        try:
+            hours, minutes, seconds = (int(p) for p in sleep_str.split(':'))
+        except ValueError:
+            raise ModelError('base.config.polling.sleep is not HH:MM:SS: '
+                             '{}'.format(sleep_str))
+        sleep = hours * 3600 + minutes * 60 + seconds
+
+        links = data.get('_links') or {}
+        base = cls(sleep, 'configData' in links)
+        if 'deploymentBase' in links:
+            base.deployment = Link.parse(
+                field(links['deploymentBase'], 'href', '_links.deploymentBase'),
+                'deploymentBase')
+        if 'cancelAction' in links:
+            base.cancel = Link.parse(
+                field(links['cancelAction'], 'href', '_links.cancelAction'),
+                'cancelAction')
+        return base
+
+
+class Hashes(object):
+    __slots__ = ('md5', 'sha1', 'sha256')
+
+    def __init__(self, md5, sha1=None, sha256=None):
+        self.md5 = md5
+        self.sha1 = sha1
+        self.sha256 = sha256
+
+    @classmethod
+    def parse(cls, data, path):
+        md5 = field(data, 'md5', path)
+        # part of local file names, e.g. in the gateway's artifact cache
+        if len(md5) != 32 or not all(c in HEX_DIGITS for c in md5.lower()):
+            raise ModelError('{}.md5 is not an MD5 digest: {}'.format(path, md5))
+        return cls(md5, data.get('sha1'), data.get('sha256'))
+
+
+class Artifact(object):
+    """
+    Artifact of a chunk with its download URL.
+
+    module_id is None if the URL does not follow the DDI API layout
+    (static download URLs). local_name is the filename safe to use for
+    local files.
+    """
+    __slots__ = ('filename', 'size', 'hashes', 'url', 'module_id',
+                 'local_name')
+
+    def __init__(self, filename, size, hashes, url, module_id=None):
+        self.filename = filename
+        self.size = size
+        self.hashes = hashes
+        self.url = url
+        self.module_id = module_id
+        self.local_name = local_name(filename)
+
+    @classmethod
+    def parse(cls, data, path):
+        filename = field(data, 'filename', path)
+        hashes = Hashes.parse(field(data, 'hashes', path, dict),
+                              path + '.hashes')
+
+        # prefer https ('download') over http ('download-http')
+        # HawkBit provides either only https, only http or both
+        links = field(data, '_links', path, dict)
+        rel = 'download' if 'download' in links else 'download-http'
+        url = field(field(links, rel, path + '._links', dict), 'href',
+                    '{}._links.{}'.format(path, rel))
+
+        segments = path_segments(url)
+        module_id = None
+        if len(segments) >= 4 and segments[-4] == 'softwaremodules' \
+                and segments[-2] == 'artifacts':
+            module_id = segments[-3]
+
+        return cls(filename, data.get('size'), hashes, url, module_id)
+
+    @property
+    def is_index(self):
+        return self.filename.endswith(INDEX_SUFFIX)
+
+
+class Chunk(object):
+    __slots__ = ('part', 'name', 'version', 'artifacts')
+
+    def __init__(self, part, name, version, artifacts):
+        self.part = part
+        self.name = name
+        self.version = version
+        self.artifacts = artifacts
+
+    @classmethod
+    def parse(cls, data, path):
+        artifacts = field(data, 'artifacts', path, list)
+        return cls(data.get('part'), data.get('name'), data.get('version'),
+                   [Artifact.parse(a, '{}.artifacts[{}]'.format(path, i))
+                    for i, a in enumerate(artifacts)])
+
+    def payloads(self):
+        '''
+        Artifacts to install, with the block index of each (or None)
+        '''
+        indexes = {a.filename: a for a in self.artifacts if a.is_index}
+        return [(a, indexes.get(a.filename + INDEX_SUFFIX))
+                for a in self.artifacts if not a.is_index]
+
+
+class Deployment(object):
+    """
+    deploymentBase resource of an action
+    """
+    __slots__ = ('action_id', 'resource', 'download', 'update',
+                 'maintenance_window', 'chunks')
+
+    def __init__(self, action_id, resource, download, update,
+                 maintenance_window, chunks):
+        self.action_id = action_id
+        self.resource = resource
+        self.download = download
+        self.update = update
+        self.maintenance_window = maintenance_window
+        self.chunks = chunks
+
+    @classmethod
+    def parse(cls, data, resource=None):
+        action_id = str(field(data, 'id', 'deploymentBase', (str, int)))
+        deployment = field(data, 'deployment', 'deploymentBase', dict)
+        chunks = field(deployment, 'chunks', 'deployment', list)
+
+        def handling(key):
+            value = deployment.get(key, 'forced')
+            try:
+                return DeploymentUpdate[value]
+            except KeyError:
+                raise ModelError('deployment.{} is invalid: {}'.format(
+                    key, value))
+
+        return cls(action_id, resource, handling('download'),
+                   handling('update'), deployment.get('maintenanceWindow'),
+                   [Chunk.parse(c, 'deployment.chunks[{}]'.format(i))
+                    for i, c in enumerate(chunks)])
+
+    def payloads(self):
+        return [p for chunk in self.chunks for p in chunk.payloads()]
+
+    def install_allowed(self):
+        '''
+        Whether the server allows to install now: the update is not
+        skipped and the maintenance window is not closed
+        '''
+        return self.update != DeploymentUpdate.skip and \
+            self.maintenance_window != 'unavailable'
+
+
+class DeploymentCache(object):
+    """
+    Parsed deployments by action id. An entry is valid as long as the
+    base poll links the action with the same resource parameter, which
+    HawkBit changes whenever the action changes.
+    """
+    __slots__ = ('size', 'items')
+
+    def __init__(self, size=32):
+        self.size = size
+        self.items = {}
+
+    def get(self, link):
+        deployment = self.items.get(link.action_id)
+        if deployment is not None and deployment.resource == link.resource:
+            return deployment
+        return None
+
+    def put(self, deployment):
+        self.items.pop(deployment.action_id, None)
+        if len(self.items) >= self.size:
+            del self.items[next(iter(self.items))]
+        self.items[deployment.action_id] = deployment
+        return deployment
+
+    def discard(self, action_id):
+        self.items.pop(action_id, None)
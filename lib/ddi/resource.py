@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+
+class ResourceCache(object):
+    """
+    Memoizes resource objects by key, e.g. DeploymentBaseAction by action
+    id. The oldest entry is dropped when ``size`` entries are cached.
+    """
+    __slots__ = ('factory', 'size', 'items')
+
+    def __init__(self, factory, size=32):
+        self.factory = factory
+        self.size = size
+        self.items = {}
+
+    def __getitem__(self, key):
+        item = self.items.get(key)
+        if item is None:
+            if len(self.items) >= self.size:
+                del self.items[next(iter(self.items))]
+            item = self.items[key] = self.factory(key)
+        return item
@@ -1,22 +1,28 @@
 # -*- coding: utf-8 -*-
 
+from .resource import ResourceCache
+
 class FileName(object):
     """
     Represents /{tenant}/controller/v1/{targetid}/softwaremodules/{softwareModuleId}/artifacts/{fileName} # noqa
     in HawkBit's DDI API.
     """
+    __slots__ = ('ddi', 'software_module_id', 'file_name')
+
     def __init__(self, ddi, software_module_id, file_name):
         self.ddi = ddi
         self.software_module_id = software_module_id
         self.file_name = file_name
 
-    async def __call__(self, bundle_dl_location):
+    async def __call__(self, bundle_dl_location, progress_callback=None,
+                       decoder=None):
         """
         See http://sp.apps.bosch-iot-cloud.com/documentation/rest-api/rootcontroller-api-guide.html#_get_tenant_controller_v1_targetid_softwaremodules_softwaremoduleid_artifacts_filename # noqa
         """
         return await self.ddi.get_binary_resource(
             '/{tenant}/controller/v1/{controllerId}/softwaremodules/{moduleId}/artifacts/{filename}', bundle_dl_location, moduleId=self.software_module_id,
-            filename=self.file_name)
+            filename=self.file_name, progress_callback=progress_callback,
+            decoder=decoder)
 
     async def MD5SUM(self, md5_dl_location):
         """
@@ -32,9 +38,13 @@ class Artifacts(object):
     Represents /{tenant}/controller/v1/{targetid}/softwaremodules/{softwareModuleId}/artifacts # noqa
     in HawkBit's DDI API.
     """
+    __slots__ = ('ddi', 'software_module_id', 'files')
+
     def __init__(self, ddi, software_module_id):
         self.ddi = ddi
         self.software_module_id = software_module_id
+        self.files = ResourceCache(
+            lambda filename: FileName(ddi, software_module_id, filename))
 
     async def __call__(self):
         """
@@ -44,8 +54,7 @@ class Artifacts(object):
             '/{tenant}/controller/v1/{controllerId}/softwaremodules/{moduleId}/artifacts', moduleId=self.software_module_id)
 
     def __getitem__(self, key):
-        filename = key
-        return FileName(self.ddi, self.software_module_id, filename)
+        return self.files[key]
 
 
 class SoftwareModule(object):
@@ -53,13 +62,12 @@ class SoftwareModule(object):
     Represents /{tenant}/controller/v1/{targetid}/softwaremodules/{softwareModuleId} # noqa
     in HawkBit's DDI API.
     """
+    __slots__ = ('ddi', 'software_module_id', 'artifacts')
+
     def __init__(self, ddi, software_module_id):
         self.ddi = ddi
         self.software_module_id = software_module_id
-
-    @property
-    def artifacts(self):
-        return Artifacts(self.ddi, self.software_module_id)
+        self.artifacts = Artifacts(ddi, software_module_id)
 
 
 class SoftwareModules(object):
@@ -67,8 +75,12 @@ class SoftwareModules(object):
     Represents /{tenant}/controller/v1/{targetid}/softwaremodules in
     HawkBit's DDI API.
     """
+    __slots__ = ('ddi', 'modules')
+
     def __init__(self, ddi):
         self.ddi = ddi
+        self.modules = ResourceCache(
+            lambda software_module_id: SoftwareModule(ddi, software_module_id))
 
     def __getitem__(self, software_module_id):
-        return SoftwareModule(self.ddi, software_module_id)
+        return self.modules[software_module_id]
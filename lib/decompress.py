@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+
+# magic bytes of supported formats
+MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.tgz': 'gzip',
+    '.xz': 'xz',
+    '.txz': 'xz',
+    '.zst': 'zstd',
+    '.tzst': 'zstd',
+}
+
+
+class Identity(object):
+    def decompress(self, data, max_length=-1):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class GzipDecoder(object):
+    """
+    gzip stream decoder, also for several concatenated members (pigz).
+    """
+
+    def __init__(self):
+        self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data, max_length=-1):
+        """
+        Decompressed data, at most max_length bytes (-1 for unlimited).
+        Input beyond that is left in unconsumed_tail and dropped, the
+        caller gives up on the stream then.
+        """
+        out = []
+        size = 0
+        while True:
+            # zlib takes 0 for unlimited
+            limit = 0 if max_length < 0 else max_length - size
+            out.append(self.decoder.decompress(data, limit))
+            size += len(out[-1])
+            if not self.decoder.unused_data or size == max_length:
+                return b''.join(out)
+            data = self.decoder.unused_data
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def flush(self):
+        data = self.decoder.flush()
+        if not self.decoder.eof:
+            raise zlib.error('Compressed data ended before the end of stream')
+        return data
+
+
+class XZDecoder(object):
+    """
+    xz stream decoder, lzma is only imported once an xz artifact arrives
+    """
+
+    def __init__(self):
+        import lzma
+        self.decoder = lzma.LZMADecompressor()
+
+    def decompress(self, data, max_length=-1):
+        return self.decoder.decompress(data, max_length)
+
+    def flush(self):
+        if not self.decoder.eof:
+            raise EOFError('Compressed data ended before the end of stream')
+        return b''
+
+
+class ZstdDecoder(object):
+    """
+    zstandard's decompressobj has no output limit, the caller checks
+    the size of every decompressed chunk instead
+    """
+
+    def __init__(self):
+        import zstandard
+        self.decoder = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data, max_length=-1):
+        return self.decoder.decompress(data)
+
+    def flush(self):
+        return self.decoder.flush()
+
+
+DECODERS = {
+    'gzip': GzipDecoder,
+    'xz': XZDecoder,
+    'zstd': ZstdDecoder,
+}
+
+
+def detect(name='', head=b''):
+    '''
+    Compression format by file name extension or magic bytes,
+    None for uncompressed data
+    '''
+    for extension, compression in EXTENSIONS.items():
+        if name.endswith(extension):
+            return compression
+
+    for magic, compression in MAGIC:
+        if head.startswith(magic):
+            return compression
+
+    return None
+
+
+class StreamDecoder(object):
+    """
+    Decompresses a download chunk by chunk while it is written.
+
+    The format is chosen by file name or, failing that, by the magic bytes
+    of the first chunk. Uncompressed data passes through unchanged.
+    Corrupt data, or more than ``limit`` decompressed bytes (a
+    decompression bomb), raises ValueError.
+    """
+
+    def __init__(self, name='', limit=None):
+        self.name = name
+        self.limit = limit
+        self.size = 0
+        self.compression = None
+        self.decoder = None
+
+    def decompress(self, chunk):
+        if self.decoder is None:
+            self.compression = detect(self.name, chunk)
+            if self.compression is None:
+                self.decoder = Identity()
+            else:
+                try:
+                    self.decoder = DECODERS[self.compression]()
+                except ImportError as e:
+                    raise ValueError('{} artifacts need the {} module'.format(
+                        self.name or self.compression, e.name))
+        # one byte more than allowed tells that the limit is exceeded
+        max_length = -1 if self.limit is None else self.limit - self.size + 1
+        try:
+            data = self.decoder.decompress(chunk, max_length)
+        except Exception as e:
+            raise ValueError('Corrupt {} stream: {}'.format(
+                self.compression, e))
+        self.check(len(data))
+        return data
+
+    def check(self, size):
+        self.size += size
+        if self.limit is not None and self.compression is not None and \
+                self.size > self.limit:
+            raise ValueError('{} stream decompresses to more than {} '
+                             'bytes'.format(self.compression, self.limit))
+
+    def flush(self):
+        if self.decoder is None:
+            return b''
+        try:
+            data = self.decoder.flush()
+        except Exception as e:
+            raise ValueError('Corrupt {} stream: {}'.format(
+                self.compression, e))
+        self.check(len(data))
+        return data
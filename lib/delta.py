@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+'''
+Block level delta downloads.
+
+An artifact may be published together with a block index, an artifact
+named like the payload plus '.blockidx':
+
+    {"blockSize": 65536, "size": 1234567, "blocks": ["<sha256>", ...]}
+
+Blocks found in previously downloaded versions of the artifact are
+copied locally, only the missing blocks are fetched with HTTP range
+requests. Create the index with
+
+    python3 -m lib.delta artifact.tar
+'''
+
+import asyncio
+import hashlib
+import json
+import logging
+import sys
+from pathlib import Path
+
+from .metrics import REGISTRY
+
+INDEX_SUFFIX = '.blockidx'
+BLOCK_SIZE = 64 * 1024
+# upper bound of a single range request, held in memory
+MAX_RANGE = 4 * 1024 * 1024
+
+DELTA_BYTES = REGISTRY.counter(
+    'hbloader_delta_bytes_total',
+    'Artifact bytes of delta downloads, reused locally or fetched',
+    ('source',))
+
+
+class BlockIndex(object):
+    """
+    SHA-256 digests of the fixed size blocks of an artifact.
+    """
+
+    def __init__(self, block_size, size, blocks):
+        self.block_size = block_size
+        self.size = size
+        self.blocks = blocks
+
+    @classmethod
+    def from_json(cls, data):
+        index = cls(int(data['blockSize']), int(data['size']),
+                    list(data['blocks']))
+        expected = -(-index.size // index.block_size)
+        if len(index.blocks) != expected:
+            raise ValueError('Block index has {} blocks, expected {}'.format(
+                len(index.blocks), expected))
+        return index
+
+    @classmethod
+    def build(cls, path, block_size=BLOCK_SIZE):
+        path = Path(path)
+        blocks = [digest for _, digest in read_blocks(path, block_size)]
+        return cls(block_size, path.stat().st_size, blocks)
+
+    def to_json(self):
+        return {'blockSize': self.block_size, 'size': self.size,
+                'blocks': self.blocks}
+
+    def extent(self, number):
+        '''
+        (offset, length) of block number
+        '''
+        offset = number * self.block_size
+        return offset, min(self.block_size, self.size - offset)
+
+
+def read_blocks(path, block_size):
+    '''
+    Yield (offset, sha256 hex digest) of each block of path
+    '''
+    with Path(path).open('rb') as block_file:
+        offset = 0
+        while True:
+            block = block_file.read(block_size)
+            if not block:
+                break
+            yield offset, hashlib.sha256(block).hexdigest()
+            offset += len(block)
+
+
+def assemble(index, references, dl_location):
+    '''
+    Write all blocks found in references to dl_location.
+
+    Returns:
+        List of missing block numbers
+    '''
+    wanted = set(index.blocks)
+    found = {}
+    for reference in references:
+        for offset, digest in read_blocks(reference, index.block_size):
+            if digest in wanted and digest not in found:
+                found[digest] = (reference, offset)
+
+    missing = []
+    sources = {}
+    with Path(dl_location).open('wb') as out:
+        out.truncate(index.size)
+        for number, digest in enumerate(index.blocks):
+            if digest not in found:
+                missing.append(number)
+                continue
+
+            reference, offset = found[digest]
+            if reference not in sources:
+                sources[reference] = Path(reference).open('rb')
+            source = sources[reference]
+            source.seek(offset)
+
+            start, length = index.extent(number)
+            out.seek(start)
+            out.write(source.read(length))
+
+    for source in sources.values():
+        source.close()
+    return missing
+
+
+def ranges(index, missing, max_range=MAX_RANGE):
+    '''
+    Merge missing block numbers into (first, last) byte ranges
+    '''
+    result = []
+    for number in missing:
+        start, length = index.extent(number)
+        if result and result[-1][1] + 1 == start \
+                and start + length - result[-1][0] <= max_range:
+            result[-1][1] = start + length - 1
+        else:
+            result.append([start, start + length - 1])
+    return [tuple(r) for r in result]
+
+
+def file_md5(path):
+    hash_md5 = hashlib.md5()
+    with Path(path).open('rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1024 * 1024), b''):
+            hash_md5.update(block)
+    return hash_md5.hexdigest()
+
+
+async def download(ddi, url, index_url, references, dl_location,
+                   progress_callback=None):
+    """
+    Download artifact url to dl_location, reusing blocks of references.
+
+    Args:
+        ddi(DDIClient): client used for the range requests
+        url(str): artifact URL
+        index_url(str): block index URL
+        references(list): paths of earlier versions of the artifact
+        dl_location(Path): storage path for downloaded artifact
+    Keyword Args:
+        progress_callback: called with (bytes done, bytes total)
+
+    Returns:
+        MD5 hash of the assembled artifact
+    """
+    logger = logging.getLogger('hbloader')
+    loop = asyncio.get_event_loop()
+
+    index = BlockIndex.from_json(json.loads(await ddi.get_range(index_url)))
+    missing = await loop.run_in_executor(
+            None, assemble, index, references, dl_location)
+
+    fetch = ranges(index, missing)
+    total = sum(last - first + 1 for first, last in fetch)
+    reused = index.size - total
+    DELTA_BYTES.inc(reused, source='local')
+    logger.info('Delta download: %s of %s bytes reused, %s ranges to fetch',
+                reused, index.size, len(fetch))
+
+    done = 0
+    with Path(dl_location).open('r+b') as out:
+        for first, last in fetch:
+            data = await ddi.get_range(url, first, last)
+            if len(data) != last - first + 1:
+                raise ValueError('Short range response for {}-{}'.format(
+                    first, last))
+            out.seek(first)
+            out.write(data)
+            DELTA_BYTES.inc(len(data), source='remote')
+
+            if progress_callback:
+                done += len(data)
+                progress_callback(done, total)
+
+    return await loop.run_in_executor(None, file_md5, dl_location)
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:]:
+        index = BlockIndex.build(name)
+        with open(name + INDEX_SUFFIX, 'w') as index_file:
+            json.dump(index.to_json(), index_file)
+        print('{}: {} blocks'.format(name + INDEX_SUFFIX, len(index.blocks)))
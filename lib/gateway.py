@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+'''
+Gateway mode: one agent polling HawkBit for many downstream devices.
+
+Each device is a controller identity of its own, listed in a JSON file:
+
+    [{"controller_id": "sensor-01", "auth_token": "...",
+      "attributes": {"MAC": "..."},
+      "install": ["/opt/push.sh", "{address}", "{artifacts}"],
+      "address": "10.0.0.11"}]
+
+All identities share one HTTP session, one action scheduler and one
+artifact cache; each has an outbox of its own for feedback. Installing means running the identity's install command
+(or gateway_install) which pushes the artifacts to the device.
+'''
+
+import asyncio
+import heapq
+import json
+import logging
+import random
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+from aiohttp.client_exceptions import ClientError
+
+from .ddi.client import DDIClient, APIError
+from .ddi.client import (ConfigStatusExecution, ConfigStatusResult)
+from .ddi.deployment_base import (
+    DeploymentStatusExecution, DeploymentStatusResult, DeploymentUpdate)
+from .ddi.cancel_action import (
+    CancelStatusExecution, CancelStatusResult)
+from .ddi.model import Base, Deployment, ModelError, local_name
+from .scheduler import ActionScheduler, ActionContext
+from .metrics import REGISTRY, PHASE_DURATION, RETRIES
+from .outbox import Outbox
+from . import process
+
+# keys of an identity entry which are not install command variables
+IDENTITY_KEYS = ('controller_id', 'auth_token', 'name', 'attributes',
+                 'install')
+
+
+class Identity(object):
+    """
+    One downstream device: its DDI client and outbox, attributes and
+    install command.
+    """
+    __slots__ = ('controller_id', 'name', 'ddi', 'outbox', 'attributes',
+                 'install', 'variables', 'refresh')
+
+    def __init__(self, entry):
+        self.controller_id = entry['controller_id']
+        self.name = entry.get('name') or self.controller_id
+        self.ddi = None
+        self.outbox = None
+        self.attributes = entry.get('attributes') or {}
+        self.install = entry.get('install')
+        self.variables = {k: str(v) for k, v in entry.items()
+                          if k not in IDENTITY_KEYS}
+        # security token was rejected, look up the current one
+        self.refresh = False
+
+    def command(self, default, **kwargs):
+        '''
+        Install command with placeholders replaced. An argument
+        '{artifacts}' expands to the paths of all artifacts.
+        '''
+        variables = dict(self.variables, controller_id=self.controller_id,
+                         **kwargs)
+        command = []
+        for arg in self.install or default:
+            if arg == '{artifacts}':
+                command.extend(variables['artifacts'])
+            else:
+                command.append(arg.format(**variables))
+        return command
+
+
+class ArtifactCache(object):
+    """
+    Artifacts downloaded once for all identities, stored by MD5 hash.
+
+    Concurrent requests for the same artifact wait for a single download.
+    The least recently used files are removed when the cache exceeds
+    ``budget`` bytes; files in use are kept.
+    """
+
+    def __init__(self, directory, budget):
+        self.logger = logging.getLogger('hbloader')
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        self.locks = {}
+        # path -> number of installs using it
+        self.in_use = {}
+
+    def path(self, md5, filename):
+        return self.directory.joinpath('{}-{}'.format(md5, local_name(filename)))
+
+    async def get(self, md5, filename, download):
+        '''
+        Path of the cached artifact, downloaded with download(path) if it
+        is not cached yet. The caller releases the path after use.
+        '''
+        path = self.path(md5, filename)
+        lock = self.locks.setdefault(md5, asyncio.Lock())
+        async with lock:
+            self.in_use[path] = self.in_use.get(path, 0) + 1
+            try:
+                if path.exists():
+                    self.logger.debug('Artifact %s cached', path.name)
+                    path.touch()
+                    return path
+
+                partial = path.with_name('.{}.part'.format(path.name))
+                checksum = await download(partial)
+                if checksum != md5:
+                    partial.unlink()
+                    raise APIError('Checksum of {} does not match'.format(
+                        filename))
+                partial.replace(path)
+            except BaseException:
+                self.release(path)
+                raise
+
+        self.trim()
+        return path
+
+    def release(self, path):
+        count = self.in_use.get(path, 0) - 1
+        if count > 0:
+            self.in_use[path] = count
+        else:
+            self.in_use.pop(path, None)
+
+    def trim(self):
+        '''
+        Delete least recently used artifacts until the cache fits the budget
+        '''
+        files = [p for p in self.directory.iterdir()
+                 if p.is_file() and not p.name.startswith('.')
+                 and p not in self.in_use]
+        files.sort(key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in self.directory.iterdir()
+                    if p.is_file())
+
+        for p in files:
+            if total <= self.budget:
+                break
+            total -= p.stat().st_size
+            p.unlink()
+            self.logger.debug('Cache removed %s', p.name)
+
+
+class Gateway(object):
+    """
+    Polls and installs deployments for many controller identities.
+
+    Polls are spread over time in the order they become due, at most
+    ``gateway_concurrency`` are in flight. Each identity sleeps as long
+    as the server asks it to.
+    """
+
+    def __init__(self, session, identities, **kwargs):
+        self.logger = logging.getLogger('hbloader')
+        self.session = session
+        self.config = kwargs
+        self.path = None
+        self.mi = None
+        self.outbox_dir = Path.joinpath(Path.home(), '.hbloader/outbox/gateway')
+        self.identities = [self.create_identity(entry)
+                           for entry in identities]
+
+        self.scheduler = ActionScheduler(int(kwargs.get('max_actions', 2)))
+        self.concurrency = int(kwargs.get('gateway_concurrency', 8))
+        self.install = kwargs.get('gateway_install') or []
+        self.install_timeout = int(kwargs.get('install_timeout', 600))
+        self.cache = ArtifactCache(
+                Path.joinpath(Path.home(), 'BUNDLE/gateway'),
+                int(kwargs.get('gc_bundle_budget_mb', 256)) * 1024 * 1024)
+        # (due time, sequence, identity) of the next polls
+        self.due = []
+        self.sequence = 0
+        # ids of downloaded actions waiting until install is allowed
+        self.staged = set()
+
+    @classmethod
+    def from_file(cls, session, path, **kwargs):
+        with open(path, 'r') as identities_file:
+            gateway = cls(session, json.load(identities_file), **kwargs)
+        gateway.path = path
+        return gateway
+
+    def create_identity(self, entry):
+        '''
+        Identity with a DDI client on the shared session and an outbox
+        in a directory named after its controller id, if its security
+        token is known
+        '''
+        identity = Identity(entry)
+        if entry.get('auth_token'):
+            identity.outbox = Outbox(
+                    self.outbox_dir.joinpath(quote(identity.controller_id,
+                                                   safe='')),
+                    batch_size=int(self.config.get('outbox_batch', 10)),
+                    max_delay=int(self.config.get('outbox_max_delay', 300)))
+            identity.ddi = DDIClient(self.session, outbox=identity.outbox,
+                                     **dict(self.config,
+                                            controller_id=identity.controller_id,
+                                            auth_token=entry['auth_token']))
+        return identity
+
+    async def register(self, mi):
+        '''
+        Register identities without security token using MI and write
+        the received tokens back to the identities file.
+
+        Returns:
+            Number of identities which could not be registered
+        '''
+        from .mi.bulk import register_targets
+
+        # kept for refreshing rejected security tokens
+        self.mi = mi
+
+        with open(self.path, 'r') as identities_file:
+            entries = json.load(identities_file)
+
+        missing = [e for e in entries if not e.get('auth_token')]
+        if not missing:
+            return 0
+
+        registered, failed = await register_targets(
+                mi, [{'controllerId': e['controller_id'],
+                      'name': e.get('name') or e['controller_id']}
+                     for e in missing])
+
+        for entry in missing:
+            target = registered.get(entry['controller_id'])
+            if target:
+                entry['auth_token'] = target['securityToken']
+
+        process.write_atomic(self.path, json.dumps(entries, indent=4))
+
+        self.identities = [self.create_identity(entry) for entry in entries]
+        return len(failed)
+
+    async def refresh_token(self, identity):
+        '''
+        Look up the current security token of identity in MI after DDI
+        rejected the known one and write it to the identities file.
+        '''
+        if self.mi is None:
+            return
+
+        found = await self.mi.find_targets([identity.controller_id])
+        identity.refresh = False
+        if not found:
+            self.logger.warning('Target %s not found', identity.controller_id)
+            return
+
+        token = found[0]['securityToken']
+        identity.ddi.set_auth_token(token)
+        identity.outbox.token_refreshed()
+
+        with open(self.path, 'r') as identities_file:
+            entries = json.load(identities_file)
+        for entry in entries:
+            if entry['controller_id'] == identity.controller_id:
+                entry['auth_token'] = token
+        process.write_atomic(self.path, json.dumps(entries, indent=4))
+
+    def schedule(self, identity, delay):
+        self.sequence += 1
+        heapq.heappush(self.due, (time.monotonic() + delay, self.sequence,
+                                  identity))
+
+    async def start_polling(self, wait_on_error=60):
+        """
+        Poll all identities until cancelled.
+        """
+        active = [i for i in self.identities if i.ddi is not None]
+        self.logger.info('Gateway polling for %s identities', len(active))
+
+        # fails before any background task is started if the port is taken
+        if self.config.get('metrics_port'):
+            await REGISTRY.serve(port=int(self.config['metrics_port']))
+
+        outboxes = [asyncio.ensure_future(i.outbox.run(i.ddi))
+                    for i in active]
+
+        # spread the first polls instead of starting all at once
+        spread = min(len(active) / 10, 30)
+        for identity in active:
+            self.schedule(identity, random.uniform(0, spread))
+
+        slots = asyncio.Semaphore(self.concurrency)
+        polls = set()
+
+        try:
+            while True:
+                if not self.due:
+                    await asyncio.sleep(1)
+                    continue
+
+                delay = self.due[0][0] - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(min(delay, 1))
+                    continue
+
+                await slots.acquire()
+                _, _, identity = heapq.heappop(self.due)
+                poll = asyncio.ensure_future(
+                        self.poll(identity, slots, wait_on_error))
+                polls.add(poll)
+                poll.add_done_callback(polls.discard)
+
+        except asyncio.CancelledError:
+            self.logger.info('Polling cancelled')
+            for task in polls | set(outboxes):
+                task.cancel()
+            await asyncio.gather(*polls, *outboxes, return_exceptions=True)
+            await self.scheduler.close()
+            await REGISTRY.close()
+
+    async def poll(self, identity, slots, wait_on_error):
+        '''
+        Poll base resource of identity once and schedule the next poll.
+        '''
+        delay = wait_on_error
+        try:
+            if identity.refresh:
+                await self.refresh_token(identity)
+
+            with PHASE_DURATION.time(phase='poll'):
+                base = Base.parse(await identity.ddi())
+
+            if base.config_data:
+                await identity.ddi.configData(
+                        ConfigStatusExecution.closed,
+                        ConfigStatusResult.success, **identity.attributes)
+
+            if base.deployment:
+                self.process_deployment(identity, base.deployment)
+
+            if base.cancel:
+                await self.cancel(identity, base.cancel)
+
+            # a little jitter so that identities do not poll in lockstep
+            delay = base.sleep * random.uniform(0.9, 1.1)
+
+        except asyncio.CancelledError:
+            raise
+
+        except (APIError, ModelError, ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning('Polling %s failed: %s',
+                                identity.controller_id, e)
+            RETRIES.inc(operation='poll')
+
+            # security token of the identity is outdated
+            identity.refresh = getattr(e, 'status', None) == 401
+
+        except Exception:
+            self.logger.exception('Polling %s failed',
+                                  identity.controller_id)
+            RETRIES.inc(operation='poll')
+
+        finally:
+            slots.release()
+
+        self.schedule(identity, delay)
+
+    def process_deployment(self, identity, link):
+        action_id, resource = link.action_id, link.resource
+
+        if action_id in self.scheduler:
+            return
+
+        if identity.outbox.closing(identity.ddi.deploymentBase[action_id].key):
+            # finished, only the server does not know yet
+            return
+
+        self.logger.info('Deployment %s for %s', action_id,
+                         identity.controller_id)
+        action = ActionContext(action_id, resource)
+        action.identity = identity
+        self.scheduler.submit(action, self.run_deployment)
+
+    async def run_deployment(self, action):
+        with PHASE_DURATION.time(phase='deployment'):
+            await self.deploy(action)
+
+    async def deploy(self, action):
+        '''
+        Fetch the artifacts of all chunks into the cache and run the
+        install command of the identity, as far as the server's download
+        and update handling and maintenance window allow.
+        '''
+        identity = action.identity
+        ddi = identity.ddi
+        feedback = ddi.deploymentBase[action.action_id].feedback
+
+        try:
+            deployment = Deployment.parse(
+                await ddi.deploymentBase[action.action_id](action.resource),
+                action.resource)
+        except ModelError as e:
+            msg = 'Invalid deployment: {}'.format(e)
+            await feedback(DeploymentStatusExecution.closed,
+                           DeploymentStatusResult.failure, [msg])
+            raise APIError(msg)
+        artifacts = [artifact for artifact, _ in deployment.payloads()]
+
+        if not artifacts:
+            msg = 'Deployment without artifacts found. Ignoring'
+            await feedback(DeploymentStatusExecution.closed,
+                           DeploymentStatusResult.failure, [msg])
+            raise APIError(msg)
+
+        if deployment.download == DeploymentUpdate.skip:
+            self.logger.info('Download of %s not yet allowed',
+                             action.action_id)
+            return
+
+        install = deployment.install_allowed()
+        if not install and action.action_id in self.staged:
+            return
+
+        await feedback(DeploymentStatusExecution.proceeding,
+                       DeploymentStatusResult.none, ['Downloading'])
+
+        paths = []
+        try:
+            for artifact in artifacts:
+                try:
+                    with PHASE_DURATION.time(phase='download'):
+                        paths.append(await self.cache.get(
+                            artifact.hashes.md5, artifact.filename,
+                            lambda path: ddi.get_binary(artifact.url, path)))
+                except (APIError, ClientError, asyncio.TimeoutError) as e:
+                    await feedback(DeploymentStatusExecution.closed,
+                                   DeploymentStatusResult.failure, [str(e)])
+                    raise
+
+            if not install:
+                self.staged.add(action.action_id)
+                await feedback(DeploymentStatusExecution.proceeding,
+                               DeploymentStatusResult.none,
+                               ['Downloaded, waiting for installation'])
+                return
+            self.staged.discard(action.action_id)
+
+            command = identity.command(
+                    self.install,
+                    action_id=action.action_id,
+                    artifact=str(paths[0]),
+                    artifacts=[str(p) for p in paths])
+            if not command:
+                raise APIError('No install command for {}'.format(
+                    identity.controller_id))
+
+            await feedback(DeploymentStatusExecution.proceeding,
+                           DeploymentStatusResult.none, ['Installing'])
+            action.installing = True
+            try:
+                result = await process.run(command, cwd=self.cache.directory,
+                                           timeout=self.install_timeout,
+                                           check=False)
+            except (OSError, asyncio.TimeoutError) as e:
+                await feedback(DeploymentStatusExecution.closed,
+                               DeploymentStatusResult.failure,
+                               ['Install failed: {}'.format(e)])
+                raise
+
+            details = result.output.splitlines()[-10:]
+            if result.returncode == 0:
+                await feedback(DeploymentStatusExecution.closed,
+                               DeploymentStatusResult.success,
+                               ['Install completed'] + details)
+            else:
+                await feedback(DeploymentStatusExecution.closed,
+                               DeploymentStatusResult.failure,
+                               ['Install exited with {}'.format(
+                                   result.returncode)] + details)
+        finally:
+            for path in paths:
+                self.cache.release(path)
+
+    async def cancel(self, identity, link):
+        action_id = link.action_id
+
+        info = await identity.ddi.cancelAction[action_id]()
+        stop_id = info['cancelAction']['stopId']
+
+        action = self.scheduler.get(stop_id)
+        if (action is not None and action.installing) or \
+                identity.outbox.closing(
+                    identity.ddi.deploymentBase[stop_id].key):
+            await identity.ddi.cancelAction[action_id].feedback(
+                    CancelStatusExecution.rejected, CancelStatusResult.none,
+                    ['Action {} is already being installed'.format(stop_id)])
+            return
+
+        self.staged.discard(stop_id)
+        if self.scheduler.cancel(stop_id):
+            self.logger.info('Action %s of %s cancelled', stop_id,
+                             identity.controller_id)
+            details = ['Action {} stopped'.format(stop_id)]
+        else:
+            details = ['Action {} was not started'.format(stop_id)]
+
+        await identity.ddi.cancelAction[action_id].feedback(
+                CancelStatusExecution.closed, CancelStatusResult.success,
+                details)
@@ -1,24 +1,46 @@
 import asyncio
-import docker
 import json
-from docker.types import LogConfig
-import tarfile
-from pathlib import Path
-import subprocess
 import re
-from aiohttp.client_exceptions import ClientOSError, ClientResponseError
-from datetime import datetime, timedelta
+import threading
+from pathlib import Path
+from aiohttp.client_exceptions import (
+    ClientError, ClientOSError, ClientResponseError)
+from datetime import datetime, time
 
 from .ddi.client import DDIClient, APIError
 from .ddi.client import (ConfigStatusExecution, ConfigStatusResult)
 from .ddi.deployment_base import (
-    DeploymentStatusExecution, DeploymentStatusResult)
+    DeploymentStatusExecution, DeploymentStatusResult, DeploymentUpdate)
 from .ddi.cancel_action import (
     CancelStatusExecution, CancelStatusResult)
+from .ddi.model import Base, Deployment, DeploymentCache, ModelError
 from .mi.client import MIClient
+from .cleanup import GarbageCollector
+from .progress import ProgressReporter
+from .outbox import Outbox
+from .scheduler import ActionScheduler, ActionContext
+from .metrics import REGISTRY, PHASE_DURATION, RETRIES
+from . import process
+from .process import SystemdUnits
+from . import delta
+from .decompress import StreamDecoder, detect
+from .notify import Notifier
+from .preflight import Preflight, PreflightError, MB
 import logging
 
 
+def parse_window(text):
+    '''
+    (start, end) times of a window like 02:00-04:00, raises ValueError
+    '''
+    window = []
+    for part in text.split('-'):
+        hours, minutes = part.strip().split(':')
+        window.append(time(int(hours), int(minutes)))
+    start, end = window
+    return start, end
+
+
 class HBClient(object):
     """
     HawkBit downloader
@@ -37,38 +59,111 @@ class HBClient(object):
         self.session = session
 
         self.docker_client = None
+        # the GC and preflight create the client in executor threads too
+        self.docker_lock = threading.Lock()
 
         self.config = kwargs
 
-        self.logger.info(self.config)
+        self.logger.debug('%s', self.config)
 
         self.run_mode = kwargs['run_as_service']
         self.docker_mode = True
         self.attributes = kwargs['attributes']
 
-        self.action_id = None
+        self.scheduler = ActionScheduler(int(kwargs.get('max_actions', 2)))
+        self.metrics_port = kwargs.get('metrics_port', '')
+        self.metrics_interval = int(kwargs.get('metrics_interval', 60))
+        self.metrics_file = Path.joinpath(Path.home(), '.hbloader/metrics.json')
         self.lock_keeper = lock_keeper
 
         self.result_callback = result_callback
         self.step_callback = step_callback
+        self.progress_interval = int(kwargs.get('progress_interval', 10))
+        self.progress_step = int(kwargs.get('progress_step', 5))
+        self.install_window = None
+        if kwargs.get('install_window'):
+            try:
+                self.install_window = parse_window(kwargs['install_window'])
+            except ValueError:
+                self.logger.warning('install_window %s is not HH:MM-HH:MM, '
+                                    'installing at any time',
+                                    kwargs['install_window'])
+        # action_id -> download location of actions waiting for install
+        self.staged = {}
+        self.deployments = DeploymentCache()
 
         self.dl_dir = Path.joinpath(Path.home(), 'BUNDLE')
         Path(self.dl_dir).mkdir(parents=True, exist_ok=True)
 
-        self.dl_filename = ''
         self.service_dir = Path.joinpath(Path.home(), '.config/systemd/user')
         Path(self.service_dir).mkdir(parents=True, exist_ok=True)
+        self.units = SystemdUnits(self.service_dir)
+        self.install_timeout = int(kwargs.get('install_timeout', 600))
+        self.decompress = kwargs.get('decompress_artifacts', 'yes') == 'yes'
+        # larger expansion of a compressed artifact is taken as corrupt
+        self.decompress_ratio = int(kwargs.get('decompress_max_ratio', 20))
+        # waits are divided by clock_speed when replaying traces faster
+        self.clock_speed = 1
+        self.notify_url = kwargs.get('notify_url', '')
+        self.notify_interval = int(kwargs.get('notify_poll_interval', 300))
+        self.notifier = None
         self.auth_token = ''
         self.controller_id = kwargs['controller_id']
-        self.mi = MIClient(session, **kwargs)
+        self.mi_client = None
         self.ddi = None
+        self.outbox = Outbox(Path.joinpath(Path.home(), '.hbloader/outbox'),
+                             batch_size=int(kwargs.get('outbox_batch', 10)),
+                             max_delay=int(kwargs.get('outbox_max_delay', 300)))
+
+        self.gc = GarbageCollector(
+                self.dl_dir,
+                keep_images=int(kwargs.get('gc_keep_images', 3)),
+                bundle_budget=int(kwargs.get('gc_bundle_budget_mb', 256)) * 1024 * 1024,
+                interval=int(kwargs.get('gc_interval', 3600)),
+                report_callback=self.report_gc,
+                docker_client=self.get_docker_client)
+
+        self.preflight = None
+        if kwargs.get('preflight', 'yes') == 'yes':
+            self.preflight = Preflight(
+                    session, self.gc,
+                    reserve=int(kwargs.get('preflight_reserve_mb', 100)) * MB,
+                    min_memory=int(kwargs.get('preflight_min_memory_mb', 64)) * MB)
+
+    @property
+    def mi(self):
+        '''
+        Management API client, only created if the target
+        has to be looked up or registered.
+        '''
+        if self.mi_client is None:
+            self.mi_client = MIClient(self.session, **self.config)
+        return self.mi_client
+
+    def get_docker_client(self):
+        '''
+        Docker client, created on first use and shared afterwards.
+        Called from the event loop and from executor threads.
+        '''
+        with self.docker_lock:
+            if self.docker_client is None:
+                import docker
+                self.docker_client = docker.from_env()
+            return self.docker_client
 
-    async def run_ddi(self):
+    async def run_ddi(self, refresh=False):
         '''
         Register target on server using MI
         and switch to DDI with received parmeters
+
+        A security token known from configuration skips MI,
+        refresh=True fetches a new one.
         '''
-        self.logger.info('')
+        self.logger.debug('')
+
+        if self.config.get('auth_token') and not refresh:
+            self.ddi = DDIClient(self.session, outbox=self.outbox, **self.config)
+            return
 
         ''' loop until target will be registred on server'''
         while True:
@@ -77,9 +172,9 @@ class HBClient(object):
                 break
             await self.mi.register_target()
 
-        self.logger.debug('name: \n {}'.format(target['name']))
-        self.logger.debug('controller_id: \n {}'.format(target['controllerId']))
-        self.logger.debug('securityTocken: \n {}'.format(target['securityToken']))
+        self.logger.debug('name: \n %s', target['name'])
+        self.logger.debug('controller_id: \n %s', target['controllerId'])
+        self.logger.debug('securityTocken: \n %s', target['securityToken'])
 
         '''
         get generated on server auth tocken,
@@ -87,32 +182,37 @@ class HBClient(object):
         and run DDI with full set of params
         '''
         self.config['auth_token'] = target['securityToken']
-        self.logger.debug('{}'.format(self.config))
-        self.ddi = DDIClient(self.session, **self.config)
+        self.logger.debug('%s', self.config)
+
+        if self.ddi is not None:
+            self.ddi.set_auth_token(self.config['auth_token'])
+            self.outbox.token_refreshed()
+            if self.notifier is not None:
+                self.notifier.headers = self.ddi.headers
+            return
+
+        self.ddi = DDIClient(self.session, outbox=self.outbox, **self.config)
 
     async def get_target_details(self):
         '''
         If target exists return details (dict)
         If not return None
         '''
-        self.logger.info('')
-
-        targets = await self.mi()
-        content = targets['content']
-        self.logger.info(content)
-        if content:
-            for item in content:
-                self.logger.info("content item: {}".format(item))
-                if item['controllerId'] == self.controller_id:
-                    return item
-        self.logger.info('no content')     
+        self.logger.debug('')
+
+        # looked up by id, the unfiltered list is paged and holds only
+        # the first 50 targets
+        for item in await self.mi.find_targets([self.controller_id]):
+            if item['controllerId'] == self.controller_id:
+                return item
+        self.logger.info('no content')
         return None
 
     async def start_polling(self, wait_on_error=60):
         """
         Wrapper around self.poll_base_resource() for exception handling.
         """
-        self.logger.info('')
+        self.logger.debug('')
 
         INFO_POLLING = 'Polling cancelled'
         WARN_TIMEOUT = 'Polling failed due to TimeoutError'
@@ -120,30 +220,65 @@ class HBClient(object):
         WARN_EXCEPTION = 'Polling failed with an unexpected exception:'
         INFO_RETRY_FMT = 'Retry will happen in {} seconds'
 
+        # fails before any background task is started if the port is taken
+        if self.metrics_port:
+            await REGISTRY.serve(port=int(self.metrics_port))
+
+        gc_task = asyncio.ensure_future(self.gc.start())
+        outbox_task = asyncio.ensure_future(self.outbox.run(self.ddi))
+        metrics_task = asyncio.ensure_future(self.write_metrics())
+        notify_task = None
+        if self.notify_url:
+            self.notifier = Notifier(
+                    self.session,
+                    self.notify_url.format(tenant=self.config['tenant_id'],
+                                           controllerId=self.controller_id),
+                    self.controller_id, headers=self.ddi.headers)
+            notify_task = asyncio.ensure_future(self.notifier.run())
+
+        refresh_token = False
+
         while True:
             try:
+                if refresh_token:
+                    await self.run_ddi(refresh=True)
+                    refresh_token = False
+
                 await self.poll_base_resource()
             except asyncio.CancelledError:
                 self.logger.info(INFO_POLLING)
+                gc_task.cancel()
+                outbox_task.cancel()
+                metrics_task.cancel()
+                if notify_task:
+                    notify_task.cancel()
+                await self.scheduler.close()
+                await REGISTRY.close()
                 break
 
             except asyncio.TimeoutError:
                 self.logger.warning(WARN_TIMEOUT)
+                RETRIES.inc(operation='poll')
 
             except (APIError,
+                    ModelError,
                     TimeoutError,
                     ClientOSError,
                     ClientResponseError) as e:
                 # log error and start all over again
-                self.logger.warning('{} {}'.format(WARN_TEMP_ERROR, e))
+                self.logger.warning('%s %s', WARN_TEMP_ERROR, e)
+                RETRIES.inc(operation='poll')
+
+                # configured security token is outdated
+                refresh_token = getattr(e, 'status', None) == 401
 
             except Exception:
                 self.logger.exception(WARN_EXCEPTION)
+                RETRIES.inc(operation='poll')
 
-            self.action_id = None
             self.logger.info(INFO_RETRY_FMT.format(wait_on_error))
 
-            await asyncio.sleep(wait_on_error)
+            await asyncio.sleep(wait_on_error / self.clock_speed)
 
     async def poll_base_resource(self):
         """
@@ -151,20 +286,31 @@ class HBClient(object):
         """
         while True:
 
-            base = await self.ddi()
-            if '_links' in base:
+            with PHASE_DURATION.time(phase='poll'):
+                base = Base.parse(await self.ddi())
 
-                if 'configData' in base['_links']:
-                    await self.identify(base)
+            if base.config_data:
+                await self.identify(base)
 
-                if 'deploymentBase' in base['_links']:
-                    await self.process_deployment(base)
+            if base.deployment:
+                await self.process_deployment(base.deployment)
 
-                if 'cancelAction' in base['_links']:
-                    await self.cancel(base)
+            if base.cancel:
+                await self.cancel(base.cancel)
 
             await self.sleep(base)
 
+    async def write_metrics(self):
+        """
+        Dump metrics snapshot to disk every metrics_interval seconds.
+        """
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            try:
+                REGISTRY.dump(self.metrics_file)
+            except OSError as e:
+                self.logger.warning('Metrics snapshot failed: %s', e)
+
     async def identify(self, base):
         """
         Identify target against HawkBit.
@@ -175,76 +321,308 @@ class HBClient(object):
                 ConfigStatusExecution.closed,
                 ConfigStatusResult.success, **self.attributes)
 
-    async def process_deployment(self, base):
+    async def report_gc(self, reclaimed):
+        """
+        Report bytes reclaimed by garbage collection as config data.
+        """
+        if self.ddi is None:
+            return
+
+        data = {'gc_reclaimed_{}'.format(k): str(v)
+                for k, v in reclaimed.items()}
+        await self.ddi.configData(
+                ConfigStatusExecution.closed,
+                ConfigStatusResult.success, **self.attributes, **data)
+
+    async def process_deployment(self, link):
         """
-        Check and download deployments
+        Check deployment and start it as an action of its own
         """
         self.logger.info('> process_deployment')
 
-        if self.action_id is not None:
-            self.logger.info('Deployment is already in progress')
+        action_id, resource = link.action_id, link.resource
+        self.logger.debug('action_id: %s', action_id)
+        self.logger.debug('resource: %s', resource)
+
+        if action_id in self.scheduler:
+            self.logger.info('Deployment %s is already in progress', action_id)
+            return
+
+        # HawkBit links the action until its closing feedback arrives
+        if self.outbox.closing(self.ddi.deploymentBase[action_id].key):
+            self.logger.info('Deployment %s is finished, feedback pending',
+                             action_id)
             return
 
-        # retrieve action id and resource parameter from URL
-        deployment = base['_links']['deploymentBase']['href']
-        self.logger.info('deploymentBase: {}'.format(deployment))
-        match = re.search('/deploymentBase/(.+)\?c=(.+)$', deployment)
-        action_id, resource = match.groups()
-        self.logger.debug('action_id: {}'.format(action_id))
-        self.logger.debug('resource: {}'.format(resource))
         self.logger.info('Deployment found for this target')
-        # fetch deployment information
-        deploy_info = await self.ddi.deploymentBase[action_id](resource)
+        self.scheduler.submit(ActionContext(action_id, resource),
+                              self.run_deployment)
+
+    async def run_deployment(self, action):
+        """
+        Download and install deployment of one action
+        """
+        try:
+            with PHASE_DURATION.time(phase='deployment'):
+                await self.deploy(action)
+        finally:
+            if action.action_id not in self.staged:
+                self.deployments.discard(action.action_id)
+
+    async def fetch_deployment(self, action, tries=3):
+        '''
+        Parsed deployment of action, fetched only if it changed.
+
+        A lost connection or a body cut short is retried right away
+        instead of waiting for the next poll.
+        '''
+        deployment = self.deployments.get(action)
+        if deployment is not None:
+            return deployment
+
+        for fetch_try in range(tries):
+            try:
+                data = await self.ddi.deploymentBase[action.action_id](
+                        action.resource)
+                break
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                if fetch_try == tries - 1:
+                    raise
+                self.logger.warning('Fetching deployment %s failed: %s',
+                                    action.action_id, e)
+                RETRIES.inc(operation='deployment')
+                await asyncio.sleep(2 ** fetch_try / self.clock_speed)
+
         try:
-            chunk = deploy_info['deployment']['chunks'][0]
-        except IndexError:
+            deployment = Deployment.parse(data, action.resource)
+        except ModelError as e:
             # send negative feedback to HawkBit
-            status_execution = DeploymentStatusExecution.closed
-            status_result = DeploymentStatusResult.failure
-            msg = 'Deployment without chunks found. Ignoring'
-            await self.ddi.deploymentBase[action_id].feedback(
-                    status_execution, status_result, [msg])
+            msg = 'Invalid deployment: {}'.format(e)
+            await self.ddi.deploymentBase[action.action_id].feedback(
+                    DeploymentStatusExecution.closed,
+                    DeploymentStatusResult.failure, [msg])
             raise APIError(msg)
 
-        try:
-            artifact = chunk['artifacts'][0]
+        return self.deployments.put(deployment)
+
+    async def deploy(self, action):
+        action_id = action.action_id
 
-        except IndexError:
+        # fetch deployment information
+        deployment = await self.fetch_deployment(action)
+
+        # block indexes for delta downloads are published as artifacts
+        payloads = deployment.payloads()
+        if not payloads:
             # send negative feedback to HawkBit
             status_execution = DeploymentStatusExecution.closed
             status_result = DeploymentStatusResult.failure
             msg = 'Deployment without artifacts found. Ignoring'
+            await self.ddi.deploymentBase[action_id].feedback(
+                    status_execution, status_result, [msg])
+            raise APIError(msg)
+        artifact, index = payloads[0]
 
-        # prefer https ('download') over http ('download-http')
-        # HawkBit provides either only https, only http or both
-        if 'download' in artifact['_links']:
-            download_url = artifact['_links']['download']['href']
+        if deployment.download == DeploymentUpdate.skip:
+            self.logger.info('Download of %s not yet allowed', action_id)
+            return
 
-        else:
-            download_url = artifact['_links']['download-http']['href']
+        install = self.install_allowed(deployment)
+        if not install and action_id in self.staged:
+            self.logger.debug('Action %s staged, waiting for install', action_id)
+            return
 
-        # download artifact, check md5 and report feedback
-        md5_hash = artifact['hashes']['md5']
-        self.logger.info('Starting bundle download')
-        await self.download_artifact(action_id, download_url, md5_hash)
+        # nothing is downloaded unless the deployment fits, only the
+        # first payload is fetched
+        if action_id not in self.staged and \
+                not await self.preflight_artifacts(action_id, payloads[:1]):
+            return
 
-        # download successful, start install
-        self.logger.info('Starting installation')
+        action.progress = self.create_progress(action_id)
         try:
-            self.action_id = action_id
-            await asyncio.shield(self.install())
-        except Exception as e:
-            # send negative feedback to HawkBit
-            status_execution = DeploymentStatusExecution.closed
-            status_result = DeploymentStatusResult.failure
+            if action_id not in self.staged:
+                # pre-staging runs one action at a time
+                lock = self.scheduler.lock('staging') if not install else None
+                if lock:
+                    await lock.acquire()
+                try:
+                    # download artifact, check md5 and report feedback
+                    self.logger.info('Starting bundle download')
+                    await self.download_artifact(action, artifact, index=index)
+                    await self.preflight_image(action)
+
+                    if not install:
+                        await self.stage(action)
+                        return
+                finally:
+                    if lock:
+                        lock.release()
+            else:
+                action.dl_location = self.staged[action_id]
+                self.logger.info('Installing staged action %s', action_id)
+
+            # download successful, start install
+            self.logger.info('Starting installation')
+            action.installing = True
+            try:
+                await asyncio.shield(self.install(action))
+            except Exception as e:
+                await action.progress.close()
+                # send negative feedback to HawkBit
+                status_execution = DeploymentStatusExecution.closed
+                status_result = DeploymentStatusResult.failure
+                await self.ddi.deploymentBase[action_id].feedback(
+                        status_execution, status_result, [str(e)])
+                raise APIError(str(e))
+            finally:
+                self.staged.pop(action_id, None)
+        finally:
+            await action.progress.close()
+            if action.dl_location and action_id not in self.staged:
+                self.gc.release(action.dl_location)
+
+    async def preflight_artifacts(self, action_id, payloads):
+        '''
+        Check memory and make room for the artifacts of a deployment.
+        Returns False if the action has to wait, rejects the action if
+        its artifacts do not fit.
+        '''
+        if self.preflight is None:
+            return True
+
+        shortage = self.preflight.memory_shortage()
+        if shortage:
+            self.logger.warning('Action %s deferred: %s', action_id, shortage)
+            return False
+
+        try:
+            await self.preflight.check_artifacts(self.dl_dir, payloads,
+                                                 self.decompress)
+        except PreflightError as e:
             await self.ddi.deploymentBase[action_id].feedback(
-                    status_execution, status_result, [str(e)])
+                    DeploymentStatusExecution.closed,
+                    DeploymentStatusResult.failure, [str(e)])
             raise APIError(str(e))
+        return True
 
-    async def install(self):
-        
-        self.logger.info('{} {}'.format(self.dl_dir, self.dl_filename))
-        manifest_file_name = Path(self.dl_dir).joinpath(self.dl_filename)
+    async def preflight_image(self, action):
+        '''
+        Make room for the image of a downloaded action before it is pulled,
+        reject the action if it does not fit.
+        '''
+        if self.preflight is None:
+            return
+
+        try:
+            uri, _ = self.read_manifest(action)
+        except (OSError, ValueError, KeyError):
+            # not an image manifest, installation reports it
+            return
+
+        try:
+            await self.preflight.check_image(uri, self.get_docker_client)
+        except PreflightError as e:
+            await action.progress.close()
+            await self.ddi.deploymentBase[action.action_id].feedback(
+                    DeploymentStatusExecution.closed,
+                    DeploymentStatusResult.failure, [str(e)])
+            raise APIError(str(e))
+
+    def install_allowed(self, deployment):
+        '''
+        Whether the server and the local install window allow to install
+        the deployment now.
+        '''
+        if not deployment.install_allowed():
+            return False
+
+        if not self.install_window:
+            return True
+
+        start, end = self.install_window
+        now = datetime.now().time()
+        if start <= end:
+            return start <= now < end
+        # window spans midnight
+        return now >= start or now < end
+
+    async def stage(self, action):
+        '''
+        Pull the image of a downloaded action and keep both until
+        installation is allowed.
+        '''
+        uri, _ = self.read_manifest(action)
+        self.get_docker_client()
+        await self.pull_image(action, uri)
+
+        self.staged[action.action_id] = action.dl_location
+        self.logger.info('Action %s staged', action.action_id)
+
+        await action.progress.close()
+        await self.ddi.deploymentBase[action.action_id].feedback(
+                DeploymentStatusExecution.proceeding,
+                DeploymentStatusResult.none,
+                ['Downloaded, waiting for installation'])
+
+    async def cancel(self, link):
+        """
+        Cancel action requested by HawkBit.
+        """
+        self.logger.info('> cancel')
+
+        action_id = link.action_id
+
+        info = await self.ddi.cancelAction[action_id]()
+        stop_id = info['cancelAction']['stopId']
+
+        # an install runs to completion, its result stands
+        action = self.scheduler.get(stop_id)
+        if (action is not None and action.installing) or \
+                self.outbox.closing(self.ddi.deploymentBase[stop_id].key):
+            self.logger.info('Action %s already installing, cancel rejected',
+                             stop_id)
+            await self.ddi.cancelAction[action_id].feedback(
+                    CancelStatusExecution.rejected, CancelStatusResult.none,
+                    ['Action {} is already being installed'.format(stop_id)])
+            return
+
+        if self.scheduler.cancel(stop_id):
+            self.logger.info('Action %s cancelled', stop_id)
+            details = ['Action {} stopped'.format(stop_id)]
+        else:
+            details = ['Action {} was not started'.format(stop_id)]
+
+        self.deployments.discard(stop_id)
+        staged = self.staged.pop(stop_id, None)
+        if staged:
+            self.gc.release(staged)
+            details = ['Staged action {} dropped'.format(stop_id)]
+
+        await self.ddi.cancelAction[action_id].feedback(
+                CancelStatusExecution.closed, CancelStatusResult.success,
+                details)
+
+    def create_progress(self, action_id):
+        '''
+        Background reporter sending 'proceeding' feedback for action_id
+        '''
+        async def send(percentage, message):
+            await self.ddi.deploymentBase[action_id].feedback(
+                    DeploymentStatusExecution.proceeding,
+                    DeploymentStatusResult.none, [message],
+                    cnt=percentage, of=100)
+
+        return ProgressReporter(send,
+                                interval=self.progress_interval,
+                                step=self.progress_step,
+                                step_callback=self.step_callback).start()
+
+    def read_manifest(self, action):
+        '''
+        Image URI and port bindings from the downloaded manifest
+        '''
+        self.logger.info('%s', action.dl_location)
+        manifest_file_name = action.dl_location
         manifest = {}
 
         with open(manifest_file_name, "r") as manifest_file:
@@ -257,58 +635,109 @@ class HBClient(object):
         ports = {}
         for port_int, port_list in port_bindings.items(): 
             ports[port_int] = [entry["HostPort"] for entry in port_list]
+        return uri, ports
+
+    async def install(self, action):
+
+        uri, ports = self.read_manifest(action)
         print (ports)
 
         print(uri)
-        self.docker_client = docker.from_env()
-        client = docker.from_env()
-        
-        print("pulling image")
-        self.docker_client.images.pull(uri)
-        print("pull done")
+        self.get_docker_client()
+
+        # deployments of the same service must not overlap
+        async with self.scheduler.lock('service:{}'.format(
+                self.gc.service_name(uri))):
+            # staged images are already pulled
+            if action.action_id not in self.staged:
+                print("pulling image")
+                await self.pull_image(action, uri)
+                print("pull done")
+
+            self.logger.info("Image load finished.")
+            #self.logger.info("Images available:\n{}".format(images))
+
+            await self.process_image(action, uri, ports)
 
-        self.logger.info("Image load finished.")
-        #self.logger.info("Images available:\n{}".format(images))
 
-        await self.process_image(uri, ports)
+    async def pull_image(self, action, uri):
+        '''
+        Pull image in a worker thread, forwarding layer progress.
+        '''
+        callback = None
+        if action.progress:
+            callback = action.progress.phase(30, 90, 'Pulling image')
+
+        loop = asyncio.get_event_loop()
+        with PHASE_DURATION.time(phase='pull'):
+            await loop.run_in_executor(None, self.pull_image_sync,
+                                       uri, callback, loop)
+
+    def pull_image_sync(self, uri, callback, loop):
+        layers = {}
+        reported = -1
+
+        for event in self.docker_client.api.pull(uri, stream=True,
+                                                 decode=True):
+            if 'error' in event:
+                raise RuntimeError(event['error'])
 
+            if callback is None or 'id' not in event:
+                continue
 
-    async def install_old(self):
+            detail = event.get('progressDetail') or {}
+            if detail.get('total'):
+                layers[event['id']] = [detail.get('current', 0), detail['total']]
+            elif event.get('status') in ('Pull complete', 'Already exists') \
+                    and event['id'] in layers:
+                layers[event['id']][0] = layers[event['id']][1]
 
-        self.logger.info('{} {}'.format(self.dl_dir, self.dl_filename))
+            done = sum(layer[0] for layer in layers.values())
+            total = sum(layer[1] for layer in layers.values())
+            percent = done * 100 // total if total else 0
 
-        artifact_type = self.identify_artifact()
-        self.logger.info('artifact type {}'.format(artifact_type))
+            # do not flood the event loop with unchanged values
+            if percent != reported:
+                reported = percent
+                loop.call_soon_threadsafe(callback, done, total)
 
-        dl_location = Path(self.dl_dir).joinpath(self.dl_filename)
+    async def install_old(self, action):
+
+        self.logger.info('%s', action.dl_location)
+
+        artifact_type = self.identify_artifact(action)
+        self.logger.info('artifact type %s', artifact_type)
+
+        dl_location = action.dl_location
 
         if artifact_type == 'python':
-            commands = [['pip3', 'install', self.dl_filename], ]
+            commands = [['pip3', 'install', dl_location.name], ]
             for command in commands:
-                self.logger.info(command)
-                process = subprocess.run(command, cwd=self.dl_dir.as_posix())
-                rc = process.returncode
+                result = await process.run(command, cwd=self.dl_dir,
+                                           timeout=self.install_timeout,
+                                           check=False)
+                rc = result.returncode
 
-                await self.run_as_service()
+                await self.run_as_service(action)
 
         if artifact_type == 'docker':
-            self.docker_client = docker.from_env()
+            self.get_docker_client()
 
             with open(dl_location, 'rb') as image:
                 images = self.docker_client.images.load(image)
             
             rc = 0
             self.logger.info("Image load finished.")
-            self.logger.info("Images available:\n{}".format(images))
+            self.logger.info("Images available:\n%s", images)
 
             last_image = images[0]
 
-            await self.process_image(last_image)
+            await self.process_image(action, last_image)
 
         if self.lock_keeper:
             self.lock_keeper.unlock(self)
 
-        self.logger.info("Install complete {}".format(rc))
+        self.logger.info("Install complete %s", rc)
 
         if rc == 0:
             status_execution = DeploymentStatusExecution.closed
@@ -318,12 +747,11 @@ class HBClient(object):
             status_execution = DeploymentStatusExecution.closed
             status_result = DeploymentStatusResult.failure
 
-        await self.ddi.deploymentBase[self.action_id].feedback(
+        await self.ddi.deploymentBase[action.action_id].feedback(
                 status_execution, status_result, ['Install completed'])
 
-        self.logger.info("Install complete fb {}".format(rc))
+        self.logger.info("Install complete fb %s", rc)
 
-        self.action_id = None
         self.result_callback(result)
 
     async def uninstall(self):
@@ -345,23 +773,28 @@ class HBClient(object):
 
             print('Wrong input')
 
-    async def process_image(self, image, ports):
+    async def process_image(self, action, image, ports):
         '''
         Make descision about image usage
         and run container if yes.
         '''
-        self.logger.info('')
+        self.logger.debug('')
         if self.docker_mode == 'no':
             print("no start container")
             return
 
+        from docker.types import LogConfig
+
         print("start container")
+        if action.progress:
+            action.progress.update(95, 'Starting container')
         log_params = {'max-size': '10m', 'max-file': '3'}
         log_config = LogConfig(type=LogConfig.types.JSON, config=log_params)
-        container = self.docker_client.containers.run(image,
-                                        detach=True,
-                                        log_config=log_config, 
-                                        ports=ports)
+        with PHASE_DURATION.time(phase='start'):
+            container = self.docker_client.containers.run(image,
+                                            detach=True,
+                                            log_config=log_config, 
+                                            ports=ports)
 
         self.logger.info('container {} {} {}'.format(container.short_id,
                                                      container.name,
@@ -370,17 +803,23 @@ class HBClient(object):
                                                      
         status_execution = DeploymentStatusExecution.closed
         status_result = DeploymentStatusResult.success
-                                                     
-        await self.ddi.deploymentBase[self.action_id].feedback(
+
+        # no progress may arrive after the final feedback
+        if action.progress:
+            await action.progress.close()
+
+        await self.ddi.deploymentBase[action.action_id].feedback(
                 status_execution, status_result, ['Install completed'])
 
-    async def run_as_service(self):
+        self.gc.mark_good(image)
+
+    async def run_as_service(self, action):
         '''
         If it enabled by configuration
         create service file and pass  it to systemd.
         '''
 
-        self.logger.info('> run_as_service {} {}'.format(self.run_mode, self.dl_filename))
+        self.logger.info('> run_as_service %s %s', self.run_mode, action.dl_filename)
 
         '''
         choose operating mode
@@ -395,93 +834,158 @@ class HBClient(object):
         '''
         create service file, put it to systemd
         '''
-        app_name =  self.dl_filename.split('-')[0]
+        app_name =  action.dl_filename.split('-')[0]
         service_file_name = app_name + '.service'
         exec_file_name = app_name + '.py'
 
-        self.logger.debug("Names: {} {} {}".format(app_name, service_file_name, exec_file_name))
+        self.logger.debug("Names: %s %s %s", app_name, service_file_name, exec_file_name)
 
         self.create_service_file(service_file_name, exec_file_name)
 
-        self.logger.debug('service_dir {}'.format(self.service_dir))
-
-        commands = [['pwd'],
-                    ['ls', '-la'],
-                    ['cp', service_file_name, self.service_dir],
-                    ['systemctl', '--user', 'daemon-reload'],
-                    ['systemctl', '--user', 'enable', service_file_name],
-                    ['systemctl', '--user', 'start', service_file_name],
-                    ['systemctl', '--user', 'status', service_file_name]]
+        self.logger.debug('service_dir %s', self.service_dir)
 
-        for command in commands:
-            self.logger.info(command)
-            process = subprocess.run(command, cwd=self.dl_dir)
-            rc = process.returncode
+        # one daemon-reload for all units installed at about the same time
+        await self.units.activate(service_file_name)
 
-    async def download_artifact(self, action_id, url, md5sum,
-                                tries=3):
+    async def download_artifact(self, action, artifact, tries=3, index=None):
         """
         Download bundle artifact.
+
+        With the block index artifact the first try reuses blocks of
+        earlier downloads of the same artifact and only fetches the
+        changed ranges.
         """
-        self.logger.info('')
+        self.logger.debug('')
+
+        action_id = action.action_id
+        url = artifact.url
+        md5sum = artifact.hashes.md5
+        index_url = index.url if index else None
 
         ERR_CHECKSUMM_FMT = 'Checksum does not match. {} tries remaining'
+        ERR_DOWNLOAD_FMT = 'Download failed: {}. {} tries remaining'
         STATUS_MSG_FMT = 'Artifact checksum does not match after {} tries.'
+        STATUS_ERROR_FMT = 'Artifact download failed after {} tries: {}'
 
-        try:
-            match = re.search('/softwaremodules/(.+)/artifacts/(.+)$', url)
-            software_module, self.dl_filename = match.groups()
-            static_api_url = False
+        # API implementations might return static URLs
+        static_api_url = artifact.module_id is None
 
-        except AttributeError:
-            static_api_url = True
+        # compressed artifacts are stored decompressed
+        artifact_name = artifact.local_name
+        compressed = self.decompress and detect(artifact_name) is not None
 
-        if self.step_callback:
+        callback = None
+        if action.progress:
+            callback = action.progress.phase(0, 30, 'Downloading bundle')
+        elif self.step_callback:
             self.step_callback(0, "Downloading bundle...")
         
-        self.dl_filename = 'manifest.json'
-
-        self.logger.debug('dl_filename: {}'.format(self.dl_filename))
-        self.logger.debug('dl_dir: {}'.format(self.dl_dir))
-
-        dl_location = Path(self.dl_dir).joinpath(self.dl_filename)
+        action.dl_filename = 'manifest.json'
+
+        self.logger.debug('dl_filename: %s', action.dl_filename)
+        self.logger.debug('dl_dir: %s', self.dl_dir)
+
+        # concurrent actions must not share download files, earlier
+        # versions of the artifact are found by its name
+        dl_location = Path(self.dl_dir).joinpath(
+                '{}-{}'.format(action_id, artifact_name))
+        action.dl_location = dl_location
+        self.gc.protect(dl_location)
+
+        references = []
+        if index_url and not compressed:
+            earlier = re.compile(r'\d+-{}$'.format(re.escape(artifact_name)))
+            references = sorted(
+                (p for p in Path(self.dl_dir).iterdir()
+                 if earlier.match(p.name) and p != dl_location),
+                key=lambda p: p.stat().st_mtime, reverse=True)[:2]
 
         # try several times
+        error = None
         for dl_try in range(tries):
 
-            if not static_api_url:
-                checksum = await self.ddi.softwaremodules[software_module].artifacts[self.dl_filename](dl_location)
-
-            else:
-                # API implementations might return static URLs, so bypass API
-                # methods and download bundle anyway
-                checksum = await self.ddi.get_binary(url, dl_location)
+            with PHASE_DURATION.time(phase='download'):
+                checksum = None
+                error = None
+                decoder = None
+                if self.decompress:
+                    decoder = StreamDecoder(artifact_name, limit=(
+                            artifact.size * self.decompress_ratio
+                            if artifact.size else None))
+                if references and dl_try == 0:
+                    # the GC must not trim references while they are read
+                    for reference in references:
+                        self.gc.protect(reference)
+                    try:
+                        checksum = await delta.download(
+                                self.ddi, url, index_url, references,
+                                dl_location, progress_callback=callback)
+                    except (APIError, ClientError, asyncio.TimeoutError,
+                            OSError, ValueError, KeyError) as e:
+                        self.logger.warning('Delta download failed: %s', e)
+                    finally:
+                        for reference in references:
+                            self.gc.release(reference)
+
+                try:
+                    if checksum is None and not static_api_url:
+                        checksum = await self.ddi.softwaremodules[artifact.module_id].artifacts[artifact.filename](
+                                dl_location, progress_callback=callback,
+                                decoder=decoder)
+
+                    elif checksum is None:
+                        # API implementations might return static URLs, so bypass API
+                        # methods and download bundle anyway
+                        checksum = await self.ddi.get_binary(
+                                url, dl_location, progress_callback=callback,
+                                decoder=decoder)
+                except ValueError as e:
+                    # corrupt compressed stream
+                    self.logger.error('%s', e)
+                except (APIError, ClientError, asyncio.TimeoutError,
+                        OSError) as e:
+                    # connection lost, the next try starts over
+                    error = e
 
             if checksum == md5sum:
                 self.logger.info('Download successful')
                 return
 
+            elif error is not None:
+                self.logger.warning(ERR_DOWNLOAD_FMT.format(
+                    error, tries - dl_try - 1))
+                RETRIES.inc(operation='download')
+
             else:
-                self.logger.error(ERR_CHECKSUMM.format(tries-dl_try))
+                self.logger.error(ERR_CHECKSUMM_FMT.format(tries-dl_try))
+                RETRIES.inc(operation='download')
 
-        # MD5 comparison unsuccessful, send negative feedback to HawkBit
-        status_msg = STATUS_MSG_FMT.format(tries)
+        # download or MD5 comparison unsuccessful, send negative
+        # feedback to HawkBit
+        if error is not None:
+            status_msg = STATUS_ERROR_FMT.format(tries, error)
+        else:
+            status_msg = STATUS_MSG_FMT.format(tries)
         status_execution = DeploymentStatusExecution.closed
         status_result = DeploymentStatusResult.failure
 
         self.logger.info('Feedback failure')
+        if action.progress:
+            await action.progress.close()
         await self.ddi.deploymentBase[action_id].feedback(
                 status_execution, status_result, [status_msg])
 
         raise APIError(status_msg)
 
-    def identify_artifact(self):
+    def identify_artifact(self, action):
         '''
         Get archive's file list and determines type of content.
         '''
-        self.logger.info('')
+        self.logger.debug('')
 
-        dl_location = Path(self.dl_dir).joinpath(self.dl_filename)
+        dl_location = action.dl_location
+
+        import tarfile
 
         with tarfile.open(dl_location,'r') as tar:
             names = tar.getnames()
@@ -494,20 +998,26 @@ class HBClient(object):
         if 'setup.py' in items:
             result = 'python'
 
-        self.logger.debug("{} is a |{}|".format(self.dl_filename, result))
+        self.logger.debug("%s is a |%s|", action.dl_filename, result)
         return result
 
     async def sleep(self, base):
         """
         Sleep time suggested by HawkBit.
         """
-        self.logger.info('')
-        sleep_str = base['config']['polling']['sleep']
-        self.logger.info('Will sleep for {}'.format(sleep_str))
-        t = datetime.strptime(sleep_str, '%H:%M:%S')
-        delta = timedelta(hours=t.hour, minutes=t.minute, seconds=t.second)
-        # await asyncio.sleep(delta.total_seconds())
-        await asyncio.sleep(30)
+        self.logger.debug('')
+        self.logger.info('Will sleep for %s seconds', base.sleep)
+        # await asyncio.sleep(base.sleep)
+        interval = 30
+        if self.notifier is None:
+            await asyncio.sleep(interval / self.clock_speed)
+            return
+
+        # with push notifications polling is only the fallback
+        if self.notifier.connected:
+            interval = self.notify_interval
+        if await self.notifier.wait(interval / self.clock_speed):
+            self.logger.info('Woken up by notification')
 
     def create_service_file(self,
                             service_file_name,
@@ -517,10 +1027,12 @@ class HBClient(object):
         Create .service file for installed programm.
 
         '''
-        self.logger.info('> create_service_file {}'.format(self.run_mode))
+        self.logger.info('> create_service_file %s', self.run_mode)
+
+        import shutil
 
-        result = subprocess.run(['whereis', exec_name],  stdout=subprocess.PIPE)
-        full_exec_name = result.stdout.split()[1].decode('utf-8')
+        full_exec_name = shutil.which(exec_name) or \
+            Path.joinpath(self.dl_dir, exec_name).as_posix()
         str = '''[Unit]
 Description={}
 
@@ -530,6 +1042,4 @@ ExecStart=/usr/bin/python3 {}
 [Install]
 WantedBy=multi-user.target
 '''.format(description, full_exec_name)
-        p = Path.joinpath(self.dl_dir, service_file_name)
-        with p.open( 'w') as service_file:
-            service_file.write(str)
+        self.units.write(service_file_name, str)
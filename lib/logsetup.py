@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import logging.handlers
+import queue
+import sys
+from collections import deque
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler which leaves formatting to the listener thread.
+
+    Only the message is merged here, so that queued and buffered records
+    hold no references to the caller's arguments or tracebacks.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                        record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Passes records of ``output_level`` and above to ``target``, keeps
+    records below it in a fixed-size ring.
+
+    The ring is written to ``target`` before a record of ``flush_level``
+    or above, or on demand by ``flush_ring()``.
+    """
+
+    def __init__(self, target, capacity=1000, output_level=logging.INFO,
+                 flush_level=logging.ERROR):
+        super(RingBufferHandler, self).__init__(logging.NOTSET)
+        self.target = target
+        self.ring = deque(maxlen=capacity)
+        self.output_level = output_level
+        self.flush_level = flush_level
+
+    def emit(self, record):
+        if getattr(record, 'flush_ring', False):
+            self.flush_ring()
+            return
+
+        if record.levelno < self.output_level:
+            self.ring.append(record)
+            return
+
+        if record.levelno >= self.flush_level:
+            self.flush_ring()
+
+        self.target.handle(record)
+
+    def flush_ring(self):
+        self.acquire()
+        try:
+            while self.ring:
+                self.target.handle(self.ring.popleft())
+            self.target.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.target.close()
+        super(RingBufferHandler, self).close()
+
+
+class LogPipeline(object):
+    """
+    Logging through a queue: callers only enqueue records, a background
+    thread formats and writes them.
+
+    Records below ``level`` are kept in the ring only from ``ring_level``
+    on, lower records are not created at all. The message of a record is
+    merged when it is queued, so ``ring_level`` also bounds the work done
+    in the caller.
+    """
+
+    FORMAT = '%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d-%(funcName)s] %(message)s'
+    DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, level='INFO', ring_size=1000, logfile=None,
+                 ring_level='DEBUG', fmt=FORMAT, datefmt=DATEFMT):
+        self.level = self.parse_level(level, logging.INFO)
+        self.ring_level = min(self.parse_level(ring_level, logging.DEBUG),
+                              self.level)
+
+        if logfile:
+            output = logging.handlers.RotatingFileHandler(
+                    logfile, maxBytes=1024 * 1024, backupCount=3)
+        else:
+            output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(logging.Formatter(fmt, datefmt))
+
+        self.ring = None
+        handler = output
+        if ring_size and self.ring_level < self.level:
+            self.ring = RingBufferHandler(output, ring_size, self.level)
+            handler = self.ring
+
+        self.queue = queue.Queue(-1)
+        self.handler = LazyQueueHandler(self.queue)
+        self.listener = logging.handlers.QueueListener(
+                self.queue, handler, respect_handler_level=True)
+
+    @staticmethod
+    def parse_level(name, default):
+        level = logging.getLevelName(str(name).upper())
+        return level if isinstance(level, int) else default
+
+    def start(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+
+        # records below loglevel are only created for the agent's own
+        # logger and only if the ring keeps them
+        root.setLevel(self.level)
+        if self.ring:
+            logging.getLogger('hbloader').setLevel(self.ring_level)
+        self.listener.start()
+        return self
+
+    def flush_ring(self):
+        '''
+        Write buffered debug records once records queued so far are handled.
+        '''
+        if self.ring:
+            marker = logging.makeLogRecord({'levelno': logging.NOTSET,
+                                            'flush_ring': True})
+            self.queue.put_nowait(marker)
+
+    def stop(self):
+        self.listener.stop()
+        logging.getLogger().removeHandler(self.handler)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+
+def sort_key(item):
+    return tuple(str(v) for v in item[0])
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+class Counter(object):
+    """
+    Monotonic counter, optionally split by labels.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if not labels:
+            return ()
+        return tuple([labels.get(name, '') for name in self.labels])
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def items(self):
+        '''
+        Sorted copy of the values, other threads may update them
+        '''
+        with self.lock:
+            items = list(self.values.items())
+        return sorted(items, key=sort_key)
+
+    def render(self):
+        for key, value in self.items():
+            yield '{}{} {}'.format(self.name,
+                                   format_labels(self.labels, key), value)
+
+    def snapshot(self):
+        return [{'labels': dict(zip(self.labels, key)), 'value': value}
+                for key, value in self.items()]
+
+
+class Timer(object):
+    """
+    Context manager observing the elapsed time into a histogram.
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+
+class Histogram(Counter):
+    """
+    Distribution of observed values (usually seconds) in fixed buckets.
+    """
+    kind = 'histogram'
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+               30, 60, 120, 300, 600)
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            counts, _, _ = entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def items(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count))
+                     for key, (counts, total, count) in self.values.items()]
+        return sorted(items, key=sort_key)
+
+    def render(self):
+        for key, (counts, total, count) in self.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield '{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(self.labels, key, [('le', bound)]),
+                    cumulative)
+            yield '{}_bucket{} {}'.format(
+                self.name, format_labels(self.labels, key, [('le', '+Inf')]),
+                count)
+            yield '{}_sum{} {}'.format(
+                self.name, format_labels(self.labels, key), total)
+            yield '{}_count{} {}'.format(
+                self.name, format_labels(self.labels, key), count)
+
+    def snapshot(self):
+        return [{'labels': dict(zip(self.labels, key)),
+                 'buckets': dict(zip(self.buckets, counts)),
+                 'sum': total, 'count': count}
+                for key, (counts, total, count) in self.items()]
+
+
+class Registry(object):
+    """
+    Collection of the agent's metrics, rendered in Prometheus text format
+    or dumped as JSON snapshot.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('hbloader')
+        self.metrics = {}
+        self.runner = None
+
+    def register(self, cls, name, doc, labels, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, doc, labels, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter, name, doc, labels)
+
+    def histogram(self, name, doc, labels=(), **kwargs):
+        return self.register(Histogram, name, doc, labels, **kwargs)
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.doc))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'metrics': {name: {'type': metric.kind,
+                               'values': metric.snapshot()}
+                        for name, metric in sorted(self.metrics.items())}
+        }
+
+    def dump(self, path):
+        '''
+        Write snapshot to path atomically.
+        '''
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        with tmp.open('w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        tmp.replace(path)
+
+    async def serve(self, host='127.0.0.1', port=9100):
+        """
+        Start HTTP endpoint serving /metrics.
+        """
+        from aiohttp import web
+
+        async def handler(request):
+            return web.Response(text=self.render(),
+                                content_type='text/plain')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, host, port).start()
+        except OSError:
+            await self.close()
+            raise
+        self.logger.info('Metrics on http://{}:{}/metrics'.format(host, port))
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'hbloader_http_responses_total',
+    'HTTP responses by API, method and status code',
+    ('api', 'method', 'status'))
+
+HTTP_DURATION = REGISTRY.histogram(
+    'hbloader_http_request_seconds',
+    'Duration of HTTP requests',
+    ('api', 'method'))
+
+DOWNLOAD_BYTES = REGISTRY.counter(
+    'hbloader_download_bytes_total',
+    'Bytes of artifacts downloaded')
+
+PHASE_DURATION = REGISTRY.histogram(
+    'hbloader_phase_seconds',
+    'Duration of agent phases (poll, download, hash, pull, start, '
+    'feedback, deployment)',
+    ('phase',))
+
+RETRIES = REGISTRY.counter(
+    'hbloader_retries_total',
+    'Retried operations',
+    ('operation',))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+
+from aiohttp.client_exceptions import ClientError
+
+from .client import APIError
+
+# HawkBit returns at most 500 targets per page, existing targets of a
+# larger batch would not all be found by the lookup
+MAX_BATCH_SIZE = 500
+
+
+async def register_targets(mi, targets, batch_size=100, concurrency=4,
+                           retries=3, backoff=2):
+    """
+    Register targets in batches with bounded concurrency.
+
+    A batch is idempotent: targets which already exist are looked up
+    instead of being posted again, so failed batches can simply be
+    retried.
+
+    Args:
+        mi(MIClient): Management API client
+        targets(list): dicts with 'controllerId' and 'name'
+    Keyword Args:
+        batch_size: targets per POST request, at most MAX_BATCH_SIZE
+        concurrency: batches in flight
+        retries: retries of a failed batch
+        backoff: seconds before first retry, doubled per retry
+
+    Returns:
+        (registered, failed): dict controllerId -> target incl.
+        securityToken and list of targets which could not be registered
+    """
+    logger = logging.getLogger('hbloader')
+    if batch_size > MAX_BATCH_SIZE:
+        logger.warning('Batch size %s reduced to %s', batch_size,
+                       MAX_BATCH_SIZE)
+        batch_size = MAX_BATCH_SIZE
+    slots = asyncio.Semaphore(concurrency)
+    registered = {}
+    failed = []
+
+    async def register(batch):
+        ids = [target['controllerId'] for target in batch]
+
+        async with slots:
+            for attempt in range(retries + 1):
+                try:
+                    found = await mi.find_targets(ids)
+                    known = {t['controllerId']: t for t in found}
+                    missing = [t for t in batch
+                               if t['controllerId'] not in known]
+                    if missing:
+                        created = await mi.register_targets(missing) or []
+                        known.update((t['controllerId'], t) for t in created)
+
+                    registered.update(known)
+                    logger.info('Registered batch %s..%s (%s new)',
+                                ids[0], ids[-1], len(missing))
+                    return
+
+                except (APIError, ClientError, asyncio.TimeoutError) as e:
+                    # client errors other than rate limiting will not heal
+                    status = getattr(e, 'status', None)
+                    if status is not None and 400 <= status < 500 \
+                            and status not in (409, 429):
+                        logger.error('Batch %s..%s rejected: %s',
+                                     ids[0], ids[-1], e)
+                        break
+
+                    logger.warning('Batch %s..%s failed (%s), attempt %s',
+                                   ids[0], ids[-1], e, attempt + 1)
+                    if attempt < retries:
+                        await asyncio.sleep(backoff * 2 ** attempt)
+
+            failed.extend(batch)
+
+    batches = [targets[i:i + batch_size]
+               for i in range(0, len(targets), batch_size)]
+    await asyncio.gather(*(register(batch) for batch in batches))
+
+    return registered, failed
@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
 
 import aiohttp
-import json
+import asyncio
 import logging
 
 from aiohttp.client import ClientTimeout
 
+from ..metrics import HTTP_REQUESTS, HTTP_DURATION
+from ..codec import get_codec
+
 
 class APIError(Exception):
-    pass
+    def __init__(self, message, status=None):
+        super(APIError, self).__init__(message)
+        self.status = status
+
+
+def fiql_quote(value):
+    '''
+    value as a quoted FIQL argument, so that reserved characters like
+    , ( ) ; or spaces in controller ids do not change the query
+    '''
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
 
 
 class MIClient(object):
@@ -29,25 +42,25 @@ class MIClient(object):
 
     def __init__(self, session, timeout=10, **kwargs):
         self.logger = logging.getLogger('hbloader')
-        self.logger.info('')
+        self.logger.debug('')
 
         self.session = session
         self.host = '{}:{}'.format(kwargs['ip'],kwargs['port'])
         self.ssl = kwargs['ssl']
         auth_str = '{}\\{}'.format(kwargs['tenant_id'], kwargs['login'])
         self.auth = aiohttp.BasicAuth(auth_str, kwargs['password'])
-        self.logger.debug('auth_str: {}\n{}\n'.format(auth_str, self.auth))
         self.tenant = kwargs['tenant_id']
-        self.target_name = kwargs['target_name']
-        self.controller_id = kwargs['controller_id']
+        self.target_name = kwargs.get('target_name', '')
+        self.controller_id = kwargs.get('controller_id', '')
         self.timeout = timeout
         self.headers = {}
+        self.codec = get_codec(kwargs.get('json_codec', 'auto'))
 
     async def __call__(self):
         """
         Get controller data
         """
-        self.logger.info('')
+        self.logger.debug('')
         return await self.get_resource('/rest/v1/targets')
 
     async def register_target(self):
@@ -55,7 +68,7 @@ class MIClient(object):
         Manually register target on controller 
         '''
 
-        self.logger.info('')
+        self.logger.debug('')
 
         data = {}
         data['controllerId'] = self.controller_id
@@ -64,10 +77,96 @@ class MIClient(object):
         post_data = []
         post_data.append(data)
 
-        self.logger.debug("post_data {}".format(post_data))
-
         await self.post_resource('/rest/v1/targets', post_data)
 
+    async def register_targets(self, targets):
+        '''
+        Register several targets with a single request.
+
+        Args:
+            targets(list): dicts with 'controllerId' and 'name'
+
+        Returns:
+            List of created targets including their securityToken
+        '''
+        return await self.post_resource('/rest/v1/targets', list(targets))
+
+    async def find_targets(self, controller_ids):
+        '''
+        Look up existing targets by controller id.
+
+        Returns:
+            List of found targets including their securityToken
+        '''
+        query = 'controllerId=in=({})'.format(
+                ','.join(fiql_quote(i) for i in controller_ids))
+        result = await self.get_resource(
+                '/rest/v1/targets', {'q': query, 'limit': len(controller_ids)})
+        return result['content']
+
+    async def iter_collection(self, api_path, q=None, sort=None,
+                              page_size=100, **kwargs):
+        '''
+        Iterate over all items of a paged collection.
+
+        The next page is requested while the current one is consumed, so
+        at most two pages are held in memory.
+
+        Args:
+            api_path(str): REST API path of the collection
+        Keyword Args:
+            q: FIQL filter, e.g. 'updateStatus==error'
+            sort: sort order, e.g. 'id:ASC'
+            page_size: items per request (HawkBit allows up to 500)
+            kwargs: keyword args used for replacing items in the API path
+
+        Yields:
+            Collection items
+        '''
+        params = {'limit': page_size}
+        if q:
+            params['q'] = q
+        if sort:
+            params['sort'] = sort
+
+        def fetch(offset):
+            return asyncio.ensure_future(self.get_resource(
+                    api_path, dict(params, offset=offset), **kwargs))
+
+        offset = 0
+        pending = fetch(offset)
+        try:
+            while pending is not None:
+                page = await pending
+                pending = None
+                content = page.get('content', [])
+                offset += len(content)
+                if content and offset < page.get('total', 0):
+                    pending = fetch(offset)
+
+                for item in content:
+                    yield item
+                del page, content
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def targets(self, q=None, **kwargs):
+        return self.iter_collection('/rest/v1/targets', q, **kwargs)
+
+    def actions(self, q=None, **kwargs):
+        return self.iter_collection('/rest/v1/actions', q, **kwargs)
+
+    def target_actions(self, controller_id, q=None, **kwargs):
+        return self.iter_collection('/rest/v1/targets/{target}/actions', q,
+                                    target=controller_id, **kwargs)
+
+    def distribution_sets(self, q=None, **kwargs):
+        return self.iter_collection('/rest/v1/distributionsets', q, **kwargs)
+
+    def software_modules(self, q=None, **kwargs):
+        return self.iter_collection('/rest/v1/softwaremodules', q, **kwargs)
+
     #async def  get_target_details(self, )
     #   return await self.get_resource('/rest/v1/targets/{controllerId}')
 
@@ -81,7 +180,7 @@ class MIClient(object):
         Returns:
             Expanded API URL with protocol (http/https) and host prepended
         """
-        self.logger.info('')
+        self.logger.debug('')
         protocol = 'https' if self.ssl else 'http'
         return '{protocol}://api.{host}{api_path}'.format(
             protocol=protocol, host=self.host, api_path=api_path)
@@ -100,29 +199,27 @@ class MIClient(object):
         Returns:
             Response JSON data
         """
-        self.logger.info('')
+        self.logger.debug('')
         get_headers = {
             'Accept': 'application/json',
             **self.headers
         }
-        self.logger.info(get_headers)
-        
+
         url = self.build_api_url(
                 api_path.format(
                     tenant=self.tenant,
                     controllerId=self.controller_id,
                     **kwargs))
 
-        self.logger.info(self.auth)
-
-        self.logger.debug('GET {} {}'.format(url, get_headers))
-        async with self.session.get(url, headers=get_headers,
-                                    params=query_params,
-                                    auth=self.auth,
-                                    timeout=ClientTimeout(self.timeout)) as resp:
-            await self.check_http_status(resp)
-            json = await resp.json()
-            return json
+        self.logger.debug('GET %s', url)
+        with HTTP_DURATION.time(api='mi', method='GET'):
+            async with self.session.get(url, headers=get_headers,
+                                        params=query_params,
+                                        auth=self.auth,
+                                        timeout=ClientTimeout(self.timeout)) as resp:
+                await self.check_http_status(resp)
+                data = await self.codec.read(resp, 'mi')
+        return data
 
 
     async def post_resource(self, api_path, data, **kwargs):
@@ -134,8 +231,11 @@ class MIClient(object):
             data: JSON data for POST request
         Keyword Args:
             kwargs: keyword args used for replacing items in the API path
+
+        Returns:
+            Response JSON data, if any
         """
-        self.logger.info('')
+        self.logger.debug('')
 
         post_headers = {
             'Content-Type': 'application/json',
@@ -146,24 +246,28 @@ class MIClient(object):
                     tenant=self.tenant,
                     controllerId=self.controller_id,
                     **kwargs))
-        self.logger.debug('POST {}'.format(url))
+        self.logger.debug('POST %s', url)
 
-        async with self.session.post(url, headers=post_headers,
-                                     data=json.dumps(data),
-                                     auth=self.auth,
-                                     timeout=ClientTimeout(self.timeout)) as resp:
-            await self.check_http_status(resp)
+        with HTTP_DURATION.time(api='mi', method='POST'):
+            async with self.session.post(url, headers=post_headers,
+                                         data=self.codec.write(data, 'mi'),
+                                         auth=self.auth,
+                                         timeout=ClientTimeout(self.timeout)) as resp:
+                await self.check_http_status(resp)
+                return await self.codec.read(resp, 'mi')
 
 
     async def check_http_status(self, resp):
         """Log API error message."""
 
-        self.logger.info('')
-        
+        self.logger.debug('')
+
+        HTTP_REQUESTS.inc(api='mi', method=resp.method, status=resp.status)
+
         if resp.status not in [200, 201]:
             error_description = await resp.text()
             if error_description:
-                self.logger.debug('API error: {}'.format(error_description))
+                self.logger.debug('API error: %s', error_description)
 
             if resp.status in self.error_responses:
                 reason = self.error_responses[resp.status]
@@ -171,4 +275,4 @@ class MIClient(object):
                 reason = resp.reason
 
             raise APIError('{status}: {reason}'.format(
-                status=resp.status, reason=reason))
+                status=resp.status, reason=reason), resp.status)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import logging
+import time
+
+from aiohttp.client_exceptions import ClientError
+
+from .client import APIError
+
+# latest action status -> rollout phase
+PHASES = {
+    'scheduled': 'waiting',
+    'retrieved': 'downloading',
+    'download': 'downloading',
+    'downloaded': 'downloaded',
+    'running': 'installing',
+    'warning': 'installing',
+    'finished': 'done',
+    'error': 'failed',
+    'canceling': 'canceled',
+    'canceled': 'canceled',
+}
+
+# target update status -> phase, if no action needs to be looked at;
+# failed targets are looked up once for the error message
+SETTLED = {
+    'in_sync': 'done',
+    'registered': 'idle',
+    'unknown': 'idle',
+}
+
+TargetState = collections.namedtuple(
+    'TargetState', 'controller_id modified phase action_id since message')
+
+
+class FleetStatus(object):
+    """
+    Rollout state of many targets, refreshed by a fixed number of workers
+    with one Management API request in flight each.
+
+    Targets are listed page by page; the latest action of a pending target
+    is requested on every refresh, since the status of an action changes
+    without touching its target. Other targets are only requested again
+    when they changed since the previous refresh.
+    """
+
+    def __init__(self, mi, q=None, concurrency=8, page_size=500):
+        self.logger = logging.getLogger('hbloader')
+        self.mi = mi
+        self.q = q
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.states = {}
+        self.requests = 0
+
+    async def refresh(self):
+        '''
+        Update the state of all targets matching the filter
+
+        Returns:
+            Number of targets whose actions were requested
+        '''
+        self.requests = 0
+        seen = set()
+        pending = 0
+
+        # targets are queued while listed, a full queue pauses the listing
+        queue = asyncio.Queue(self.concurrency * 2)
+        workers = [asyncio.ensure_future(self.update_targets(queue))
+                   for _ in range(self.concurrency)]
+        try:
+            async for target in self.mi.targets(self.q,
+                                                page_size=self.page_size):
+                if self.settle(target, seen):
+                    continue
+                pending += 1
+                await queue.put((target['controllerId'],
+                                 target.get('lastModifiedAt')))
+
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        for controller_id in set(self.states) - seen:
+            del self.states[controller_id]
+
+        return pending
+
+    def settle(self, target, seen):
+        '''
+        Update the state of target from the listing if possible
+
+        Returns:
+            False if its actions have to be requested
+        '''
+        controller_id = target['controllerId']
+        seen.add(controller_id)
+        modified = target.get('lastModifiedAt')
+        update_status = target.get('updateStatus')
+        cached = self.states.get(controller_id)
+        if cached is not None and cached.modified == modified and \
+                update_status != 'pending':
+            return True
+
+        phase = SETTLED.get(update_status)
+        if phase is None:
+            return False
+        self.states[controller_id] = TargetState(
+            controller_id, modified, phase, None, modified, '')
+        return True
+
+    async def update_targets(self, queue):
+        '''
+        Worker: request the state of queued targets until None is queued
+        '''
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            controller_id, modified = item
+            try:
+                state = await self.fetch_state(controller_id, modified)
+            except (APIError, ClientError, asyncio.TimeoutError) as e:
+                self.logger.warning('%s: %s', controller_id, e)
+                continue
+            self.states[controller_id] = state
+
+    async def fetch_state(self, controller_id, modified):
+        '''
+        Phase of the latest action of a target from its newest status entry
+        '''
+        self.requests += 1
+        actions = await self.mi.get_resource(
+                '/rest/v1/targets/{target}/actions',
+                {'limit': 1, 'sort': 'id:DESC'}, target=controller_id)
+        if not actions.get('content'):
+            return TargetState(controller_id, modified, 'idle', None,
+                               modified, '')
+
+        action = actions['content'][0]
+        self.requests += 1
+        statuses = await self.mi.get_resource(
+                '/rest/v1/targets/{target}/actions/{action}/status',
+                {'limit': 1, 'sort': 'id:DESC'},
+                target=controller_id, action=action['id'])
+
+        phase, message = 'waiting', ''
+        if statuses.get('content'):
+            status = statuses['content'][0]
+            phase = PHASES.get(status.get('type'), 'waiting')
+            message = '; '.join(status.get('messages') or [])
+
+        return TargetState(controller_id, modified, phase, action['id'],
+                           action.get('createdAt'), message)
+
+    def summary(self):
+        '''
+        Number of targets per phase
+        '''
+        return collections.Counter(s.phase for s in self.states.values())
+
+    def slowest(self, n=10, now=None):
+        '''
+        Targets with the longest running actions which are not finished
+
+        Returns:
+            List of (seconds, TargetState)
+        '''
+        now = now or time.time()
+        running = [((now * 1000 - s.since) / 1000, s)
+                   for s in self.states.values()
+                   if s.phase not in ('done', 'failed', 'canceled', 'idle')
+                   and s.since]
+        running.sort(key=lambda item: item[0], reverse=True)
+        return running[:n]
+
+    def failed(self):
+        return sorted((s for s in self.states.values() if s.phase == 'failed'),
+                      key=lambda s: s.controller_id)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+Push notifications which wake up polling early.
+
+A notification service next to HawkBit (e.g. a bridge subscribed to the
+DMF exchange) tells the target that something changed for it, either
+over a WebSocket (ws:// or wss:// URL) or as the response to a long-poll
+GET request (http:// or https:// URL, 204 when nothing happened). Any
+message triggers an immediate base poll; JSON messages with a
+controllerId of another target are ignored.
+'''
+
+import asyncio
+import json
+import logging
+
+import aiohttp
+from aiohttp.client import ClientTimeout
+
+from .metrics import REGISTRY
+
+NOTIFICATIONS = REGISTRY.counter(
+    'hbloader_notifications_total',
+    'Push notifications received', ('transport',))
+
+
+class Notifier(object):
+    """
+    Keeps a push channel open and reconnects with backoff.
+
+    ``connected`` tells whether notifications can currently arrive,
+    ``wait(timeout)`` returns early when one did.
+
+    A long-poll request still outstanding after ``accept`` seconds has
+    been accepted by the server and counts as connected.
+    """
+
+    def __init__(self, session, url, controller_id, headers=None,
+                 reconnect=5, max_reconnect=300, hold=300, accept=2):
+        self.logger = logging.getLogger('hbloader')
+        self.session = session
+        self.url = url
+        self.controller_id = controller_id
+        self.headers = headers or {}
+        self.reconnect = reconnect
+        self.max_reconnect = max_reconnect
+        # longest time a long-poll request is held open by the server
+        self.hold = hold
+        self.accept = accept
+        self.connected = False
+        self.wakeup = asyncio.Event()
+
+    async def run(self):
+        '''
+        Listen until cancelled
+        '''
+        backoff = self.reconnect
+        while True:
+            try:
+                if self.url.startswith(('ws://', 'wss://')):
+                    await self.listen_websocket()
+                else:
+                    await self.long_poll()
+                backoff = self.reconnect
+
+            except asyncio.CancelledError:
+                self.connected = False
+                raise
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                self.logger.warning('Notification channel failed: %s', e)
+
+            self.connected = False
+            self.logger.info('Notification channel reconnects in %s seconds',
+                             backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_reconnect)
+
+    async def listen_websocket(self):
+        async with self.session.ws_connect(self.url, headers=self.headers,
+                                           heartbeat=30) as ws:
+            self.connect()
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    self.notify(msg.data, 'websocket')
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    self.notify(msg.data.decode('utf-8', 'replace'),
+                                'websocket')
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    raise aiohttp.ClientConnectionError(str(ws.exception()))
+
+    async def long_poll(self):
+        timeout = ClientTimeout(total=self.hold + 30)
+        while True:
+            request = asyncio.ensure_future(self.session.get(
+                    self.url, headers=self.headers, timeout=timeout))
+            try:
+                # the server holds the request until something happens,
+                # which may take up to hold seconds
+                done, _ = await asyncio.wait({request}, timeout=self.accept)
+                if not done and not self.connected:
+                    self.connect()
+                resp = await request
+            except asyncio.CancelledError:
+                request.cancel()
+                raise
+
+            async with resp:
+                if resp.status >= 400:
+                    raise aiohttp.ClientResponseError(
+                            resp.request_info, resp.history,
+                            status=resp.status, message=resp.reason)
+                if not self.connected:
+                    self.connect()
+                if resp.status != 204:
+                    self.notify(await resp.text(), 'longpoll')
+
+    def connect(self):
+        '''
+        Channel is (re)established: poll once, an assignment may have
+        been made while no notification could arrive
+        '''
+        self.connected = True
+        self.logger.info('Notification channel connected')
+        self.wakeup.set()
+
+    def notify(self, message, transport):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            data = None
+
+        if isinstance(data, dict) and \
+                data.get('controllerId', self.controller_id) != self.controller_id:
+            return
+
+        self.logger.debug('Notification: %s', message)
+        NOTIFICATIONS.inc(transport=transport)
+        self.wakeup.set()
+
+    async def wait(self, timeout):
+        '''
+        Sleep up to timeout seconds.
+
+        Returns:
+            True if woken up by a notification
+        '''
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.wakeup.clear()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import logging
+from pathlib import Path
+
+from aiohttp.client_exceptions import ClientError
+
+from .ddi.client import APIError
+from .metrics import PHASE_DURATION, RETRIES
+
+
+class Outbox(object):
+    """
+    Disk backed queue for DDI feedback and configData requests.
+
+    Requests are stored in ``directory`` (one JSON file per request) and
+    sent in order by a background task, so a slow or broken link never
+    stalls the caller. Pending requests survive a restart.
+
+    Requests with the same key (e.g. one action) are deduplicated: a newer
+    intermediate request replaces a pending intermediate one and a final
+    request replaces everything pending for the key.
+    """
+
+    def __init__(self, directory, batch_size=10, min_delay=1, max_delay=300):
+        self.logger = logging.getLogger('hbloader')
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+        self.entries = []
+        self.seq = 0
+        self.pending = asyncio.Event()
+        # set when requests are rejected with 401/403 until the security
+        # token has been refreshed
+        self.unauthorized = False
+        self.refreshed = asyncio.Event()
+        self.load()
+
+    def load(self):
+        '''
+        Pick up requests left over from a previous run
+        '''
+        for path in sorted(self.directory.glob('*.json')):
+            try:
+                with path.open('r') as entry_file:
+                    entry = json.load(entry_file)
+            except (OSError, ValueError):
+                self.logger.warning('Dropping broken outbox entry {}'.format(path))
+                path.unlink()
+                continue
+
+            entry['path'] = path
+            self.entries.append(entry)
+            self.seq = max(self.seq, entry['seq'])
+
+        if self.entries:
+            self.logger.info('Outbox: {} pending requests'.format(len(self.entries)))
+            self.pending.set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def closing(self, key):
+        '''
+        True while a request closing key (e.g. an action) is pending
+        '''
+        return any(e['final'] and e['key'] == key for e in self.entries)
+
+    def put(self, method, api_path, data, key=None, final=False, **kwargs):
+        '''
+        Queue request, returns immediately.
+
+        Args:
+            method(str): 'POST' or 'PUT'
+            api_path(str): REST API path
+            data: JSON data of the request
+        Keyword Args:
+            key: deduplication key, e.g. resource of the action
+            final: request closes the action
+            kwargs: keyword args used for replacing items in the API path
+        '''
+        if key is not None:
+            same = [e for e in self.entries if e['key'] == key]
+            if not final and any(e['final'] for e in same):
+                self.logger.debug('Outbox: {} already closed, dropped'.format(key))
+                return
+            for entry in same:
+                if final or not entry['final']:
+                    self.remove(entry)
+
+        self.seq += 1
+        entry = {
+            'seq': self.seq,
+            'method': method,
+            'api_path': api_path,
+            'data': data,
+            'kwargs': kwargs,
+            'key': key,
+            'final': final,
+        }
+
+        path = self.directory.joinpath('{:012d}.json'.format(self.seq))
+        tmp = path.with_suffix('.tmp')
+        with tmp.open('w') as entry_file:
+            json.dump(entry, entry_file)
+        tmp.replace(path)
+
+        entry['path'] = path
+        self.entries.append(entry)
+        self.pending.set()
+
+    def remove(self, entry):
+        if entry not in self.entries:
+            return
+        self.entries.remove(entry)
+        try:
+            entry['path'].unlink()
+        except FileNotFoundError:
+            pass
+
+    async def run(self, ddi):
+        """
+        Send queued requests in order, back off while the server
+        is not reachable.
+        """
+        delay = self.min_delay
+
+        while True:
+            await self.pending.wait()
+
+            if await self.flush(ddi):
+                delay = self.min_delay
+                if not self.entries:
+                    self.pending.clear()
+                continue
+
+            if self.unauthorized:
+                # retry as soon as the token is refreshed, at the latest
+                # after max_delay in case the rejection was transient
+                self.logger.info('Outbox: {} pending, waiting for a new '
+                                 'security token'.format(len(self.entries)))
+                try:
+                    await asyncio.wait_for(self.refreshed.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.refreshed.clear()
+                continue
+
+            self.logger.info('Outbox: {} pending, retry in {}s'.format(
+                len(self.entries), delay))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    def token_refreshed(self):
+        '''
+        Retry requests rejected because of an outdated security token
+        '''
+        if self.unauthorized:
+            self.refreshed.set()
+
+    async def flush(self, ddi):
+        """
+        Send one batch. Returns False if the link is down or the
+        security token is not accepted.
+        """
+        self.unauthorized = False
+        for entry in list(self.entries[:self.batch_size]):
+            send = ddi.post_resource if entry['method'] == 'POST' \
+                else ddi.put_resource
+            try:
+                with PHASE_DURATION.time(phase='feedback'):
+                    await send(entry['api_path'], entry['data'], **entry['kwargs'])
+
+            except APIError as e:
+                if e.status is None or e.status >= 500 or e.status == 429:
+                    self.logger.warning('Outbox: send failed: {}'.format(e))
+                    RETRIES.inc(operation='feedback')
+                    return False
+                if e.status in (401, 403):
+                    # keep the request, the token was probably rotated
+                    self.logger.warning('Outbox: send rejected: {}'.format(e))
+                    self.unauthorized = True
+                    return False
+                # server rejects request, retrying will not help
+                self.logger.error('Outbox: dropping {} {}: {}'.format(
+                    entry['method'], entry['api_path'], e))
+
+            except (ClientError, asyncio.TimeoutError, OSError) as e:
+                self.logger.warning('Outbox: send failed: {}'.format(e))
+                RETRIES.inc(operation='feedback')
+                return False
+
+            self.remove(entry)
+
+        return True
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+'''
+Admission control before a deployment downloads anything.
+
+Artifact sizes come from the deployment, image sizes from the registry
+manifest of the image. Both are compared with the free space of the
+bundle directory and of Docker's data root; if they do not fit, old
+bundle files and images are evicted first and the deployment is
+rejected only if that is not enough.
+'''
+
+import asyncio
+import logging
+import platform
+import re
+import shutil
+from pathlib import Path
+
+from aiohttp.client import ClientTimeout
+from aiohttp.client_exceptions import ClientError
+
+from .decompress import detect
+
+MB = 1024 * 1024
+
+# size of decompressed artifacts is not known, assume this ratio
+DECOMPRESSION_RATIO = 4
+# layers are stored unpacked, registries report compressed sizes
+LAYER_EXPANSION = 3
+
+MANIFEST_TYPES = ', '.join((
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+))
+
+# platform.machine() -> (architecture, variant) in manifest lists
+ARCHITECTURES = {
+    'x86_64': ('amd64', None),
+    'aarch64': ('arm64', None),
+    'armv7l': ('arm', 'v7'),
+    'armv6l': ('arm', 'v6'),
+}
+
+
+class PreflightError(Exception):
+    pass
+
+
+def human(size):
+    if abs(size) < 1024:
+        return '{} B'.format(size)
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if abs(size) < 1024 or unit == 'GiB':
+            return '{:.1f} {}'.format(size, unit)
+
+
+def free_space(path):
+    '''
+    Free bytes on the file system of path, or of its nearest accessible
+    parent (e.g. /var/lib for /var/lib/docker)
+    '''
+    path = Path(path)
+    for candidate in [path] + list(path.parents):
+        try:
+            return shutil.disk_usage(str(candidate)).free
+        except OSError:
+            continue
+    return None
+
+
+def memory_available():
+    '''
+    MemAvailable from /proc/meminfo in bytes, None if unknown
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def parse_image(uri):
+    '''
+    (registry, repository, tag or digest) of an image reference, e.g.
+    nginx -> ('registry-1.docker.io', 'library/nginx', 'latest')
+    '''
+    name, _, digest = uri.partition('@')
+    head, _, tail = name.rpartition('/')
+    tag = 'latest'
+    if ':' in tail:
+        tail, tag = tail.split(':', 1)
+    name = '{}/{}'.format(head, tail) if head else tail
+
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        registry, repository = first, rest
+    else:
+        registry, repository = 'registry-1.docker.io', name
+        if '/' not in repository:
+            repository = 'library/' + repository
+
+    return registry, repository, digest or tag
+
+
+class Preflight(object):
+    """
+    Checks whether a deployment fits on the device.
+
+    ``reserve`` bytes are kept free on every file system, downloads
+    wait while less than ``min_memory`` bytes of memory are available.
+    """
+
+    def __init__(self, session, gc, reserve=100 * MB, min_memory=64 * MB,
+                 timeout=10):
+        self.logger = logging.getLogger('hbloader')
+        self.session = session
+        self.gc = gc
+        self.reserve = reserve
+        self.min_memory = min_memory
+        self.timeout = ClientTimeout(timeout)
+
+    def artifacts_size(self, payloads, decompress=True):
+        '''
+        Bytes needed in the bundle directory for the artifacts and block
+        indexes of a deployment
+        '''
+        total = 0
+        for artifact, index in payloads:
+            size = artifact.size or 0
+            if decompress and detect(artifact.filename) is not None:
+                size *= DECOMPRESSION_RATIO
+            total += size
+            if index is not None:
+                total += index.size or 0
+        return total
+
+    def memory_shortage(self):
+        '''
+        Message if less than min_memory is available, else None
+        '''
+        available = memory_available()
+        if available is None or available >= self.min_memory:
+            return None
+        return '{} of memory available, {} required'.format(
+            human(available), human(self.min_memory))
+
+    async def check_space(self, what, path, needed, docker=False):
+        '''
+        Make room for needed bytes at path or raise PreflightError.
+
+        Returns:
+            Free bytes left after the deployment
+        '''
+        free = free_space(path)
+        if free is None:
+            return None
+        free -= self.reserve
+
+        if needed > free:
+            self.logger.info('%s needs %s in %s, %s free, evicting',
+                             what, human(needed), path, human(free))
+            await self.gc.make_room(bundle=0 if docker else needed - free,
+                                    docker=docker)
+            free = (free_space(path) or 0) - self.reserve
+
+        if needed > free:
+            raise PreflightError(
+                'Not enough space for {} in {}: {} needed, {} free '
+                'after cleanup ({} reserved)'.format(
+                    what, path, human(needed), human(max(free, 0)),
+                    human(self.reserve)))
+        return free - needed
+
+    async def check_artifacts(self, dl_dir, payloads, decompress=True):
+        needed = self.artifacts_size(payloads, decompress)
+        return await self.check_space('artifacts', dl_dir, needed)
+
+    async def check_image(self, uri, get_docker_client):
+        '''
+        Make room for image uri in Docker's data root unless it is
+        already there. An image whose size cannot be determined, e.g.
+        because the Docker daemon is down, passes.
+        '''
+        loop = asyncio.get_event_loop()
+        try:
+            root = await loop.run_in_executor(
+                    None, self.docker_root, uri, get_docker_client)
+        except Exception as e:
+            self.logger.warning('Preflight cannot query Docker: %s', e)
+            return None
+        if root is None:
+            return None
+
+        size = await self.image_size(uri)
+        if size is None:
+            return None
+        return await self.check_space('image {}'.format(uri), root,
+                                      size * LAYER_EXPANSION, docker=True)
+
+    @staticmethod
+    def docker_root(uri, get_docker_client):
+        '''
+        Docker's data root, None if the image is present already
+        '''
+        from docker.errors import ImageNotFound
+        docker_client = get_docker_client()
+        try:
+            docker_client.images.get(uri)
+            return None
+        except ImageNotFound:
+            pass
+        return docker_client.info().get('DockerRootDir', '/var/lib/docker')
+
+    async def image_size(self, uri):
+        '''
+        Compressed size of config and layers of image uri for this
+        device's platform, from the registry. None if unknown.
+        '''
+        registry, repository, reference = parse_image(uri)
+        base = 'https://{}/v2/{}'.format(registry, repository)
+        try:
+            token = None
+            manifest, token = await self.get_manifest(base, reference, token)
+
+            if 'manifests' in manifest:
+                digest = self.select_platform(manifest['manifests'])
+                if digest is None:
+                    self.logger.warning('No manifest of %s for %s', uri,
+                                        platform.machine())
+                    return None
+                manifest, token = await self.get_manifest(base, digest, token)
+
+            return manifest['config'].get('size', 0) + sum(
+                layer.get('size', 0) for layer in manifest['layers'])
+
+        except (ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            self.logger.warning('Size of image %s unknown: %s', uri, e)
+            return None
+
+    async def get_manifest(self, base, reference, token):
+        url = '{}/manifests/{}'.format(base, reference)
+        headers = {'Accept': MANIFEST_TYPES}
+        if token:
+            headers['Authorization'] = 'Bearer {}'.format(token)
+
+        async with self.session.get(url, headers=headers,
+                                    timeout=self.timeout) as resp:
+            if resp.status == 401 and token is None:
+                challenge = resp.headers.get('WWW-Authenticate', '')
+                token = await self.get_token(challenge)
+                return await self.get_manifest(base, reference, token)
+            resp.raise_for_status()
+            return await resp.json(content_type=None), token
+
+    async def get_token(self, challenge):
+        '''
+        Anonymous pull token for a Bearer challenge
+        '''
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop('realm', None)
+        if not challenge.startswith('Bearer') or not realm:
+            raise ValueError('Unsupported registry authentication')
+
+        async with self.session.get(realm, params=params,
+                                    timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            data = await resp.json(content_type=None)
+        return data.get('token') or data['access_token']
+
+    @staticmethod
+    def select_platform(manifests):
+        architecture, variant = ARCHITECTURES.get(
+                platform.machine(), (platform.machine(), None))
+        for entry in manifests:
+            wanted = entry.get('platform', {})
+            if wanted.get('os', 'linux') == 'linux' and \
+                    wanted.get('architecture') == architecture and \
+                    (variant is None or wanted.get('variant') in (None, variant)):
+                return entry['digest']
+        return None
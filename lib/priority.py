@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+CPU and I/O scheduling class of the agent's workers.
+
+Hashing, block matching, image loading and installer subprocesses should
+yield to the device's production workloads. On Linux nice values and
+I/O priorities belong to threads, so they are set in the worker threads
+of the event loop's default executor and in subprocesses before exec.
+The event loop itself keeps its priority, polling and feedback are not
+delayed by a busy device.
+'''
+
+import asyncio
+import ctypes
+import functools
+import logging
+import os
+import platform
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import process
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+IOPRIO_CLASSES = {
+    'best-effort': 2,
+    'idle': 3,
+}
+
+# ioprio_set syscall number by machine
+IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv6l': 314,
+    'armv7l': 314,
+}
+
+
+def set_nice(nice):
+    '''
+    Lower CPU priority of the calling thread to nice
+    '''
+    current = os.getpriority(os.PRIO_PROCESS, 0)
+    if nice > current:
+        os.nice(nice - current)
+
+
+def set_io_priority(io_class, level=7):
+    '''
+    I/O scheduling class of the calling thread, see ionice(1).
+    level (0 highest - 7 lowest) applies to best-effort only.
+    '''
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError('ioprio_set unknown on {}'.format(platform.machine()))
+
+    data = level if io_class == 'best-effort' else 0
+    value = (IOPRIO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT) | data
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def join_cgroup(path):
+    '''
+    Move the agent into the cgroup v2 directory path, e.g. a delegated
+    hbloader.slice whose CPU and I/O weights are set by systemd
+    '''
+    with Path(path).joinpath('cgroup.procs').open('w') as procs:
+        procs.write(str(os.getpid()))
+
+
+def lower(nice, io_class, logger=None):
+    '''
+    Lower the scheduling class of the calling thread, e.g. as initializer
+    of a worker thread or before exec of a subprocess.
+
+    Returns:
+        List of applied settings, failures are logged with logger if given
+    '''
+    applied = []
+
+    if nice:
+        try:
+            set_nice(nice)
+            applied.append('nice {}'.format(nice))
+        except OSError as e:
+            if logger:
+                logger.warning('Cannot set nice value %s: %s', nice, e)
+
+    if io_class:
+        try:
+            set_io_priority(io_class)
+            applied.append('ionice {}'.format(io_class))
+        except OSError as e:
+            if logger:
+                logger.warning('Cannot set I/O class %s: %s', io_class, e)
+
+    return applied
+
+
+def apply(**kwargs):
+    """
+    Apply the configured scheduling class to the agent's workers: the
+    default executor of the running event loop and subprocesses started
+    by lib.process. Image pulls are done by the Docker daemon and keep
+    its priority.
+
+    Keyword Args:
+        priority_nice: nice value (1-19), 0 leaves CPU priority alone
+        priority_ionice: 'idle', 'best-effort' (lowest level) or '' to
+            leave I/O priority alone
+        priority_cgroup: cgroup v2 directory the whole agent joins,
+            '' for none
+
+    Returns:
+        List of applied settings
+    """
+    logger = logging.getLogger('hbloader')
+
+    nice = int(kwargs.get('priority_nice', 10) or 0)
+    io_class = kwargs.get('priority_ionice', 'best-effort')
+    if io_class and io_class not in IOPRIO_CLASSES:
+        logger.warning('Unknown I/O class %s, use one of %s', io_class,
+                       ', '.join(IOPRIO_CLASSES))
+        io_class = ''
+
+    applied = []
+    if nice or io_class:
+        executor = ThreadPoolExecutor(
+                thread_name_prefix='hbloader-worker',
+                initializer=lower, initargs=(nice, io_class))
+        asyncio.get_event_loop().set_default_executor(executor)
+        process.preexec_fn = functools.partial(lower, nice, io_class)
+        # run once more in a worker to report what could be applied
+        applied = executor.submit(lower, nice, io_class, logger).result()
+
+    cgroup = kwargs.get('priority_cgroup', '')
+    if cgroup:
+        try:
+            join_cgroup(cgroup)
+            applied.append('cgroup {}'.format(cgroup))
+        except OSError as e:
+            logger.warning('Cannot join cgroup %s: %s', cgroup, e)
+
+    if applied:
+        logger.info('Scheduling class of workers: %s', ', '.join(applied))
+    return applied
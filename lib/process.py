@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import logging
+import os
+from pathlib import Path
+
+ProcessResult = collections.namedtuple('ProcessResult', 'returncode output')
+
+# called in the child before exec, e.g. to lower its scheduling class
+# (see priority.apply)
+preexec_fn = None
+
+
+class ProcessError(Exception):
+    def __init__(self, command, returncode, output=''):
+        super(ProcessError, self).__init__('{} exited with {}: {}'.format(
+            ' '.join(command), returncode, output[-500:]))
+        self.returncode = returncode
+        self.output = output
+
+
+async def run(command, cwd=None, timeout=300, check=True, keep_lines=200):
+    """
+    Run command without blocking the event loop.
+
+    Output (stdout and stderr) is logged line by line while the command
+    runs. On timeout or cancellation the process is terminated, and
+    killed if it does not exit within a few seconds.
+
+    Args:
+        command(list): program and arguments
+    Keyword Args:
+        cwd: working directory
+        timeout: seconds until the process is terminated, None for no limit
+        check: raise ProcessError on a non-zero exit code
+        keep_lines: last lines of output kept for the result
+
+    Returns:
+        ProcessResult(returncode, output)
+    """
+    logger = logging.getLogger('hbloader')
+    logger.info('Running %s', ' '.join(str(arg) for arg in command))
+
+    process = await asyncio.create_subprocess_exec(
+            *[str(arg) for arg in command],
+            cwd=None if cwd is None else str(cwd),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            preexec_fn=preexec_fn)
+
+    lines = collections.deque(maxlen=keep_lines)
+
+    async def capture():
+        async for line in process.stdout:
+            line = line.decode('utf-8', 'replace').rstrip()
+            lines.append(line)
+            logger.debug('[%s] %s', command[0], line)
+        return await process.wait()
+
+    try:
+        returncode = await asyncio.wait_for(capture(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        await stop(process)
+        raise
+
+    output = '\n'.join(lines)
+    if check and returncode != 0:
+        raise ProcessError(command, returncode, output)
+    return ProcessResult(returncode, output)
+
+
+async def stop(process, grace=5):
+    if process.returncode is not None:
+        return
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), grace)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def write_atomic(path, text):
+    '''
+    Replace file content so readers never see a partial file
+    '''
+    path = Path(path)
+    tmp = path.with_name('.{}.tmp'.format(path.name))
+    with tmp.open('w') as tmp_file:
+        tmp_file.write(text)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    tmp.replace(path)
+
+
+class SystemdUnits(object):
+    """
+    Installs and starts systemd user units.
+
+    Units activated within ``delay`` seconds of each other share a single
+    ``daemon-reload`` and a single ``enable --now`` call.
+    """
+
+    def __init__(self, unit_dir, delay=0.5, timeout=60):
+        self.logger = logging.getLogger('hbloader')
+        self.unit_dir = Path(unit_dir)
+        self.delay = delay
+        self.timeout = timeout
+        self.pending = {}
+        self.flusher = None
+
+    def write(self, name, text):
+        '''
+        Write unit file name atomically
+        '''
+        self.unit_dir.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.unit_dir.joinpath(name), text)
+
+    async def activate(self, name):
+        '''
+        Reload systemd and enable and start unit name, together with all
+        units activated at about the same time.
+        '''
+        loop = asyncio.get_event_loop()
+        if name not in self.pending:
+            self.pending[name] = loop.create_future()
+        waiter = self.pending[name]
+
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush())
+
+        # several callers may wait for the same unit
+        return await asyncio.shield(waiter)
+
+    async def flush(self):
+        await asyncio.sleep(self.delay)
+        batch, self.pending = self.pending, {}
+        self.flusher = None
+
+        names = sorted(batch)
+        self.logger.info('Activating units %s', ', '.join(names))
+        try:
+            await run(['systemctl', '--user', 'daemon-reload'],
+                      timeout=self.timeout)
+            await run(['systemctl', '--user', 'enable', '--now'] + names,
+                      timeout=self.timeout)
+        except asyncio.CancelledError:
+            for waiter in batch.values():
+                waiter.cancel()
+            raise
+        except Exception as e:
+            for waiter in batch.values():
+                if not waiter.done():
+                    waiter.set_exception(e)
+        else:
+            for waiter in batch.values():
+                if not waiter.done():
+                    waiter.set_result(None)
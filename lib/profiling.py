@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import signal
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+
+class Profiler(object):
+    """
+    On-demand profiling of the running agent.
+
+    Triggered by signals or by creating a file of the same name in
+    ``directory``:
+
+        SIGUSR1  cprofile     run cProfile for the next ``seconds`` seconds
+        SIGUSR2  tracemalloc  take tracemalloc snapshot, diff to previous one
+        SIGQUIT  tasks        dump stacks of all asyncio tasks
+
+    Results are written to ``directory``, which keeps at most
+    ``max_files`` results.
+    """
+
+    TRIGGERS = {
+        'cprofile': 'start_cprofile',
+        'tracemalloc': 'take_snapshot',
+        'tasks': 'dump_tasks',
+    }
+
+    def __init__(self, directory, seconds=30, max_files=20, poll=5):
+        self.logger = logging.getLogger('hbloader')
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.seconds = seconds
+        self.max_files = max_files
+        self.poll = poll
+
+        self.profile = None
+        self.snapshot = None
+        self.task = None
+
+    def install(self):
+        '''
+        Register signal handlers and start watching trigger files.
+        '''
+        loop = asyncio.get_event_loop()
+        handlers = {
+            signal.SIGUSR1: self.start_cprofile,
+            signal.SIGUSR2: self.take_snapshot,
+            signal.SIGQUIT: self.dump_tasks,
+        }
+        for signum, handler in handlers.items():
+            try:
+                loop.add_signal_handler(signum, handler)
+            except (NotImplementedError, RuntimeError):
+                # not on the main thread or not supported by platform
+                self.logger.debug('No handler for {}'.format(signum))
+
+        self.task = asyncio.ensure_future(self.watch())
+        self.logger.info('Profiling hooks installed, results in {}'.format(
+            self.directory))
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.poll)
+            for name, method in self.TRIGGERS.items():
+                trigger = self.directory.joinpath(name)
+                if trigger.exists():
+                    trigger.unlink()
+                    getattr(self, method)()
+
+    def output(self, kind, suffix='txt'):
+        '''
+        Path for a new result, oldest results are removed.
+        '''
+        results = sorted((p for p in self.directory.iterdir()
+                          if p.is_file() and p.name not in self.TRIGGERS),
+                         key=lambda p: p.stat().st_mtime)
+        for p in results[:max(0, len(results) - self.max_files + 1)]:
+            p.unlink()
+
+        stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        return self.directory.joinpath('{}-{}.{}'.format(kind, stamp, suffix))
+
+    def start_cprofile(self):
+        if self.profile is not None:
+            self.logger.info('cProfile already running')
+            return
+
+        self.logger.info('cProfile started for {}s'.format(self.seconds))
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        asyncio.get_event_loop().call_later(self.seconds, self.stop_cprofile)
+
+    def stop_cprofile(self):
+        if self.profile is None:
+            return
+
+        profile, self.profile = self.profile, None
+        profile.disable()
+
+        path = self.output('cprofile', 'pstats')
+        profile.dump_stats(str(path))
+
+        text = io.StringIO()
+        stats = pstats.Stats(profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(50)
+        path.with_suffix('.txt').write_text(text.getvalue())
+
+        self.logger.info('cProfile written to {}'.format(path))
+
+    def take_snapshot(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.logger.info('tracemalloc started, next trigger takes snapshot')
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        path = self.output('tracemalloc')
+
+        if self.snapshot is None:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self.snapshot, 'lineno')
+        self.snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ['current {} peak {}'.format(current, peak)]
+        lines.extend(str(stat) for stat in stats[:50])
+        path.write_text('\n'.join(lines) + '\n')
+
+        self.logger.info('tracemalloc written to {}'.format(path))
+
+    def dump_tasks(self):
+        path = self.output('tasks')
+        text = io.StringIO()
+
+        for task in asyncio.all_tasks():
+            text.write('{}\n'.format(task))
+            task.print_stack(file=text)
+            text.write('\n')
+
+        path.write_text(text.getvalue())
+        self.logger.info('Task stacks written to {}'.format(path))
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.profile is not None:
+            self.stop_cprofile()
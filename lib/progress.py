@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+
+
+class ProgressReporter(object):
+    """
+    Collects progress events of a running action and posts them as
+    'proceeding' feedback in the background.
+
+    Events are coalesced: at most one feedback is sent every ``interval``
+    seconds, and only if progress advanced at least ``step`` percent or a
+    new phase started.
+    """
+
+    def __init__(self, send, interval=10, step=5, step_callback=None):
+        '''
+        Args:
+            send: coroutine function send(percentage, message)
+        Keyword Args:
+            interval: minimal number of seconds between two feedbacks
+            step: minimal progress in percent between two feedbacks
+            step_callback: local callback step_callback(percentage, message)
+        '''
+        self.logger = logging.getLogger('hbloader')
+        self.send = send
+        self.interval = interval
+        self.step = step
+        self.step_callback = step_callback
+
+        self.percentage = 0
+        self.message = ''
+        self.sent_percentage = None
+        self.sent_message = None
+        self.sent_time = 0
+
+        self.loop = asyncio.get_event_loop()
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self
+
+    def update(self, percentage, message):
+        '''
+        Record progress, never blocks.
+        '''
+        self.percentage = max(0, min(100, int(percentage)))
+        self.message = message
+        self.changed.set()
+
+    def update_threadsafe(self, percentage, message):
+        '''
+        Record progress from a worker thread.
+        '''
+        self.loop.call_soon_threadsafe(self.update, percentage, message)
+
+    def phase(self, start, end, message):
+        '''
+        Return callback mapping (done, total) of a phase onto
+        the [start, end] percentage range.
+        '''
+        def callback(done, total):
+            if total:
+                pct = start + (end - start) * min(done, total) / total
+            else:
+                pct = start
+            self.update(pct, message)
+
+        self.update(start, message)
+        return callback
+
+    def due(self):
+        if self.message != self.sent_message:
+            return True
+        if self.sent_percentage is None:
+            return True
+        return self.percentage - self.sent_percentage >= self.step
+
+    async def run(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+
+            if not self.due():
+                continue
+
+            wait = self.sent_time + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            await self.flush()
+
+    async def flush(self):
+        """
+        Post current progress now.
+        """
+        percentage, message = self.percentage, self.message
+        if (percentage, message) == (self.sent_percentage, self.sent_message):
+            return
+
+        self.sent_percentage = percentage
+        self.sent_message = message
+        self.sent_time = time.monotonic()
+
+        if self.step_callback:
+            self.step_callback(percentage, message)
+
+        try:
+            await self.send(percentage, message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # progress is informational only, never fail the action
+            self.logger.warning('Progress feedback failed: {}'.format(e))
+
+    async def close(self):
+        """
+        Stop reporting. Pending progress is dropped, final feedback
+        is sent by the caller.
+        """
+        if self.task is None:
+            return
+
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
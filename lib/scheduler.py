@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+
+
+class ActionContext(object):
+    """
+    State of one action in flight: its task, downloaded files and
+    feedback stream.
+    """
+
+    def __init__(self, action_id, resource=None):
+        self.action_id = action_id
+        self.resource = resource
+        self.dl_filename = ''
+        self.dl_location = None
+        self.progress = None
+        self.task = None
+        # install has started and can no longer be cancelled
+        self.installing = False
+        # downstream device of the action in gateway mode
+        self.identity = None
+
+
+class ActionScheduler(object):
+    """
+    Runs several assigned actions concurrently.
+
+    At most ``max_actions`` actions run at the same time, further actions
+    wait for a free slot. Actions touching the same resource (e.g. the same
+    service) are serialized with ``lock(name)``.
+    """
+
+    def __init__(self, max_actions=2):
+        self.logger = logging.getLogger('hbloader')
+        self.max_actions = max_actions
+        self.slots = asyncio.Semaphore(max_actions)
+        self.actions = {}
+        self.locks = {}
+
+    def __contains__(self, action_id):
+        return action_id in self.actions
+
+    def __len__(self):
+        return len(self.actions)
+
+    def get(self, action_id):
+        return self.actions.get(action_id)
+
+    def submit(self, action, handler):
+        '''
+        Run handler(action) as a task of its own.
+        '''
+        action.task = asyncio.ensure_future(self.run(action, handler))
+        self.actions[action.action_id] = action
+        return action
+
+    async def run(self, action, handler):
+        try:
+            async with self.slots:
+                self.logger.info('Action {} started ({} in flight)'.format(
+                    action.action_id, len(self.actions)))
+                await handler(action)
+
+        except asyncio.CancelledError:
+            self.logger.info('Action {} cancelled'.format(action.action_id))
+
+        except Exception as e:
+            self.logger.warning('Action {} failed: {}'.format(action.action_id, e))
+
+        finally:
+            self.actions.pop(action.action_id, None)
+
+    def lock(self, name):
+        '''
+        Lock for resource name, e.g. 'service:nginx'
+        '''
+        if name not in self.locks:
+            self.locks[name] = asyncio.Lock()
+        return self.locks[name]
+
+    def cancel(self, action_id):
+        '''
+        Cancel action, returns False if it is not in flight.
+        '''
+        action = self.actions.get(action_id)
+        if action is None:
+            return False
+
+        action.task.cancel()
+        return True
+
+    async def close(self):
+        """
+        Cancel all actions and wait for them.
+        """
+        tasks = [action.task for action in self.actions.values()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
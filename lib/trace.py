@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+'''
+Record and replay of HTTP traffic of the DDI and MI clients.
+
+RecordingSession wraps the aiohttp session shared by both clients and
+writes every request with its response, status code and timing to a
+trace file (JSON lines, gzip compressed if the name ends with .gz).
+Small text bodies are stored in the trace itself, binary and large
+bodies (e.g. artifacts) once per SHA-256 digest in the directory
+<trace>.bodies next to it. ReplaySession answers requests from such a
+trace without a server, at the recorded pace or faster.
+
+Traces contain the server's responses including security tokens.
+'''
+
+import asyncio
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import aiohttp
+
+# larger bodies go to side files
+INLINE_BODY = 64 * 1024
+
+# response headers kept in the trace
+HEADERS = ('Content-Type', 'Content-Encoding', 'Content-Length', 'Retry-After')
+
+# exceptions recorded and raised again on replay
+ERRORS = {
+    'TimeoutError': asyncio.TimeoutError,
+    'ClientConnectionError': aiohttp.ClientConnectionError,
+    'ClientOSError': aiohttp.ClientOSError,
+    'ClientPayloadError': aiohttp.ClientPayloadError,
+    'ServerDisconnectedError': aiohttp.ServerDisconnectedError,
+}
+
+
+def request_key(method, url, params=None):
+    '''
+    Method and path with query, independent of host and parameter order
+    '''
+    parts = urlsplit(str(url))
+    query = sorted(p for p in parts.query.split('&') if p)
+    if params:
+        query = sorted(query + ['{}={}'.format(k, v)
+                                for k, v in params.items() if v is not None])
+    return '{} {}{}'.format(method, parts.path,
+                            '?' + '&'.join(query) if query else '')
+
+
+def bodies_directory(path):
+    return Path(str(path) + '.bodies')
+
+
+def encode_body(body, directory):
+    '''
+    Trace entry of body: inline text, or the digest of its side file
+    in directory
+    '''
+    if len(body) <= INLINE_BODY:
+        try:
+            return {'text': body.decode('utf-8')}
+        except UnicodeDecodeError:
+            pass
+
+    digest = hashlib.sha256(body).hexdigest()
+    path = directory.joinpath(digest)
+    if not path.exists():
+        directory.mkdir(exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        tmp.write_bytes(body)
+        tmp.replace(path)
+    return {'sha256': digest}
+
+
+def decode_body(entry, directory):
+    if 'text' in entry:
+        return entry['text'].encode('utf-8')
+    if 'sha256' in entry:
+        try:
+            return directory.joinpath(entry['sha256']).read_bytes()
+        except FileNotFoundError:
+            pass
+    # body was too large to be recorded, or its side file is gone
+    return bytes(entry.get('size', 0))
+
+
+def open_trace(path, mode):
+    path = str(path)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class RecordedContent(object):
+    def __init__(self, content, response):
+        self.content = content
+        self.response = response
+
+    async def readchunk(self):
+        chunk, end = await self.content.readchunk()
+        self.response.capture(chunk)
+        return chunk, end
+
+    async def read(self, n=-1):
+        chunk = await self.content.read(n)
+        self.response.capture(chunk)
+        return chunk
+
+
+class RecordedResponse(object):
+    """
+    Response proxy capturing the body while the client reads it.
+    """
+
+    def __init__(self, resp, max_body):
+        self.resp = resp
+        self.max_body = max_body
+        self.body = []
+        self.size = 0
+        self.content = RecordedContent(resp.content, self)
+
+    def __getattr__(self, name):
+        return getattr(self.resp, name)
+
+    def capture(self, chunk):
+        self.size += len(chunk)
+        if self.body is not None:
+            self.body.append(chunk)
+            if self.size > self.max_body:
+                self.body = None
+
+    async def read(self):
+        body = await self.resp.read()
+        self.capture(body)
+        return body
+
+    async def text(self):
+        return (await self.read()).decode('utf-8', 'replace')
+
+
+class RecordingRequest(object):
+    def __init__(self, session, method, url, kwargs):
+        self.session = session
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+
+    async def __aenter__(self):
+        self.start = time.monotonic()
+        self.request = getattr(self.session.session, self.method.lower())(
+                self.url, **self.kwargs)
+        try:
+            resp = await self.request.__aenter__()
+        except Exception as e:
+            self.session.write(self, None, e)
+            raise
+        self.response = RecordedResponse(resp, self.session.max_body)
+        return self.response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.session.write(self, self.response, exc)
+        return await self.request.__aexit__(exc_type, exc, tb)
+
+
+class RecordingSession(object):
+    """
+    aiohttp session wrapper writing all traffic to a trace file.
+    """
+
+    def __init__(self, session, path, max_body=16 * 1024 * 1024):
+        self.logger = logging.getLogger('hbloader')
+        self.session = session
+        self.max_body = max_body
+        self.trace = open_trace(path, 'w')
+        self.bodies = bodies_directory(path)
+        self.started = time.monotonic()
+        self.logger.info('Recording traffic to %s', path)
+
+    def get(self, url, **kwargs):
+        return RecordingRequest(self, 'GET', url, kwargs)
+
+    def post(self, url, **kwargs):
+        return RecordingRequest(self, 'POST', url, kwargs)
+
+    def put(self, url, **kwargs):
+        return RecordingRequest(self, 'PUT', url, kwargs)
+
+    def write(self, request, response, error):
+        entry = {
+            'key': request_key(request.method, request.url,
+                               request.kwargs.get('params')),
+            'at': round(request.start - self.started, 4),
+            'took': round(time.monotonic() - request.start, 4),
+        }
+        data = request.kwargs.get('data')
+        if data:
+            entry['request'] = encode_body(
+                    data if isinstance(data, bytes)
+                    else str(data).encode('utf-8'), self.bodies)
+
+        if response is not None:
+            entry['status'] = response.status
+            entry['reason'] = response.reason
+            entry['headers'] = {k: response.headers[k] for k in HEADERS
+                                if k in response.headers}
+            body = {'size': response.size}
+            if response.body is not None:
+                body.update(encode_body(b''.join(response.body), self.bodies))
+            entry['body'] = body
+
+        # errors of the client itself (e.g. on bad status) are not traffic
+        if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError)):
+            entry['error'] = [type(error).__name__, str(error)]
+
+        self.trace.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.trace.flush()
+
+    def close(self):
+        self.trace.close()
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def recorded_error(entry):
+    name, message = entry['error']
+    return ERRORS.get(name, aiohttp.ClientConnectionError)(message)
+
+
+class ReplayContent(object):
+    def __init__(self, body, error=None, chunk_size=64 * 1024):
+        self.body = body
+        self.error = error
+        self.offset = 0
+        self.chunk_size = chunk_size
+
+    async def readchunk(self):
+        chunk = self.body[self.offset:self.offset + self.chunk_size]
+        if not chunk and self.error is not None:
+            raise self.error
+        self.offset += len(chunk)
+        return chunk, False
+
+    async def read(self, n=-1):
+        end = len(self.body) if n < 0 else self.offset + n
+        chunk = self.body[self.offset:end]
+        if not chunk and self.error is not None:
+            raise self.error
+        self.offset += len(chunk)
+        return chunk
+
+
+class ReplayResponse(object):
+    def __init__(self, method, entry, bodies):
+        self.method = method
+        self.status = entry['status']
+        self.reason = entry.get('reason', '')
+        self.headers = entry.get('headers', {})
+        self.body = decode_body(entry.get('body', {}), bodies)
+        self.content_length = len(self.body)
+        # failure while the body was read, e.g. connection reset
+        self.error = recorded_error(entry) if 'error' in entry else None
+        self.content = ReplayContent(self.body, self.error)
+
+    async def read(self):
+        if self.error is not None:
+            raise self.error
+        return self.body
+
+    async def text(self):
+        return self.body.decode('utf-8', 'replace')
+
+
+class ReplayRequest(object):
+    def __init__(self, session, method, url, kwargs):
+        self.session = session
+        self.method = method
+        self.key = request_key(method, url, kwargs.get('params'))
+
+    async def __aenter__(self):
+        entry = self.session.take(self.key)
+        if self.session.speed:
+            # not answered before the request was made in the recording
+            await asyncio.sleep(max(self.session.due(entry), 0) +
+                                entry['took'] / self.session.speed)
+
+        if 'error' in entry and 'status' not in entry:
+            raise recorded_error(entry)
+        return ReplayResponse(self.method, entry, self.session.bodies)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class ReplaySession(object):
+    """
+    Session answering requests from a trace.
+
+    Recorded responses are handed out in order per request (method, path
+    and query), not before the time the request was made in the
+    recording. speed scales the recorded times, 0 answers immediately.
+    Requests missing from the trace fail with a connection error.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.logger = logging.getLogger('hbloader')
+        self.speed = speed
+        self.bodies = bodies_directory(path)
+        # replay time which corresponds to the start of the recording
+        self.started = None
+        self.entries = collections.defaultdict(collections.deque)
+        self.remaining = 0
+        self.missing = []
+        # all entries used, or a recorded request asked for more often
+        # than it was recorded: the agent went past the end of the trace
+        self.ended = asyncio.Event()
+
+        with open_trace(path, 'r') as trace:
+            for line in trace:
+                entry = json.loads(line)
+                self.entries[entry['key']].append(entry)
+                self.remaining += 1
+
+        self.logger.info('Replaying %s requests from %s', self.remaining, path)
+
+    def take(self, key):
+        queue = self.entries.get(key)
+        if not queue:
+            if queue is not None:
+                self.ended.set()
+            else:
+                self.missing.append(key)
+            raise aiohttp.ClientConnectionError(
+                'Request not in trace: {}'.format(key))
+
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.ended.set()
+        return queue.popleft()
+
+    def due(self, entry):
+        '''
+        Seconds until the recorded time of entry, scaled by speed
+        '''
+        now = time.monotonic()
+        if self.started is None:
+            # the first request is answered right away
+            self.started = now - entry['at'] / self.speed
+        return self.started + entry['at'] / self.speed - now
+
+    def get(self, url, **kwargs):
+        return ReplayRequest(self, 'GET', url, kwargs)
+
+    def post(self, url, **kwargs):
+        return ReplayRequest(self, 'POST', url, kwargs)
+
+    def put(self, url, **kwargs):
+        return ReplayRequest(self, 'PUT', url, kwargs)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
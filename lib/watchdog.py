@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+
+from .metrics import REGISTRY
+
+LOOP_LAG = REGISTRY.histogram(
+    'hbloader_loop_lag_seconds',
+    'Delay of event loop heartbeats')
+
+BLOCKING_CALLS = REGISTRY.counter(
+    'hbloader_blocking_calls_total',
+    'Callbacks blocking the event loop longer than the threshold',
+    ('location',))
+
+# frames of the agent itself are preferred when attributing a block
+AGENT_ROOT = str(Path(__file__).resolve().parent.parent)
+
+
+class LoopMonitor(object):
+    """
+    Measures event loop lag and attributes blocking calls.
+
+    A heartbeat coroutine wakes up every ``interval`` seconds and records
+    how late it was. A watchdog thread checks the heartbeat; when the loop
+    did not run for ``threshold`` seconds it captures the stack of the loop
+    thread, which shows the blocking call.
+    """
+
+    def __init__(self, threshold=0.25, interval=0.1):
+        self.logger = logging.getLogger('hbloader')
+        self.threshold = threshold
+        self.interval = interval
+
+        self.loop_thread = None
+        self.beat = time.monotonic()
+        self.max_lag = 0
+        self.blocked = deque(maxlen=100)
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.ensure_future(self.heartbeat())
+        self.thread = threading.Thread(target=self.watch,
+                                       name='loop-watchdog', daemon=True)
+        self.thread.start()
+        return self
+
+    async def heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.beat = time.monotonic()
+            lag = self.beat - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+
+    def watch(self):
+        reported = None
+
+        while not self.stopped.wait(self.threshold / 2):
+            beat = self.beat
+            if time.monotonic() - beat < self.threshold:
+                continue
+
+            # report every blocking episode only once
+            if beat == reported:
+                continue
+            reported = beat
+
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+
+            stack = traceback.extract_stack(frame)
+            location = self.locate(stack)
+            self.blocked.append((location, stack))
+            BLOCKING_CALLS.inc(location=location)
+            self.logger.warning(
+                'Event loop blocked for more than {:.3f}s in {}\n{}'.format(
+                    self.threshold, location,
+                    ''.join(traceback.format_list(stack))))
+
+    @staticmethod
+    def locate(stack):
+        '''
+        Innermost frame of the agent's own code, e.g. 'hbclient.py:42 install'
+        '''
+        own = [f for f in stack if f.filename.startswith(AGENT_ROOT)]
+        frame = (own or stack)[-1]
+        return '{}:{} {}'.format(Path(frame.filename).name, frame.lineno,
+                                 frame.name)
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None